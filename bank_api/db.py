@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Applies SQLITE_PRAGMAS to every new SQLite connection.
+    WAL lets readers work during a write, busy_timeout makes writers wait for the lock instead of failing
+    and synchronous=NORMAL syncs on checkpoints only, which is safe in WAL mode.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+
+
+@receiver(request_started)
+def check_persistent_connections(**kwargs):
+    """
+    Health check of persistent connections before they are reused by a request.
+    Django closes connections only after errors inside a request, a connection dropped
+    by the server while idle would otherwise fail the first query of the next request.
+    """
+    for connection in connections.all():
+        if connection.connection is not None and connection.settings_dict['CONN_MAX_AGE'] \
+                and not connection.in_atomic_block and not connection.is_usable():
+            connection.close()
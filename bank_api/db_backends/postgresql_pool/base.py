@@ -0,0 +1,53 @@
+import threading
+
+from django.db.backends.postgresql import base
+from psycopg2 import pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend taking connections from an in-process psycopg2 pool.
+    Closing the connection at the end of request returns it to the pool, connections with errors are discarded.
+    OPTIONS['pool']: minconn - idle connections kept open, maxconn - not less than worker threads
+    """
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def get_connection_params(self):
+        conn_params = super().get_connection_params()
+        conn_params.pop('pool', None)
+        return conn_params
+
+    @property
+    def pool(self):
+        # Test database has another name, so it gets its own pool
+        key = self.alias, self.settings_dict['NAME']
+        connection_pool = self.pools.get(key)
+        if connection_pool is None:
+            with self.pools_lock:
+                connection_pool = self.pools.get(key)
+                if connection_pool is None:
+                    options = self.settings_dict['OPTIONS'].get('pool', {})
+                    connection_pool = self.pools[key] = pool.ThreadedConnectionPool(
+                        options.get('minconn', 1), options.get('maxconn', 20), **self.get_connection_params())
+        return connection_pool
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.getconn()
+
+        # Same as in django.db.backends.postgresql
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.putconn(self.connection, close=self.errors_occurred or bool(self.connection.closed))
@@ -0,0 +1,178 @@
+import hashlib
+import json
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .cache import LRUCache
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+# Request being processed and response stored for replay
+InFlight = namedtuple('InFlight', ['fingerprint'])
+StoredResponse = namedtuple('StoredResponse', ['fingerprint', 'status_code', 'data'])
+
+
+class IdempotencyKeyInUse(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'A request with this Idempotency-Key is in progress!'
+    default_code = 'idempotency_key_in_use'
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = 422
+    default_detail = 'Idempotency-Key was already used for a different request!'
+    default_code = 'idempotency_key_reused'
+
+
+class IdempotencyStore:
+    """
+    Responses by idempotency key.
+    A key is taken by the first request, concurrent requests with the key are rejected until its response
+    is stored. Stored responses expire after ttl, keys of requests which never finished after in_flight_ttl.
+    """
+    def __init__(self, ttl=24 * 60 * 60, in_flight_ttl=60):
+        self.ttl = ttl
+        self.in_flight_ttl = in_flight_ttl
+
+    def begin(self, key, fingerprint):
+        """
+        Takes key for a request
+        :param key:
+        :param fingerprint: hash of request data
+        :return: StoredResponse to replay or None if the request should be processed
+        """
+        while not self.add(key, InFlight(fingerprint), ttl=self.in_flight_ttl):
+            entry = self.get(key)
+            if entry is None:
+                # Expired in the meantime
+                continue
+            if entry.fingerprint != fingerprint:
+                raise IdempotencyKeyReused()
+            if isinstance(entry, InFlight):
+                raise IdempotencyKeyInUse()
+            return entry
+        return None
+
+    def complete(self, key, fingerprint, response):
+        self.set(key, StoredResponse(fingerprint, response.status_code, response.data), ttl=self.ttl)
+
+    def release(self, key):
+        self.delete(key)
+
+
+class LocalIdempotencyStore(IdempotencyStore):
+    """
+    Keys of this worker process in a bounded cache, a retry is recognised only by the process
+    which served the first request
+    """
+    def __init__(self, max_size=10000, **kwargs):
+        super().__init__(**kwargs)
+        self._cache = LRUCache(max_size=max_size)
+
+    def add(self, key, value, ttl):
+        return self._cache.add(key, value, ttl=ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, ttl=ttl)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class CacheIdempotencyStore(IdempotencyStore):
+    """
+    Keys shared by worker processes in a Django cache (settings.CACHES), taken atomically with cache.add
+    """
+    key_prefix = 'idempotency:'
+
+    def __init__(self, alias, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = caches[alias]
+
+    def cache_key(self, key):
+        # Idempotency keys are client input, hashed to a valid cache key
+        return self.key_prefix + hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def add(self, key, value, ttl):
+        return self.cache.add(self.cache_key(key), value, timeout=ttl)
+
+    def get(self, key):
+        return self.cache.get(self.cache_key(key))
+
+    def set(self, key, value, ttl):
+        self.cache.set(self.cache_key(key), value, timeout=ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.cache_key(key))
+
+    def clear(self):
+        self.cache.clear()
+
+
+def get_idempotency_store():
+    ttls = {'ttl': getattr(settings, 'IDEMPOTENCY_KEY_TTL', 24 * 60 * 60),
+            'in_flight_ttl': getattr(settings, 'IDEMPOTENCY_IN_FLIGHT_TTL', 60)}
+    alias = getattr(settings, 'IDEMPOTENCY_CACHE', None)
+    if alias:
+        return CacheIdempotencyStore(alias, **ttls)
+    return LocalIdempotencyStore(max_size=getattr(settings, 'IDEMPOTENCY_CACHE_SIZE', 10000), **ttls)
+
+
+idempotency_store = get_idempotency_store()
+
+
+class IdempotencyMixin:
+    """
+    Replays the stored response of POST and PUT requests repeated with the same Idempotency-Key header.
+    Keys are scoped to the user and URL. Responses of server errors and exceptions are not stored,
+    so such requests can be retried with the same key.
+    Views defining their own post / put wrap the handler with idempotent.
+    """
+    max_key_length = 255
+
+    def post(self, request, *args, **kwargs):
+        return self.idempotent(super().post, request, *args, **kwargs)
+
+    def put(self, request, *args, **kwargs):
+        return self.idempotent(super().put, request, *args, **kwargs)
+
+    def idempotent(self, handler, request, *args, **kwargs):
+        idempotency_key = request.META.get(IDEMPOTENCY_HEADER)
+        if not idempotency_key:
+            return handler(request, *args, **kwargs)
+        if len(idempotency_key) > self.max_key_length:
+            raise ValidationError(f'Idempotency-Key should be at most {self.max_key_length} characters!')
+
+        key = (request.user.pk, request.method, request.path, idempotency_key)
+        fingerprint = self.fingerprint(request)
+        stored = idempotency_store.begin(key, fingerprint)
+        if stored is not None:
+            return Response(stored.data, status=stored.status_code, headers={'Idempotent-Replayed': 'true'})
+
+        try:
+            response = handler(request, *args, **kwargs)
+        except Exception:
+            idempotency_store.release(key)
+            raise
+        if response.status_code >= 500:
+            idempotency_store.release(key)
+        else:
+            idempotency_store.complete(key, fingerprint, response)
+        return response
+
+    @staticmethod
+    def fingerprint(request):
+        data = json.dumps(request.data, cls=JSONEncoder, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
@@ -0,0 +1,145 @@
+import bisect
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+# Upper bounds of histogram buckets in milliseconds, the last bucket is unbounded
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class QueryRecorder:
+    """
+    Database execute wrapper counting queries, their time and repeated SQL of one request
+    """
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.statements[sql] += 1
+
+    @property
+    def duplicates(self):
+        # Same SQL with other parameters is the usual N+1 pattern
+        return self.count - len(self.statements)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self, count):
+        return {
+            'buckets': {f'le_{bound}' if bound else 'inf': hits
+                        for bound, hits in zip(HISTOGRAM_BUCKETS + (None,), self.buckets)},
+            'avg': round(self.total / count, 3) if count else 0,
+            'max': round(self.max, 3),
+        }
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.count = 0
+        self.wall = Histogram()
+        self.db = Histogram()
+        self.queries = 0
+        self.max_queries = 0
+        self.duplicates = 0
+        self.max_duplicates = 0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'wall_ms': self.wall.to_dict(self.count),
+            'db_ms': self.db.to_dict(self.count),
+            'queries': {'avg': round(self.queries / self.count, 3) if self.count else 0, 'max': self.max_queries},
+            'duplicates': {'total': self.duplicates, 'max': self.max_duplicates},
+        }
+
+
+class RequestMetrics:
+    """
+    In-process aggregation of request metrics per URL name
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, name, wall_ms, db_ms, queries, duplicates):
+        with self._lock:
+            endpoint = self._endpoints.get(name)
+            if endpoint is None:
+                endpoint = self._endpoints[name] = EndpointMetrics()
+            endpoint.count += 1
+            endpoint.wall.add(wall_ms)
+            endpoint.db.add(db_ms)
+            endpoint.queries += queries
+            endpoint.max_queries = max(endpoint.max_queries, queries)
+            endpoint.duplicates += duplicates
+            endpoint.max_duplicates = max(endpoint.max_duplicates, duplicates)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: endpoint.to_dict() for name, endpoint in sorted(self._endpoints.items())}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+
+request_metrics = RequestMetrics()
+
+
+class PerformanceMiddleware:
+    """
+    Records wall time, DB time, query count and duplicated queries of every request per resolved URL name.
+    Values are added to request_metrics, to the response as Server-Timing header and
+    to the response object as query_count / duplicate_queries (used by query budget tests).
+    Queries of streaming responses run after the view returns and are not counted.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'PERFORMANCE_METRICS', True)
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        wall_ms = (time.perf_counter() - start) * 1000
+        db_ms = recorder.duration * 1000
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        name = resolver_match.url_name if resolver_match and resolver_match.url_name else 'unresolved'
+        request_metrics.record(name, wall_ms, db_ms, recorder.count, recorder.duplicates)
+
+        response['Server-Timing'] = f'app;dur={wall_ms:.1f}, ' \
+                                    f'db;dur={db_ms:.1f};desc="{recorder.count} queries, ' \
+                                    f'{recorder.duplicates} duplicates"'
+        response.url_name = name
+        response.query_count = recorder.count
+        response.duplicate_queries = recorder.duplicates
+        return response
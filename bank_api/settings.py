@@ -12,20 +12,28 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+def env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes')
+
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
+# Production values come from environment variables
 
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 'qj=5c8^b*_qm#0_0xjbucsbuy4ryc4@jkpq1%488oego&d^2a5'
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', 'qj=5c8^b*_qm#0_0xjbucsbuy4ryc4@jkpq1%488oego&d^2a5')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# Debug mode also keeps every SQL query of a request in memory
+DEBUG = env_bool('DJANGO_DEBUG', True)
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.environ.get('DJANGO_ALLOWED_HOSTS', '').split(',') if host]
 
 
 # Application definition
@@ -55,6 +63,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'bank_api.instrumentation.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -91,11 +100,53 @@ WSGI_APPLICATION = 'bank_api.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# DATABASE_ENGINE selects the profile:
+#   sqlite          - local use, WAL mode, busy_timeout and synchronous=NORMAL are set on connect (bank_api.db)
+#   postgresql      - persistent connections (DATABASE_CONN_MAX_AGE) checked before every request
+#   postgresql_pool - in-process psycopg2 connection pool per worker (DATABASE_POOL_MIN / DATABASE_POOL_MAX),
+#                     connections are returned to the pool after every request
+# PostgreSQL profiles require psycopg2
+
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+
+if DATABASE_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DATABASE_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DATABASE_NAME', 'bank_api'),
+            'USER': os.environ.get('DATABASE_USER', 'bank_api'),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', 'localhost'),
+            'PORT': os.environ.get('DATABASE_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+            'OPTIONS': {
+                'connect_timeout': int(os.environ.get('DATABASE_CONNECT_TIMEOUT', 5)),
+            },
+        }
     }
+    if DATABASE_ENGINE == 'postgresql_pool':
+        DATABASES['default'].update({
+            'ENGINE': 'bank_api.db_backends.postgresql_pool',
+            'CONN_MAX_AGE': 0,
+        })
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'minconn': int(os.environ.get('DATABASE_POOL_MIN', 4)),
+            'maxconn': int(os.environ.get('DATABASE_POOL_MAX', 20)),
+        }
+
+# SQLite connection tuning (bank_api.db)
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    'synchronous': 'NORMAL',
 }
 
 
@@ -123,6 +174,76 @@ TWILIO_ACCOUNT_SID = ''
 TWILIO_AUTH_TOKEN = ''
 TWILIO_NUMBER = ''
 
+# Notifications outbox delivery (manage.py send_notifications)
+
+SMS_PROVIDER = 'notifications.providers.TwilioSMSProvider'
+NOTIFICATION_WORKERS = 8
+NOTIFICATION_BATCH_SIZE = 100
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_BACKOFF = 30
+
+# Gateway of notifications.providers.HTTPSMSProvider
+
+SMS_HTTP_URL = os.environ.get('SMS_HTTP_URL', '')
+SMS_HTTP_TOKEN = os.environ.get('SMS_HTTP_TOKEN') or None
+SMS_HTTP_TIMEOUT = 10
+
+# Request metrics per URL name (bank_api.instrumentation), served to admins at api/v1/metrics/
+
+PERFORMANCE_METRICS = env_bool('PERFORMANCE_METRICS', True)
+
+# Maximum number of queries per request by URL name, enforced by tests (assertWithinQueryBudget)
+
+QUERY_BUDGETS = {
+    'info': 5,
+    'currencies': 3,
+    'account_products': 3,
+    'accounts': 6,
+    'managers': 4,
+    'accountants': 4,
+    'persons': 3,
+    'all_users': 6,
+    'customers': 3,
+    'transfers': 4,
+    'transfers_details': 9,
+    'statement': 9,
+    'approval_batches': 4,
+    'turnover_report': 4,
+    'transfer_events': 4,
+    'send_otp': 12,
+    'metrics': 3,
+    'token_obtain': 3,
+    'token_refresh': 3,
+    'token_revoke': 0,
+}
+
+# Fund transfers batch submission
+
+FUND_TRANSFER_BATCH_MAX_LINES = 10000
+FUND_TRANSFER_BATCH_CHUNK_SIZE = 1000
+
+# Ledger entries fetched at once by statement export (statement/?export=csv|ndjson)
+
+STATEMENT_EXPORT_CHUNK_SIZE = 2000
+
+# Clearing of external payment systems (fund_transfers.clearing, manage.py run_clearing / ingest_clearing_acks)
+# Approved transfers of a payment system are written to a pain.001 file when batch_size of them are queued
+# or the oldest has waited max_wait seconds
+
+CLEARING_QUEUES = {
+    'B': {'batch_size': 1000, 'max_wait': 15 * 60, 'service_level': 'NURG'},  # BISERA
+    'T': {'batch_size': 100, 'max_wait': 60, 'service_level': 'URGP'},  # TARGET2
+    'S': {'batch_size': 100, 'max_wait': 5 * 60, 'service_level': 'NURG'},  # SWIFT
+    'E': {'batch_size': 5000, 'max_wait': 30 * 60, 'service_level': 'SEPA'},  # SEPA
+}
+CLEARING_BANK_BIC = 'DJNGBGSF'
+CLEARING_OUTBOX_DIR = os.environ.get('CLEARING_OUTBOX_DIR', os.path.join(BASE_DIR, 'clearing', 'outbox'))
+CLEARING_INBOX_DIR = os.environ.get('CLEARING_INBOX_DIR', os.path.join(BASE_DIR, 'clearing', 'inbox'))
+
+# Fund transfer events returned at most by one read (transfers/events/)
+
+TRANSFER_EVENTS_PAGE_SIZE = 500
+
 # Internationalization
 # https://docs.djangoproject.com/en/2.2/topics/i18n/
 
@@ -150,5 +271,72 @@ SWAGGER_SETTINGS = {
     },
 }
 
+# Cross-request cache of resolved extended users (registrations.roles)
+# Invalidation by signals is per process, TTL bounds staleness between processes
+
+EXTENDED_USER_CACHE_SIZE = 4096
+EXTENDED_USER_CACHE_TTL = 300
+
+# In-process cache of currencies and account products (registrations.reference)
+# Invalidation by signals is per process, TTL bounds staleness between processes.
+# Money conversion always reads current rates from the database.
+
+REFERENCE_DATA_CACHE_TTL = 60
+
+# Responses of fund transfer POST / PUT requests stored by Idempotency-Key header (bank_api.idempotency)
+# Keys are kept in IDEMPOTENCY_CACHE, an alias of CACHES shared by worker processes. Without it they are kept
+# per process: a retry served by another worker is processed again, so more than one worker refuses to start.
+
+IDEMPOTENCY_CACHE_SIZE = 10000
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+IDEMPOTENCY_IN_FLIGHT_TTL = 60
+IDEMPOTENCY_CACHE = os.environ.get('IDEMPOTENCY_CACHE') or None
+if IDEMPOTENCY_CACHE is None and int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+    raise ImproperlyConfigured('IDEMPOTENCY_CACHE is required with more than one worker process')
+
+# Token bucket throttles (bank_api.throttling): bursts up to the number, refilled evenly over the period
+# THROTTLE_CACHE is an alias of CACHES shared by worker processes, buckets are kept per process if not set
+
+THROTTLE_RATES = {
+    'otp_user': '20/hour',
+    'otp_target': '5/hour',
+}
+THROTTLE_CACHE = os.environ.get('THROTTLE_CACHE') or None
+
+# Seconds an OTP is sent again instead of generating a new one
+
+OTP_TTL = 300
+
+# Signed access / refresh tokens (registrations.authentication), lifetimes in seconds
+# Access tokens carry is_staff / is_superuser, so JWT_SECRET_KEY must come from the environment in production
+# Revoked token ids are kept until the tokens expire in JWT_REVOCATION_CACHE, an alias of CACHES shared
+# by worker processes. Without it they are kept per process: a token revoked (logout, refresh) in one worker
+# is still accepted by the others, so more than one worker (WEB_CONCURRENCY) refuses to start.
+
+JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY')
+if JWT_SECRET_KEY is None:
+    if not DEBUG:
+        raise ImproperlyConfigured('JWT_SECRET_KEY environment variable is required when DEBUG is off')
+    JWT_SECRET_KEY = SECRET_KEY
+JWT_ALGORITHM = 'HS256'
+JWT_ACCESS_TOKEN_TTL = 5 * 60
+JWT_REFRESH_TOKEN_TTL = 24 * 60 * 60
+JWT_REVOCATION_CACHE_SIZE = 100000
+JWT_REVOCATION_CACHE = os.environ.get('JWT_REVOCATION_CACHE') or None
+if JWT_REVOCATION_CACHE is None and int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+    raise ImproperlyConfigured('JWT_REVOCATION_CACHE is required with more than one worker process')
+
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': (
+        'rest_framework.authentication.SessionAuthentication',
+        'registrations.authentication.JWTAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ),
+}
+
+# Account IBAN sequence values reserved at once by a worker process
+
+IBAN_BLOCK_SIZE = 100
+
 LOGIN_URL = 'registrations/auth/login/'
 LOGOUT_URL = 'registrations/auth/logout/'
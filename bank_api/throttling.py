@@ -0,0 +1,107 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+from .cache import LRUCache
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    """
+    :param rate: 'number/period' as in DRF throttles, e.g. '5/minute'
+    :return: tuple of bucket capacity and seconds to refill one token
+    """
+    capacity, period = rate.split('/')
+    capacity = int(capacity)
+    return capacity, RATE_PERIODS[period[0]] / capacity
+
+
+def take_token(bucket, capacity, refill, now):
+    """
+    :param bucket: (tokens, updated) or None for a full bucket
+    :return: tuple of new bucket and seconds to wait, 0 if a token was taken
+    """
+    tokens, updated = bucket if bucket is not None else (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) / refill)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) * refill
+
+
+class LocalBucketStore:
+    """
+    Token buckets of this worker process
+    """
+    def __init__(self, max_size=10000):
+        self._buckets = LRUCache(max_size=max_size)
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, refill):
+        with self._lock:
+            bucket, wait = take_token(self._buckets.get(key), capacity, refill, time.time())
+            # Full bucket is the same as a missing one
+            self._buckets.set(key, bucket, ttl=capacity * refill)
+        return wait
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class CacheBucketStore:
+    """
+    Token buckets shared by worker processes in a Django cache (settings.CACHES).
+    Read and write of a bucket are not atomic, concurrent requests may take the same token.
+    """
+    key_prefix = 'throttle:'
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def consume(self, key, capacity, refill):
+        bucket, wait = take_token(self.cache.get(self.key_prefix + key), capacity, refill, time.time())
+        self.cache.set(self.key_prefix + key, bucket, timeout=int(capacity * refill) + 1)
+        return wait
+
+    def clear(self):
+        self.cache.clear()
+
+
+def get_bucket_store():
+    alias = getattr(settings, 'THROTTLE_CACHE', None)
+    return CacheBucketStore(alias) if alias else LocalBucketStore()
+
+
+bucket_store = get_bucket_store()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle with a token bucket per key. Bursts up to the rate number are allowed,
+    tokens are refilled evenly over the rate period.
+    Rates come from settings.THROTTLE_RATES by scope.
+    """
+    scope = None
+
+    def __init__(self):
+        self.capacity, self.refill = parse_rate(settings.THROTTLE_RATES[self.scope])
+        self.wait_time = None
+
+    def get_key(self, request, view):
+        """
+        :return: bucket key or None if the request is not throttled
+        """
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        key = self.get_key(request, view)
+        if key is None:
+            return True
+        self.wait_time = bucket_store.consume(f'{self.scope}:{key}', self.capacity, self.refill)
+        return not self.wait_time
+
+    def wait(self):
+        return self.wait_time
@@ -17,6 +17,8 @@ from django.contrib import admin
 from django.urls import path, re_path, include
 from rest_framework_swagger.views import get_swagger_view
 
+from .views import PerformanceMetricsView
+
 swagger_schema_view = get_swagger_view(title='Django Bank API')
 
 urlpatterns = [
@@ -25,5 +27,6 @@ urlpatterns = [
     path('api/v1/registrations/', include('registrations.urls')),
     path('api/v1/fund_transfers/', include('fund_transfers.urls')),
     path('api/v1/notifications/', include('notifications.urls')),
+    path('api/v1/metrics/', PerformanceMetricsView.as_view(), name='metrics'),
     re_path('^', include('django.contrib.auth.urls')),
 ]
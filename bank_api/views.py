@@ -0,0 +1,19 @@
+from rest_framework import status, views
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from .instrumentation import request_metrics
+
+
+class PerformanceMetricsView(views.APIView):
+    """
+    Request metrics of this worker process per URL name, DELETE resets them
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(request_metrics.snapshot())
+
+    def delete(self, request):
+        request_metrics.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,94 @@
+"""
+Benchmarks for Django Bank API.
+Every benchmark runs on a throwaway test database and prints machine-readable JSON.
+"""
+import json
+import math
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bank_api.settings')
+    import django
+    django.setup()
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    """
+    Creates test database for the default connection and destroys it on exit
+    """
+    from django.db import connection
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+def spread_dates(now, days=365, step=10000):
+    """
+    Spreads fund transfers evenly over the days before now in order of their ids.
+    auto_now fields can not be set through bulk_create, so dates are updated afterwards.
+    """
+    from datetime import timedelta
+    from django.db import connection
+    from fund_transfers.models import FundTransfer
+
+    table = FundTransfer._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT MIN(id), MAX(id) FROM {table}')
+        first, last = cursor.fetchone()
+    if first is None:
+        return
+    span = max(last - first, 1)
+    period = timedelta(days=days)
+    for start in range(first, last + 1, step):
+        moment = now - period + period * (start - first) / span
+        FundTransfer.objects.filter(id__gte=start, id__lt=start + step).update(created=moment, last_updated=moment)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    # Nearest-rank percentile
+    index = min(len(values) - 1, max(0, math.ceil(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(durations, elapsed=None):
+    """
+    :param durations: list of operation durations in seconds
+    :param elapsed: wall time of all operations, defaults to their sum
+    :return: dict with throughput and latencies in milliseconds
+    """
+    elapsed = elapsed if elapsed is not None else sum(durations)
+    return {
+        'operations': len(durations),
+        'elapsed_s': round(elapsed, 4),
+        'throughput_per_s': round(len(durations) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(durations, 50) * 1000, 3) if durations else None,
+        'p95_ms': round(percentile(durations, 95) * 1000, 3) if durations else None,
+        'p99_ms': round(percentile(durations, 99) * 1000, 3) if durations else None,
+    }
+
+
+def timed(operation, *args, **kwargs):
+    start = time.perf_counter()
+    operation(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def write_report(report, output=None):
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
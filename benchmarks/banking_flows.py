@@ -0,0 +1,244 @@
+"""
+Scripted scenarios of the core banking flows run through the API on a generated dataset
+(benchmarks.factories): fund transfer creation, OTP issuance with delivery by a fake SMS provider,
+approval with settlement, statements and filtered transfer lists.
+Requests are sent one after another by the Django test client, so throughput is of one worker
+without network and web server overhead.
+
+    python -m benchmarks.banking_flows --customers 1000 --transfers 1000000 --operations 500 --output flows.json
+"""
+import argparse
+import random
+import time
+from datetime import timedelta
+
+from . import setup_django, benchmark_database, spread_dates, summarize, write_report
+
+SCENARIOS = ('create', 'otp', 'approve', 'statement', 'list')
+
+
+def run_scenario(operation, payloads):
+    """
+    Calls operation once per payload
+    :param operation: callable returning True on success
+    :param payloads: prepared arguments of the calls, their preparation is not measured
+    :return: summary with number of failed operations
+    """
+    durations = []
+    errors = 0
+    start = time.perf_counter()
+    for payload in payloads:
+        operation_start = time.perf_counter()
+        if not operation(*payload):
+            errors += 1
+        durations.append(time.perf_counter() - operation_start)
+    report = summarize(durations, time.perf_counter() - start)
+    report['errors'] = errors
+    return report
+
+
+class BankingFlows:
+    """
+    API calls of the scenarios. Every call is made by a user of the dataset on own accounts,
+    transfers created by the create scenario are used by otp and approve.
+    """
+    def __init__(self, dataset, days):
+        from rest_framework.test import APIClient
+
+        self.dataset = dataset
+        self.days = days
+        self.client = APIClient()
+        self.user = None
+        self.created = []
+
+    def login(self, user):
+        if user != self.user:
+            self.client.force_login(user)
+            self.user = user
+
+    def random_account(self):
+        user = random.choice(self.dataset.users)
+        return user, random.choice(self.dataset.accounts_by_user[user.pk])
+
+    def random_period(self):
+        from django.utils import timezone
+
+        to_date = timezone.now().date() - timedelta(days=random.randint(0, self.days))
+        from_date = to_date - timedelta(days=random.randint(1, 30))
+        return from_date.isoformat(), to_date.isoformat()
+
+    def create_payloads(self, operations):
+        from registrations.money import to_major
+
+        payloads = []
+        for i in range(operations):
+            user, account = self.random_account()
+            payloads.append((user, {
+                'iban_beneficiary': random.choice(self.dataset.accounts).iban,
+                'bic_beneficiary': '',
+                'bank_beneficiary': '',
+                'name_beneficiary': 'Benchmark beneficiary',
+                'details': f'Benchmark transfer {i}',
+                'amount': to_major(random.randint(1, 100) * 100, account.currency),
+                'currency': {'code': account.currency.code},
+                'account': {'iban': account.iban},
+                'payment_system': 'I',
+            }))
+        return payloads
+
+    def create(self, user, data):
+        self.login(user)
+        response = self.client.post('/api/v1/fund_transfers/', data=data, format='json')
+        if response.status_code == 201:
+            self.created.append((user, response.data['id']))
+            return True
+        return False
+
+    def otp(self, user, fund_transfer_id):
+        self.login(user)
+        response = self.client.get(f'/api/v1/notifications/send_otp/{fund_transfer_id}/')
+        return response.status_code == 200
+
+    def approve_payloads(self):
+        from fund_transfers.models import FundTransfer
+        from registrations.money import to_major
+        from .factories import BENCHMARK_PIN
+
+        # OTP lookup stands for the user reading the SMS
+        users = dict((fund_transfer_id, user) for user, fund_transfer_id in self.created)
+        fund_transfers = FundTransfer.objects.filter(pk__in=users, status='I')\
+            .select_related('account', 'currency').order_by('pk')
+        return [(users[fund_transfer.pk], fund_transfer.pk, {
+            'iban_beneficiary': fund_transfer.iban_beneficiary,
+            'name_beneficiary': fund_transfer.name_beneficiary,
+            'details': fund_transfer.details,
+            'amount': to_major(fund_transfer.amount, fund_transfer.currency),
+            'currency': {'code': fund_transfer.currency.code},
+            'account': {'iban': fund_transfer.account.iban},
+            'payment_system': fund_transfer.payment_system,
+            'status': 'A',
+            'pin_otp': BENCHMARK_PIN + fund_transfer.otp_generated,
+        }) for fund_transfer in fund_transfers]
+
+    def approve(self, user, fund_transfer_id, data):
+        self.login(user)
+        response = self.client.put(f'/api/v1/fund_transfers/{fund_transfer_id}/', data=data, format='json')
+        return response.status_code == 200
+
+    def period_payloads(self, operations):
+        return [(user, account, self.random_period())
+                for user, account in (self.random_account() for _ in range(operations))]
+
+    def statement(self, user, account, period):
+        self.login(user)
+        response = self.client.get('/api/v1/fund_transfers/statement/', {
+            'account_id': account.pk, 'from_date': period[0], 'to_date': period[1]})
+        return response.status_code == 200
+
+    def list(self, user, account, period):
+        self.login(user)
+        response = self.client.get('/api/v1/fund_transfers/', {
+            'account_id': account.pk, 'from_date': period[0], 'to_date': period[1]})
+        return response.status_code == 200
+
+
+def deliver_notifications(provider):
+    """
+    Drains the notifications outbox with the notifications worker
+    :return: delivery throughput
+    """
+    from notifications.worker import NotificationWorker
+
+    worker = NotificationWorker(provider=provider)
+    delivered = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            processed = worker.run_once()
+            if not processed:
+                break
+            delivered += processed
+    finally:
+        worker.shutdown()
+    elapsed = time.perf_counter() - start
+    return {
+        'delivered': len(provider.sent),
+        'elapsed_s': round(elapsed, 4),
+        'throughput_per_s': round(delivered / elapsed, 2) if elapsed else None,
+    }
+
+
+def prepare_ledger(dataset, now, days):
+    """
+    Spreads generated transfers over the period and posts processed ones to the ledger
+    """
+    from fund_transfers.ledger import backfill_ledger
+
+    spread_dates(now, days=days)
+    for account in dataset.accounts:
+        backfill_ledger(account)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--accounts-per-customer', type=int, default=2)
+    parser.add_argument('--transfers', type=int, default=100000, help='Generated fund transfers')
+    parser.add_argument('--days', type=int, default=365, help='Period of generated fund transfers')
+    parser.add_argument('--operations', type=int, default=200, help='Operations per scenario')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--sms-latency', type=float, default=0.0, help='Seconds per SMS of the fake provider')
+    parser.add_argument('--seed', type=int, help='Random seed of the generated dataset and operations')
+    parser.add_argument('--output', help='JSON report file, stdout by default')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.test.utils import setup_test_environment
+    from django.utils import timezone
+    from notifications.providers import FakeSMSProvider
+    from .factories import generate_dataset
+
+    # Test client host and production DEBUG value, which does not keep executed queries
+    setup_test_environment(debug=False)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    with benchmark_database() as connection:
+        start = time.perf_counter()
+        dataset = generate_dataset(args.customers, args.accounts_per_customer, args.transfers)
+        prepare_ledger(dataset, timezone.now(), args.days)
+        generation_s = time.perf_counter() - start
+
+        flows = BankingFlows(dataset, args.days)
+        scenarios = {}
+        # otp and approve work on transfers created by the create scenario
+        if {'create', 'otp', 'approve'} & set(args.scenarios):
+            report = run_scenario(flows.create, flows.create_payloads(args.operations))
+            if 'create' in args.scenarios:
+                scenarios['create'] = report
+        if {'otp', 'approve'} & set(args.scenarios):
+            report = run_scenario(flows.otp, flows.created)
+            report['delivery'] = deliver_notifications(FakeSMSProvider(latency=args.sms_latency))
+            if 'otp' in args.scenarios:
+                scenarios['otp'] = report
+        if 'approve' in args.scenarios:
+            scenarios['approve'] = run_scenario(flows.approve, flows.approve_payloads())
+        if 'statement' in args.scenarios:
+            scenarios['statement'] = run_scenario(flows.statement, flows.period_payloads(args.operations))
+        if 'list' in args.scenarios:
+            scenarios['list'] = run_scenario(flows.list, flows.period_payloads(args.operations))
+
+    write_report({
+        'benchmark': 'banking_flows',
+        'vendor': connection.vendor,
+        'customers': args.customers,
+        'accounts': len(dataset.accounts),
+        'transfers': args.transfers,
+        'period_days': args.days,
+        'generation_s': round(generation_s, 2),
+        'scenarios': scenarios,
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
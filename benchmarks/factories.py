@@ -0,0 +1,183 @@
+"""
+factory_boy factories of Django Bank API models and a generator of synthetic datasets for benchmarks.
+Import after setup_django().
+"""
+import random
+from functools import lru_cache
+
+import factory
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from factory.django import DjangoModelFactory
+
+from fund_transfers.models import FundTransfer
+from registrations.iban import iban_allocator
+from registrations.models import Account, AccountProduct, Currency, Customer, Manager, Person
+from registrations.money import to_bgn, to_money
+
+BENCHMARK_PASSWORD = '123'
+BENCHMARK_PIN = '0000'
+
+
+@lru_cache()
+def password_hash():
+    # Password hashing is slow on purpose, all generated users share one hash
+    return make_password(BENCHMARK_PASSWORD)
+
+
+class UserFactory(DjangoModelFactory):
+    class Meta:
+        model = User
+
+    username = factory.Sequence(lambda n: f'user{n:07d}')
+    email = factory.LazyAttribute(lambda user: f'{user.username}@mail.bg')
+    first_name = factory.Faker('first_name')
+    last_name = factory.Faker('last_name')
+    password = factory.LazyFunction(password_hash)
+
+
+class CurrencyFactory(DjangoModelFactory):
+    class Meta:
+        model = Currency
+        django_get_or_create = ('code',)
+
+    code = 'BGN'
+    name = 'Bulgarian lev'
+    rate_to_bgn = 1
+
+
+class AccountProductFactory(DjangoModelFactory):
+    class Meta:
+        model = AccountProduct
+        django_get_or_create = ('code',)
+
+    code = '10CA'
+    name = 'Current account'
+    type = 'C'
+    description = 'Current account'
+    interest_rate = 0.1
+
+
+class CustomerFactory(DjangoModelFactory):
+    class Meta:
+        model = Customer
+
+    cbs_customer_number = factory.Sequence(lambda n: f'{n:09d}')
+    name = factory.Faker('company')
+    type = 'C'
+
+
+class PersonFactory(DjangoModelFactory):
+    class Meta:
+        model = Person
+
+    user = factory.SubFactory(UserFactory)
+    customer = factory.SubFactory(CustomerFactory, type='P', name=factory.Faker('name'))
+    personal_identity_number = factory.Faker('numerify', text='##########')
+    date_of_birth = factory.Faker('date_of_birth', minimum_age=18)
+    address = factory.Faker('address')
+    mobile_phone = factory.Faker('numerify', text='+35988#######')
+    pin = BENCHMARK_PIN
+
+
+class ManagerFactory(DjangoModelFactory):
+    class Meta:
+        model = Manager
+
+    user = factory.SubFactory(UserFactory)
+    customer = factory.SubFactory(CustomerFactory)
+    personal_identity_number = factory.Faker('numerify', text='##########')
+    mobile_phone = factory.Faker('numerify', text='+35988#######')
+    pin = BENCHMARK_PIN
+
+
+class AccountFactory(DjangoModelFactory):
+    class Meta:
+        model = Account
+
+    product = factory.SubFactory(AccountProductFactory)
+    customer = factory.SubFactory(CustomerFactory)
+    currency = factory.SubFactory(CurrencyFactory)
+    iban = factory.LazyAttribute(lambda account: iban_allocator.next(account.product, account.currency))
+    balance = factory.LazyAttribute(lambda account: to_money(random.randint(1000, 1000000), account.currency))
+
+    @factory.post_generation
+    def users(self, create, extracted, **kwargs):
+        if create and extracted:
+            self.users.add(*extracted)
+
+
+class FundTransferFactory(DjangoModelFactory):
+    class Meta:
+        model = FundTransfer
+
+    account = factory.SubFactory(AccountFactory)
+    user = factory.SubFactory(UserFactory)
+    currency = factory.SelfAttribute('account.currency')
+    iban_beneficiary = factory.Faker('iban')
+    bic_beneficiary = factory.Faker('lexify', text='????BGSF', letters='ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+    bank_beneficiary = factory.Faker('company')
+    name_beneficiary = factory.Faker('name')
+    details = factory.Faker('sentence', nb_words=4)
+    amount = factory.LazyAttribute(lambda transfer: to_money(random.randint(1, 500), transfer.currency))
+    amount_bgn = factory.LazyAttribute(lambda transfer: to_bgn(transfer.amount, transfer.currency))
+    status = 'I'
+    payment_system = 'I'
+
+
+class Dataset:
+    """
+    Generated customers with their users and accounts
+    """
+    def __init__(self):
+        self.users = []
+        self.accounts = []
+        self.accounts_by_user = {}
+
+    def add(self, user, accounts):
+        self.users.append(user)
+        self.accounts.extend(accounts)
+        self.accounts_by_user[user.pk] = accounts
+
+
+def generate_dataset(customers, accounts_per_customer=2, transfers=0, processed=0.9, internal=0.5, batch_size=10000):
+    """
+    Creates customers (companies with a manager, persons) with accounts and fund transfers between them.
+    Transfers are built by FundTransferFactory and inserted with bulk_create.
+    :param customers: number of customers, every third one is a person
+    :param accounts_per_customer:
+    :param transfers: number of fund transfers
+    :param processed: share of processed transfers, the rest are initiated
+    :param internal: share of transfers to accounts of the bank
+    :param batch_size: rows per insert
+    :return: Dataset
+    """
+    currency = CurrencyFactory()
+    product = AccountProductFactory()
+
+    dataset = Dataset()
+    for i in range(customers):
+        if i % 3 == 2:
+            holder = PersonFactory()
+        else:
+            holder = ManagerFactory()
+        accounts = [AccountFactory(customer=holder.customer, product=product, currency=currency, users=[holder.user])
+                    for _ in range(accounts_per_customer)]
+        dataset.add(holder.user, accounts)
+
+    ibans = [account.iban for account in dataset.accounts]
+    created = 0
+    while created < transfers:
+        batch = []
+        for _ in range(min(batch_size, transfers - created)):
+            user = random.choice(dataset.users)
+            account = random.choice(dataset.accounts_by_user[user.pk])
+            fields = {'account': account, 'user': user,
+                      'status': 'P' if random.random() < processed else 'I'}
+            if random.random() < internal:
+                fields.update(iban_beneficiary=random.choice(ibans), bic_beneficiary=Account.DJANGO_BANK_BIC,
+                              bank_beneficiary='Django Bank')
+            batch.append(FundTransferFactory.build(**fields))
+        FundTransfer.objects.bulk_create(batch)
+        created += len(batch)
+    return dataset
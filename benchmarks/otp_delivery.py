@@ -0,0 +1,174 @@
+"""
+OTP requests and SMS delivery against a local fake SMS gateway which adds latency to every message.
+Compares a sync worker sending the SMS inside the OTP request with the outbox, where the request only
+stores the notification and the notifications worker delivers it by batches (run_once) or
+with sends kept in flight (run_forever).
+Requests are sent one after another by the Django test client, as a sync worker serves them, so
+requests per second are of one worker; concurrent clients would only queue for it.
+
+    python -m benchmarks.otp_delivery --requests 200 --sms-latency 0.2 --sms-jitter 0.3 --workers 8 --output otp.json
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import setup_django, benchmark_database, summarize, write_report
+
+
+class FakeSMSGateway:
+    """
+    Local HTTP server with the API of notifications.providers.HTTPSMSProvider.
+    Every message waits latency and up to jitter more seconds before it is answered,
+    messages are answered concurrently.
+    """
+    def __init__(self, latency, jitter=0):
+        gateway = self
+        self.latency = latency
+        self.jitter = jitter
+        self.received = 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                time.sleep(gateway.latency + random.uniform(0, gateway.jitter))
+                with gateway._lock:
+                    gateway.received += 1
+                    body = json.dumps({'id': f'SM{gateway.received:08d}'}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}/messages'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def create_transfers(count):
+    """
+    Initiated fund transfers of one generated manager
+    :return: user and list of fund transfer ids
+    """
+    from fund_transfers.models import FundTransfer
+    from .factories import generate_dataset
+
+    dataset = generate_dataset(customers=1, accounts_per_customer=1, transfers=count, processed=0)
+    return dataset.users[0], list(FundTransfer.objects.order_by('pk').values_list('pk', flat=True))
+
+
+def request_otps(client, transfer_ids, send=None):
+    """
+    Requests OTP of every transfer
+    :param send: called after every request with the SMS of the request, when it is sent by the request
+    """
+    from notifications.models import Notification
+
+    durations = []
+    start = time.perf_counter()
+    for transfer_id in transfer_ids:
+        request_start = time.perf_counter()
+        response = client.get(f'/api/v1/notifications/send_otp/{transfer_id}/')
+        assert response.status_code == 200, response.status_code
+        if send is not None:
+            notification = Notification.objects.filter(status='P').latest('pk')
+            send(notification.to, notification.contents)
+            Notification.objects.filter(pk=notification.pk).update(status='S')
+        durations.append(time.perf_counter() - request_start)
+    return summarize(durations, time.perf_counter() - start)
+
+
+def deliver(worker, pipelined):
+    start = time.perf_counter()
+    if pipelined:
+        delivered = worker.run_forever(poll_interval=0.01, until_empty=True)
+    else:
+        delivered = 0
+        while True:
+            processed = worker.run_once()
+            if not processed:
+                break
+            delivered += processed
+    elapsed = time.perf_counter() - start
+    return {
+        'delivered': delivered,
+        'elapsed_s': round(elapsed, 4),
+        'throughput_per_s': round(delivered / elapsed, 2) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='OTP requests per mode')
+    parser.add_argument('--sms-latency', type=float, default=0.2, help='Seconds the gateway takes per SMS')
+    parser.add_argument('--sms-jitter', type=float, default=0.3, help='Up to this many more seconds per SMS')
+    parser.add_argument('--workers', type=int, default=8, help='Sending threads of the notifications worker')
+    parser.add_argument('--batch-size', type=int, default=20, help='Notifications claimed per batch')
+    parser.add_argument('--output', help='JSON report file, stdout by default')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.test.utils import override_settings, setup_test_environment
+    from django.utils import timezone
+    from rest_framework.test import APIClient
+    from notifications.models import Notification
+    from notifications.providers import HTTPSMSProvider
+    from notifications.worker import NotificationWorker
+
+    setup_test_environment(debug=False)
+    modes = {}
+    # OTP throttles would reject most of the requests of one user
+    throttle_rates = {'otp_user': f'{args.requests * 10}/s', 'otp_target': f'{args.requests * 10}/s'}
+    with benchmark_database() as connection, FakeSMSGateway(args.sms_latency, args.sms_jitter) as gateway, \
+            override_settings(THROTTLE_RATES=throttle_rates):
+        provider = HTTPSMSProvider(pool_size=args.workers, url=gateway.url)
+        user, transfer_ids = create_transfers(args.requests * 2)
+        client = APIClient()
+        client.force_login(user)
+
+        modes['inline'] = request_otps(client, transfer_ids[:args.requests], send=provider.send)
+        modes['outbox'] = request_otps(client, transfer_ids[args.requests:])
+
+        delivery = {}
+        pending = list(Notification.objects.filter(status='P').values_list('pk', flat=True))
+        for pipelined in (False, True):
+            Notification.objects.filter(pk__in=pending).update(status='P', attempts=0, next_attempt=timezone.now())
+            worker = NotificationWorker(provider=provider, workers=args.workers, batch_size=args.batch_size)
+            try:
+                delivery['run_forever' if pipelined else 'run_once'] = deliver(worker, pipelined)
+            finally:
+                worker.shutdown()
+        modes['outbox']['delivery'] = delivery
+
+    write_report({
+        'benchmark': 'otp_delivery',
+        'vendor': connection.vendor,
+        'requests': args.requests,
+        'sms_latency_s': args.sms_latency,
+        'sms_jitter_s': args.sms_jitter,
+        'workers': args.workers,
+        'batch_size': args.batch_size,
+        'gateway_messages': gateway.received,
+        'modes': modes,
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Latency of the statement query over fund transfers (fund_transfers.ledger.transfer_postings,
+used for ledger backfill) on a generated table, with the single column foreign key
+indexes only (before) and with the composite access path indexes (after).
+
+    python -m benchmarks.statement_indexes --transfers 1000000 --output statement_indexes.json
+"""
+import argparse
+import random
+from datetime import timedelta
+
+from . import setup_django, benchmark_database, spread_dates, summarize, timed, write_report
+
+
+def generate(transfers, accounts, batch_size=10000):
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+    from fund_transfers.models import FundTransfer
+    from registrations.models import Account, AccountProduct, Currency, Customer
+
+    currency = Currency.objects.create(code='BGN', name='Bulgarian lev', rate_to_bgn=1)
+    product = AccountProduct.objects.create(code='10CA', name='Current account', type='C',
+                                            description='Current account', interest_rate=0.1)
+    customer = Customer.objects.create(cbs_customer_number='000000001', name='Benchmark Ltd.', type='C')
+    user = User.objects.create_user('benchmark', 'benchmark@mail.bg', '123')
+
+    Account.objects.bulk_create([
+        Account(product=product, customer=customer, iban=f'BG00DJNG828010BGN{i:05d}', currency=currency)
+        for i in range(accounts)
+    ])
+    account_ids = list(Account.objects.values_list('id', 'iban'))
+
+    now = timezone.now()
+    created = 0
+    while created < transfers:
+        batch = []
+        for _ in range(min(batch_size, transfers - created)):
+            account_id, _iban = random.choice(account_ids)
+            _id, iban_beneficiary = random.choice(account_ids)
+            batch.append(FundTransfer(user=user, account_id=account_id, iban_beneficiary=iban_beneficiary,
+                                      amount=10, amount_bgn=10, currency=currency, details='Benchmark',
+                                      status='P' if random.random() < 0.9 else 'I'))
+        FundTransfer.objects.bulk_create(batch)
+        created += len(batch)
+
+    spread_dates(now)
+    return [account for account, _iban in account_ids]
+
+
+def measure(accounts, repeats, days):
+    from django.utils import timezone
+    from fund_transfers.ledger import transfer_postings
+    from registrations.models import Account
+
+    durations = []
+    for _ in range(repeats):
+        account = Account.objects.select_related('currency').get(pk=random.choice(accounts))
+        to_date = timezone.now() - timedelta(days=random.randint(0, 365 - days))
+        from_date = to_date - timedelta(days=days)
+        durations.append(timed(lambda: list(transfer_postings(account, from_date, to_date))))
+    return summarize(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transfers', type=int, default=1000000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--days', type=int, default=30, help='Statement period length')
+    parser.add_argument('--output', help='JSON report file, stdout by default')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db import models
+    from fund_transfers.models import FundTransfer
+
+    composite_indexes = list(FundTransfer._meta.indexes)
+    foreign_key_indexes = [models.Index(fields=['account'], name='ft_account_fk_idx'),
+                           models.Index(fields=['user'], name='ft_user_fk_idx')]
+
+    with benchmark_database() as connection:
+        accounts = generate(args.transfers, args.accounts)
+
+        with connection.schema_editor() as editor:
+            for index in composite_indexes:
+                editor.remove_index(FundTransfer, index)
+            for index in foreign_key_indexes:
+                editor.add_index(FundTransfer, index)
+        before = measure(accounts, args.repeats, args.days)
+
+        with connection.schema_editor() as editor:
+            for index in foreign_key_indexes:
+                editor.remove_index(FundTransfer, index)
+            for index in composite_indexes:
+                editor.add_index(FundTransfer, index)
+        after = measure(accounts, args.repeats, args.days)
+
+    write_report({
+        'benchmark': 'statement_indexes',
+        'vendor': connection.vendor,
+        'transfers': args.transfers,
+        'accounts': args.accounts,
+        'period_days': args.days,
+        'before': before,
+        'after': after,
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
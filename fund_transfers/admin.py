@@ -1,5 +1,12 @@
 from django.contrib import admin
 
-from .models import FundTransfer
+from .models import FundTransfer, LedgerEntry, ApprovalBatch, DailyTurnover, TransferEvent, TransferEventConsumer, \
+    ClearingBatch
 
 admin.site.register(FundTransfer)
+admin.site.register(LedgerEntry)
+admin.site.register(ApprovalBatch)
+admin.site.register(DailyTurnover)
+admin.site.register(TransferEvent)
+admin.site.register(TransferEventConsumer)
+admin.site.register(ClearingBatch)
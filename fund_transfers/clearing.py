@@ -0,0 +1,255 @@
+import os
+import time
+import uuid
+import xml.etree.ElementTree as ElementTree
+from itertools import groupby
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from registrations.money import to_major
+from .enums import PaymentSystemEnum
+from .events import record_events
+from .models import ClearingBatch, FundTransfer
+from .settlement import settlement_engine
+
+CLEARING_PAYMENT_SYSTEMS = [payment_system.name for payment_system in PaymentSystemEnum
+                            if payment_system != PaymentSystemEnum.I]
+
+PAIN_001_NAMESPACE = 'urn:iso:std:iso:20022:tech:xsd:pain.001.001.03'
+
+# pain.002 transaction and group statuses
+ACCEPTED_STATUSES = {'ACCP', 'ACSC', 'ACSP', 'ACTC', 'ACWC'}
+REJECTED_STATUSES = {'RJCT'}
+
+
+def queue_settings(payment_system):
+    """
+    :param payment_system: PaymentSystemEnum name
+    :return: dict with batch_size, max_wait (seconds) and service_level of the clearing queue
+    """
+    queue = {'batch_size': 1000, 'max_wait': 15 * 60, 'service_level': 'NURG'}
+    queue.update(getattr(settings, 'CLEARING_QUEUES', {}).get(payment_system, {}))
+    return queue
+
+
+def clearing_queue(payment_system):
+    """
+    Approved fund transfers of payment system waiting for a clearing batch, oldest first
+    """
+    return FundTransfer.objects.filter(status='A', payment_system=payment_system, clearing_batch__isnull=True)\
+        .order_by('pk')
+
+
+def _element(parent, tag, text=None, **attributes):
+    element = ElementTree.SubElement(parent, tag, **attributes)
+    if text is not None:
+        element.text = str(text)
+    return element
+
+
+def pain_001(batch, fund_transfers, now):
+    """
+    Customer credit transfer initiation (ISO 20022 pain.001.001.03) with one payment information block
+    per debtor account. End to end id of a transfer is its reference_cbs.
+    :param batch: ClearingBatch
+    :param fund_transfers: transfers of the batch ordered by account, with account, customer and currency
+    :param now: creation time
+    :return: Element
+    """
+    amounts = [(fund_transfer, to_major(fund_transfer.amount, fund_transfer.currency))
+               for fund_transfer in fund_transfers]
+    service_level = queue_settings(batch.payment_system)['service_level']
+    bank_bic = getattr(settings, 'CLEARING_BANK_BIC', 'DJNGBGSF')
+
+    document = ElementTree.Element('Document', xmlns=PAIN_001_NAMESPACE)
+    initiation = _element(document, 'CstmrCdtTrfInitn')
+    header = _element(initiation, 'GrpHdr')
+    _element(header, 'MsgId', batch.message_id)
+    _element(header, 'CreDtTm', now.replace(microsecond=0).isoformat())
+    _element(header, 'NbOfTxs', len(amounts))
+    _element(header, 'CtrlSum', sum(amount for fund_transfer, amount in amounts))
+    _element(_element(header, 'InitgPty'), 'Nm', 'Django Bank')
+
+    for account, account_amounts in groupby(amounts, key=lambda item: item[0].account):
+        account_amounts = list(account_amounts)
+        payment = _element(initiation, 'PmtInf')
+        _element(payment, 'PmtInfId', f'{batch.message_id}-{account.pk}')
+        _element(payment, 'PmtMtd', 'TRF')
+        _element(payment, 'NbOfTxs', len(account_amounts))
+        _element(payment, 'CtrlSum', sum(amount for fund_transfer, amount in account_amounts))
+        _element(_element(_element(payment, 'PmtTpInf'), 'SvcLvl'), 'Cd', service_level)
+        _element(payment, 'ReqdExctnDt', now.date().isoformat())
+        _element(_element(payment, 'Dbtr'), 'Nm', account.customer.name if account.customer else '')
+        _element(_element(_element(payment, 'DbtrAcct'), 'Id'), 'IBAN', account.iban)
+        _element(_element(_element(payment, 'DbtrAgt'), 'FinInstnId'), 'BIC', bank_bic)
+        _element(payment, 'ChrgBr', 'SLEV')
+
+        for fund_transfer, amount in account_amounts:
+            transaction_info = _element(payment, 'CdtTrfTxInf')
+            _element(_element(transaction_info, 'PmtId'), 'EndToEndId', fund_transfer.reference_cbs)
+            _element(_element(transaction_info, 'Amt'), 'InstdAmt', amount, Ccy=fund_transfer.currency.code)
+            if fund_transfer.bic_beneficiary:
+                _element(_element(_element(transaction_info, 'CdtrAgt'), 'FinInstnId'), 'BIC',
+                         fund_transfer.bic_beneficiary)
+            _element(_element(transaction_info, 'Cdtr'), 'Nm', fund_transfer.name_beneficiary)
+            _element(_element(_element(transaction_info, 'CdtrAcct'), 'Id'), 'IBAN', fund_transfer.iban_beneficiary)
+            _element(_element(transaction_info, 'RmtInf'), 'Ustrd', fund_transfer.details)
+
+    return document
+
+
+def parse_pain_002(source):
+    """
+    Reads payment status report (ISO 20022 pain.002) of a clearing batch
+    :param source: file name or file object
+    :return: tuple of original message id, group status and dict of transaction status by end to end id
+    """
+    root = ElementTree.parse(source).getroot()
+    namespace = root.tag[1:].split('}')[0] if root.tag.startswith('{') else ''
+
+    def path(*tags):
+        return '/'.join(f'{{{namespace}}}{tag}' if namespace else tag for tag in tags)
+
+    report = root.find(path('CstmrPmtStsRpt'))
+    if report is None:
+        raise ValueError('pain.002 payment status report expected!')
+    group = report.find(path('OrgnlGrpInfAndSts'))
+    if group is None:
+        raise ValueError('Original message id not found!')
+
+    statuses = {}
+    for transaction_info in report.iter(path('TxInfAndSts')):
+        statuses[transaction_info.findtext(path('OrgnlEndToEndId'))] = transaction_info.findtext(path('TxSts'))
+    return group.findtext(path('OrgnlMsgId')), group.findtext(path('GrpSts')), statuses
+
+
+class ClearingWorker:
+    """
+    Flushes clearing queues of external payment systems into outbound pain.001 files.
+    A queue is flushed when it has batch_size transfers or its oldest transfer has waited max_wait seconds
+    (settings.CLEARING_QUEUES), so the per file overhead of the payment system is shared by many transfers.
+    """
+    def __init__(self, outbox_dir=None):
+        self.outbox_dir = outbox_dir or settings.CLEARING_OUTBOX_DIR
+
+    @staticmethod
+    def due_payment_systems(now, force=False):
+        """
+        :param now:
+        :param force: all non-empty queues are due
+        :return: list of payment systems to flush
+        """
+        queues = FundTransfer.objects.filter(status='A', payment_system__in=CLEARING_PAYMENT_SYSTEMS,
+                                             clearing_batch__isnull=True)\
+            .values('payment_system').annotate(count=Count('id'), oldest=Min('last_updated')).order_by()
+        due = []
+        for queue in queues:
+            queue_setting = queue_settings(queue['payment_system'])
+            if force or queue['count'] >= queue_setting['batch_size'] or \
+                    (now - queue['oldest']).total_seconds() >= queue_setting['max_wait']:
+                due.append(queue['payment_system'])
+        return sorted(due)
+
+    @staticmethod
+    def create_batch(payment_system):
+        """
+        Takes up to batch_size queued transfers into a new clearing batch.
+        Transfers taken by a concurrent worker are skipped.
+        :return: ClearingBatch or None if the queue is empty
+        """
+        with transaction.atomic():
+            fund_transfer_ids = list(clearing_queue(payment_system).select_for_update(skip_locked=True)
+                                     .values_list('pk', flat=True)[:queue_settings(payment_system)['batch_size']])
+            if not fund_transfer_ids:
+                return None
+            batch = ClearingBatch.objects.create(payment_system=payment_system,
+                                                 message_id=f'DJNG{uuid.uuid4().hex[:24].upper()}')
+            FundTransfer.objects.filter(pk__in=fund_transfer_ids).update(clearing_batch=batch)
+        return batch
+
+    def write_file(self, batch):
+        """
+        Writes outbound file of a Created batch and marks it Sent.
+        The file is renamed into the outbox when complete, so it is never picked up half written.
+        """
+        now = timezone.now()
+        fund_transfers = batch.fund_transfers.select_related('account__customer', 'currency')\
+            .order_by('account_id', 'pk')
+        document = pain_001(batch, fund_transfers, now)
+
+        os.makedirs(self.outbox_dir, exist_ok=True)
+        file_name = f'{PaymentSystemEnum[batch.payment_system].value}-{batch.message_id}.xml'
+        path = os.path.join(self.outbox_dir, file_name)
+        ElementTree.ElementTree(document).write(path + '.tmp', encoding='utf-8', xml_declaration=True)
+        os.replace(path + '.tmp', path)
+
+        ClearingBatch.objects.filter(pk=batch.pk, status='C').update(status='S', sent=now, file_name=file_name)
+        batch.status, batch.sent, batch.file_name = 'S', now, file_name
+        return path
+
+    def run_once(self, force=False):
+        """
+        Writes files of batches left Created and flushes due queues
+        :param force: flush all non-empty queues
+        :return: list of sent batches
+        """
+        batches = list(ClearingBatch.objects.filter(status='C').order_by('pk'))
+        for payment_system in self.due_payment_systems(timezone.now(), force=force):
+            batch = self.create_batch(payment_system)
+            if batch is not None:
+                batches.append(batch)
+
+        for batch in batches:
+            self.write_file(batch)
+        return batches
+
+    def run_forever(self, poll_interval=10):
+        while True:
+            if not self.run_once():
+                time.sleep(poll_interval)
+
+
+def ingest_acknowledgement(source):
+    """
+    Applies payment status report of a clearing batch. Accepted transfers become Processed,
+    rejected ones Processed with error and their debit is credited back. Transfers which are
+    already acknowledged or pending are left unchanged, so a report can be ingested again.
+    :param source: pain.002 file name or file object
+    :return: dict with numbers of processed and rejected transfers
+    """
+    message_id, group_status, statuses = parse_pain_002(source)
+    batch = ClearingBatch.objects.filter(message_id=message_id).first()
+    if batch is None:
+        raise ValueError(f'Clearing batch {message_id} not found!')
+
+    with transaction.atomic():
+        fund_transfers = {fund_transfer.reference_cbs: fund_transfer
+                          for fund_transfer in batch.fund_transfers.select_for_update().filter(status='A')}
+        if not statuses and group_status:
+            # Group status applies to all transfers of the batch
+            statuses = {reference: group_status for reference in fund_transfers}
+
+        accepted = [fund_transfers[reference] for reference, status in statuses.items()
+                    if status in ACCEPTED_STATUSES and reference in fund_transfers]
+        rejected = [fund_transfers[reference] for reference, status in statuses.items()
+                    if status in REJECTED_STATUSES and reference in fund_transfers]
+        now = timezone.now()
+
+        if accepted:
+            FundTransfer.objects.filter(pk__in=[fund_transfer.pk for fund_transfer in accepted])\
+                .update(status='P', last_updated=now)
+            record_events(accepted, 'P')
+        if rejected:
+            FundTransfer.objects.filter(pk__in=[fund_transfer.pk for fund_transfer in rejected])\
+                .update(status='E', last_updated=now)
+            for fund_transfer in rejected:
+                settlement_engine.reverse(fund_transfer)
+            record_events(rejected, 'E')
+
+        if not batch.fund_transfers.filter(status='A').exists():
+            ClearingBatch.objects.filter(pk=batch.pk).update(status='A', acknowledged=now)
+
+    return {'processed': len(accepted), 'rejected': len(rejected)}
@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When
+from django.utils import timezone
+from sequences.models import Sequence
+
+from .models import TransferEvent, TransferEventConsumer
+
+TRANSFER_EVENT_SEQUENCE = 'transfer_events'
+
+# Events numbered by one update statement
+NUMBERING_CHUNK_SIZE = 500
+
+
+def record_events(fund_transfers, status, user=None):
+    """
+    Appends status change events of fund transfers to the log, inside the transaction of the change.
+    Events get their sequence numbers after commit (number_events), so writers take no shared lock.
+    :param fund_transfers: FundTransfer instances or tuples of (fund transfer id, account id)
+    :param status: new status of all fund transfers
+    :param user: User who made the change
+    :return: list of created TransferEvent
+    """
+    changes = [(fund_transfer.pk, fund_transfer.account_id) if hasattr(fund_transfer, 'pk') else fund_transfer
+               for fund_transfer in fund_transfers]
+    if not changes:
+        return []
+
+    now = timezone.now()
+    return TransferEvent.objects.bulk_create([
+        TransferEvent(fund_transfer_id=fund_transfer_id, account_id=account_id, user=user, status=status, created=now)
+        for fund_transfer_id, account_id in changes
+    ])
+
+
+def number_events(limit=None):
+    """
+    Gives sequence numbers to committed events without one, in the order they were written.
+    The sequence row is locked by the numbering transaction only, so one reader numbers at a time
+    and numbers given later are always higher. A consumer therefore never skips an event numbered
+    after it has read a higher sequence number.
+    :param limit: events to number at most, all by default
+    :return: number of numbered events
+    """
+    # Readers which find all events numbered do not wait for the sequence row
+    if not TransferEvent.objects.filter(sequence__isnull=True).exists():
+        return 0
+
+    with transaction.atomic():
+        sequence, created = Sequence.objects.select_for_update()\
+            .get_or_create(name=TRANSFER_EVENT_SEQUENCE, defaults={'last': 0})
+        pending = list(TransferEvent.objects.filter(sequence__isnull=True).order_by('pk')
+                       .values_list('pk', flat=True)[:limit])
+        if not pending:
+            return 0
+
+        for i in range(0, len(pending), NUMBERING_CHUNK_SIZE):
+            chunk = pending[i:i + NUMBERING_CHUNK_SIZE]
+            TransferEvent.objects.filter(pk__in=chunk)\
+                .update(sequence=Case(*[When(pk=pk, then=sequence.last + i + j + 1) for j, pk in enumerate(chunk)]))
+        sequence.last += len(pending)
+        sequence.save(update_fields=['last'])
+    return len(pending)
+
+
+def read_events(after=0, limit=None, account_id=None):
+    """
+    Numbers committed events first, so reads see every event committed before them
+    :param after: sequence number of the last processed event
+    :param limit: events to read, settings.TRANSFER_EVENTS_PAGE_SIZE by default
+    :param account_id: events of one account only
+    :return: list of events in sequence order
+    """
+    number_events()
+    events = TransferEvent.objects.filter(sequence__gt=after).order_by('sequence')
+    if account_id is not None:
+        events = events.filter(account_id=account_id)
+    return list(events[:limit or getattr(settings, 'TRANSFER_EVENTS_PAGE_SIZE', 500)])
+
+
+def commit_offset(name, offset):
+    """
+    Stores the last event processed by consumer. Offset only moves forward, a commit
+    of a lower offset by a late or repeated request is ignored.
+    :param name: consumer name
+    :param offset: sequence number
+    :return: TransferEventConsumer with the stored offset
+    """
+    with transaction.atomic():
+        consumer, created = TransferEventConsumer.objects.select_for_update()\
+            .get_or_create(name=name, defaults={'offset': offset})
+        if not created and offset > consumer.offset:
+            consumer.offset = offset
+            consumer.save(update_fields=['offset', 'updated'])
+    return consumer
@@ -0,0 +1,78 @@
+import csv
+
+from django.conf import settings
+from rest_framework.utils.encoders import JSONEncoder
+
+from registrations.money import Money
+from .models import LedgerEntry
+
+STATEMENT_EXPORT_COLUMNS = ('posted', 'fund_transfer', 'amount_debit', 'amount_credit', 'balance', 'reference_cbs',
+                            'name_beneficiary', 'details')
+
+
+class Echo:
+    """
+    File-like object returning written text, so csv.writer formats one row at a time
+    """
+    def write(self, value):
+        return value
+
+
+class StatementExport:
+    """
+    Statement entries streamed as CSV or JSON lines.
+    Rows are read as tuples by a chunked server-side iterator and formatted without serializers,
+    so memory does not grow with the period and the first rows are sent before the last are read.
+    """
+    formats = {
+        'csv': 'text/csv',
+        'ndjson': 'application/x-ndjson',
+    }
+
+    def __init__(self, account, from_date, to_date, opening_balance):
+        self.account = account
+        self.from_date = from_date
+        self.to_date = to_date
+        self.opening_balance = opening_balance
+        self.minor_unit = account.currency.minor_unit
+        self.chunk_size = getattr(settings, 'STATEMENT_EXPORT_CHUNK_SIZE', 2000)
+
+    def rows(self):
+        """
+        :return: iterator of tuples in STATEMENT_EXPORT_COLUMNS order, amounts in major units
+        """
+        entries = LedgerEntry.objects.filter(account=self.account, posted__gte=self.from_date,
+                                             posted__lte=self.to_date)\
+            .order_by('posted', 'id')\
+            .values_list('posted', 'fund_transfer_id', 'amount', 'balance', 'fund_transfer__reference_cbs',
+                         'fund_transfer__name_beneficiary', 'fund_transfer__details')
+        minor_unit = self.minor_unit
+        zero = Money(0).to_major(minor_unit)
+        for posted, fund_transfer_id, amount, balance, reference_cbs, name_beneficiary, details \
+                in entries.iterator(chunk_size=self.chunk_size):
+            amount = Money(amount).to_major(minor_unit)
+            yield (posted, fund_transfer_id, -amount if amount < 0 else zero, amount if amount > 0 else zero,
+                   None if balance is None else Money(balance).to_major(minor_unit), reference_cbs, name_beneficiary,
+                   details)
+
+    def csv(self):
+        writer = csv.writer(Echo())
+        yield writer.writerow(STATEMENT_EXPORT_COLUMNS)
+        for row in self.rows():
+            yield writer.writerow((row[0].isoformat(),) + row[1:])
+
+    def ndjson(self):
+        encoder = JSONEncoder()
+        # First line describes the statement, entries follow one per line
+        yield encoder.encode({
+            'account': self.account.iban,
+            'currency': self.account.currency.code,
+            'from_date': self.from_date,
+            'to_date': self.to_date,
+            'opening_balance': Money(self.opening_balance).to_major(self.minor_unit),
+        }) + '\n'
+        for row in self.rows():
+            yield encoder.encode(dict(zip(STATEMENT_EXPORT_COLUMNS, row))) + '\n'
+
+    def filename(self, export_format):
+        return f'statement-{self.account.iban}-{self.from_date.date()}-{self.to_date.date()}.{export_format}'
@@ -0,0 +1,138 @@
+from django.db import transaction
+from django.db.models import F, Sum, Value
+
+from registrations.models import Account
+from registrations.money import Money, MoneyField, from_bgn
+from .models import FundTransfer, LedgerEntry
+
+
+def get_statement(account, from_date, to_date):
+    """
+    Account statement from ledger. Every part is a range read on ledger_account_posted_idx.
+    :param account:
+    :param from_date:
+    :param to_date:
+    :return: opening balance, closing balance, entries queryset
+    """
+    entries = LedgerEntry.objects.filter(account=account, posted__gte=from_date, posted__lte=to_date)
+
+    opening_balance = get_opening_balance(account, from_date)
+    last_posting = entries.order_by('-posted', '-id').values_list('balance', flat=True)[:1]
+    if not last_posting:
+        closing_balance = opening_balance
+    elif last_posting[0] is None:
+        closing_balance = get_balance_from_later_postings(account, posted__gt=to_date)
+    else:
+        closing_balance = last_posting[0]
+
+    return opening_balance, closing_balance, entries.order_by('posted', 'id')
+
+
+def get_opening_balance(account, from_date):
+    """
+    Balance of account at from_date
+    :param account:
+    :param from_date:
+    :return: balance after the last posting before from_date
+    """
+    postings = LedgerEntry.objects.filter(account=account)
+
+    last_posting = postings.filter(posted__lt=from_date).order_by('-posted', '-id')\
+        .values_list('balance', flat=True)[:1]
+    if last_posting and last_posting[0] is not None:
+        return last_posting[0]
+
+    if not last_posting:
+        # No postings before period, balance before the first posting after it
+        first_posting = postings.filter(posted__gte=from_date).order_by('posted', 'id')\
+            .values_list('balance', 'amount').first()
+        if first_posting is None:
+            return Account.objects.get(pk=account.pk).aggregated_balance
+        if first_posting[0] is not None:
+            return first_posting[0] - first_posting[1]
+
+    return get_balance_from_later_postings(account, posted__gte=from_date)
+
+
+def get_balance_from_later_postings(account, **later):
+    """
+    Balance of sharded account, whose postings get running balance at compaction:
+    current balance with shards less the postings after the moment
+    :param account:
+    :param later: lookup of postings after the moment
+    :return: Money
+    """
+    account = Account.objects.get(pk=account.pk)
+    amount = LedgerEntry.objects.filter(account=account, **later).aggregate(total=Sum('amount'))['total'] or 0
+    return Money(account.aggregated_balance - amount)
+
+
+def transfer_postings(account, from_date=None, to_date=None):
+    """
+    Processed credit and debit transfers of account, calculated from fund transfers.
+    Amounts are in BGN, converted to account currency by the caller.
+    Served by ft_statement_credit_idx and ft_statement_debit_idx indexes
+    :param account:
+    :param from_date:
+    :param to_date:
+    :return: union queryset ordered by last_updated
+    """
+    period = {}
+    if from_date is not None:
+        period['last_updated__gte'] = from_date
+    if to_date is not None:
+        period['last_updated__lte'] = to_date
+
+    # Credit transfers query for account
+    query_credits = FundTransfer.objects.filter(iban_beneficiary=account.iban,
+                                                status='P',
+                                                **period
+                                                ).values(
+        'id', 'last_updated', 'reference_cbs', 'name_beneficiary', 'details',
+        amount_debit=Value(0, MoneyField()), amount_credit=F('amount_bgn')
+    )
+    # Debit transfers query for account
+    query_debits = FundTransfer.objects.filter(account__pk=account.id,
+                                               status='P',
+                                               **period
+                                               ).values(
+        'id', 'last_updated', 'reference_cbs', 'name_beneficiary', 'details',
+        amount_debit=F('amount_bgn'), amount_credit=Value(0, MoneyField())
+    )
+
+    return query_credits.union(query_debits).order_by('last_updated')
+
+
+def backfill_ledger(account, batch_size=1000):
+    """
+    Creates ledger entries for transfers processed before account's first ledger entry.
+    Running balances are calculated backwards from the balance before the first entry,
+    including balance shards of sharded accounts.
+    :param account:
+    :param batch_size:
+    :return: number of created entries
+    """
+    with transaction.atomic():
+        account = Account.objects.select_for_update().select_related('currency').get(pk=account.pk)
+
+        first_entry = LedgerEntry.objects.filter(account=account).order_by('posted', 'id').first()
+        if first_entry is None:
+            balance, to_date = account.aggregated_balance, None
+        else:
+            # Entries of sharded accounts may have no running balance yet
+            balance, to_date = get_opening_balance(account, first_entry.posted), first_entry.posted
+
+        postings = list(transfer_postings(account, to_date=to_date))
+        if to_date is not None:
+            postings = [posting for posting in postings if posting['last_updated'] < to_date]
+
+        entries = []
+        for posting in reversed(postings):
+            amount = from_bgn(Money(posting['amount_credit'] - posting['amount_debit']), account.currency)
+            entries.append(LedgerEntry(account=account, fund_transfer_id=posting['id'], posted=posting['last_updated'],
+                                       amount=amount, balance=balance))
+            balance -= amount
+
+        LedgerEntry.objects.bulk_create(reversed(entries), batch_size=batch_size)
+
+    return len(entries)
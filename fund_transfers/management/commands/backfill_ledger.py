@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from fund_transfers.ledger import backfill_ledger
+from registrations.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Creates ledger entries for fund transfers processed before the ledger was introduced'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', type=int, action='append', help='Account id, all accounts by default')
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.order_by('pk')
+        if options['account']:
+            accounts = accounts.filter(pk__in=options['account'])
+
+        total = 0
+        for account in accounts.iterator():
+            created = backfill_ledger(account)
+            total += created
+            if created:
+                self.stdout.write(f'{account.iban}: {created} entries')
+        self.stdout.write(f'{total} ledger entries created')
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from fund_transfers.shards import compact
+from registrations.models import Account
+from registrations.money import to_major
+
+
+class Command(BaseCommand):
+    help = 'Folds balance shards of hot accounts into account balances and gives running balances to their ' \
+           'ledger entries (run periodically and after balance_shards of an account is set to 0)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', type=int, action='append', help='Account id, all sharded accounts by default')
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.select_related('currency').order_by('pk')
+        if options['account']:
+            accounts = accounts.filter(pk__in=options['account'])
+        else:
+            accounts = accounts.filter(Q(balance_shards__gt=0) | Q(shards__balance__gt=0)).distinct()
+
+        for account in accounts:
+            folded, entries = compact(account)
+            self.stdout.write(f'{account.iban}: {to_major(folded, account.currency)} {account.currency.code} folded, '
+                              f'{entries} ledger entries balanced')
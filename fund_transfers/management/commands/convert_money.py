@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
+from django.db.models import F, Func
+from django.db.models.functions import Cast
+from sequences.models import Sequence
+
+from fund_transfers.models import FundTransfer, LedgerEntry
+from registrations.models import Account, Currency
+from registrations.money import MINOR_UNIT
+
+# Sequence row marking converted database, so the conversion runs only once
+CONVERTED_MARKER = 'money_minor_units'
+
+# Money columns stored as major unit floats before minor units
+MONEY_FIELDS = [
+    (Account, 'balance'),
+    (FundTransfer, 'amount'),
+    (FundTransfer, 'amount_bgn'),
+    (LedgerEntry, 'amount'),
+    (LedgerEntry, 'balance'),
+]
+
+
+def to_minor_units(field, minor_unit):
+    return Cast(Func(F(field) * 10 ** minor_unit, function='ROUND'), output_field=models.BigIntegerField())
+
+
+def float_field(field):
+    """
+    :param field: MoneyField
+    :return: FloatField with the column of field, as it was before minor units
+    """
+    old_field = models.FloatField(null=field.null)
+    old_field.set_attributes_from_name(field.name)
+    return old_field
+
+
+def column_type(model, field):
+    """
+    :return: Django field type of the database column of field, e.g. 'FloatField'
+    """
+    with connection.cursor() as cursor:
+        description = connection.introspection.get_table_description(cursor, model._meta.db_table)
+    for column in description:
+        if column.name == field.column:
+            return connection.introspection.get_field_type(column.type_code, column)
+
+
+class Command(BaseCommand):
+    help = 'Converts amounts and balances stored as major unit floats to integer minor units and alters ' \
+           'the money columns to bigint (run once while the columns are still float, ' \
+           'an integer column has lost the minor units already)'
+
+    def handle(self, *args, **options):
+        if Sequence.objects.filter(name=CONVERTED_MARKER).exists():
+            self.stdout.write('Amounts are already in minor units')
+            return
+
+        fields = [(model, model._meta.get_field(name)) for model, name in MONEY_FIELDS]
+        not_float = [f'{model.__name__}.{field.name}' for model, field in fields
+                     if column_type(model, field) != 'FloatField']
+        if not_float:
+            raise CommandError(f'Money columns are not float: {", ".join(not_float)}. '
+                               f'Run convert_money before they are altered.')
+
+        # Atomic on backends with transactional DDL
+        with connection.schema_editor() as schema_editor:
+            # Primary key of the marker blocks a concurrent conversion
+            Sequence.objects.create(name=CONVERTED_MARKER, last=1)
+
+            # Rounded while the columns are float, so the cast to bigint of the alter is exact
+            for currency in Currency.objects.order_by('pk'):
+                accounts = Account.objects.filter(currency=currency)\
+                    .update(balance=to_minor_units('balance', currency.minor_unit))
+                transfers = FundTransfer.objects.filter(currency=currency)\
+                    .update(amount=to_minor_units('amount', currency.minor_unit))
+                entries = LedgerEntry.objects.filter(account__currency=currency)\
+                    .update(amount=to_minor_units('amount', currency.minor_unit),
+                            balance=to_minor_units('balance', currency.minor_unit))
+                self.stdout.write(f'{currency.code}: {accounts} accounts, {transfers} fund transfers, '
+                                  f'{entries} ledger entries')
+            FundTransfer.objects.update(amount_bgn=to_minor_units('amount_bgn', MINOR_UNIT))
+
+            for model, field in fields:
+                schema_editor.alter_field(model, float_field(field), field)
+        self.stdout.write('Amounts converted to minor units')
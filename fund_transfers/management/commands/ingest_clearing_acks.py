@@ -0,0 +1,31 @@
+import glob
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from fund_transfers.clearing import ingest_acknowledgement
+
+
+class Command(BaseCommand):
+    help = 'Applies pain.002 payment status reports of clearing batches: accepted fund transfers become ' \
+           'Processed, rejected ones Processed with error with their debit credited back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help='Report files, *.xml of settings.CLEARING_INBOX_DIR by default '
+                                                     '(renamed to *.done when ingested)')
+
+    def handle(self, *args, **options):
+        files = options['files']
+        from_inbox = not files
+        if from_inbox:
+            files = sorted(glob.glob(os.path.join(settings.CLEARING_INBOX_DIR, '*.xml')))
+
+        for file_name in files:
+            try:
+                result = ingest_acknowledgement(file_name)
+            except (ValueError, SyntaxError) as e:
+                raise CommandError(f'{file_name}: {e}')
+            if from_inbox:
+                os.replace(file_name, file_name[:-len('.xml')] + '.done')
+            self.stdout.write(f'{file_name}: {result["processed"]} processed, {result["rejected"]} rejected')
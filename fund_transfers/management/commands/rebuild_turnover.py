@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from fund_transfers.turnover import rebuild_turnover
+from registrations.models import Account
+
+
+class Command(BaseCommand):
+    help = 'Recalculates daily account turnovers from the ledger (run after backfill_ledger)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', type=int, action='append', help='Account id, all accounts by default')
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.order_by('pk')
+        if options['account']:
+            accounts = accounts.filter(pk__in=options['account'])
+
+        total = 0
+        for account in accounts.iterator():
+            created = rebuild_turnover(account)
+            total += created
+            if created:
+                self.stdout.write(f'{account.iban}: {created} daily turnovers')
+        self.stdout.write(f'{total} daily turnovers created')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from fund_transfers.clearing import ClearingWorker
+
+
+class Command(BaseCommand):
+    help = 'Writes approved fund transfers of external payment systems to outbound pain.001 batch files ' \
+           '(settings.CLEARING_QUEUES thresholds, settings.CLEARING_OUTBOX_DIR)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Flush due queues once and exit')
+        parser.add_argument('--force', action='store_true', help='Flush all non-empty queues, implies --once')
+        parser.add_argument('--poll-interval', type=float, default=10, help='Seconds to wait when nothing is due')
+
+    def handle(self, *args, **options):
+        worker = ClearingWorker()
+        if options['once'] or options['force']:
+            for batch in worker.run_once(force=options['force']):
+                self.stdout.write(f'{batch.message_id}: {batch.fund_transfers.count()} fund transfers '
+                                  f'written to {batch.file_name}')
+            return
+        try:
+            worker.run_forever(poll_interval=options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
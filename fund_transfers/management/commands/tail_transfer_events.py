@@ -0,0 +1,49 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from fund_transfers.events import commit_offset, read_events
+from fund_transfers.models import TransferEventConsumer
+
+
+class Command(BaseCommand):
+    help = 'Prints fund transfer events as JSON lines after a sequence number or after the offset of a consumer ' \
+           '(committed after every printed page), optionally waiting for new events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after', type=int, help='Sequence number of the last processed event')
+        parser.add_argument('--consumer', help='Consumer name, its offset is read and committed')
+        parser.add_argument('--account', type=int, help='Events of one account only')
+        parser.add_argument('--follow', action='store_true', help='Wait for new events')
+        parser.add_argument('--poll-interval', type=float, default=1, help='Seconds to wait when there are no events')
+
+    def handle(self, *args, **options):
+        consumer = options['consumer']
+        after = options['after']
+        if after is None:
+            after = consumer and TransferEventConsumer.objects.filter(name=consumer)\
+                .values_list('offset', flat=True).first() or 0
+
+        try:
+            while True:
+                events = read_events(after=after, account_id=options['account'])
+                for event in events:
+                    self.stdout.write(json.dumps({
+                        'sequence': event.sequence,
+                        'fund_transfer': event.fund_transfer_id,
+                        'account': event.account_id,
+                        'user': event.user_id,
+                        'status': event.status,
+                        'created': event.created.isoformat(),
+                    }))
+                if events:
+                    after = events[-1].sequence
+                    if consumer:
+                        commit_offset(consumer, after)
+                    continue
+                if not options['follow']:
+                    break
+                time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
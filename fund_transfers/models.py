@@ -1,29 +1,176 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator
+from django.utils import timezone
 
 from django_iban.fields import IBANField
 
 from registrations.models import Account, Currency
+from registrations.money import MoneyField
 from .enums import TransferStatusEnum, PaymentSystemEnum
 
 
+class ClearingBatch(models.Model):
+    """
+    Approved fund transfers of an external payment system sent together in one outbound file.
+    The batch is Created with its transfers in one transaction and the file is written afterwards,
+    so a batch left Created by a crashed worker gets its file on the next run.
+    """
+    STATUSES = [('C', 'Created'), ('S', 'Sent'), ('A', 'Acknowledged')]
+
+    payment_system = models.CharField(max_length=7, choices=[(p.name, p.value) for p in PaymentSystemEnum])
+    status = models.CharField(max_length=10, choices=STATUSES, default='C')
+    message_id = models.CharField(max_length=35, unique=True, blank=True)
+    file_name = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(blank=True, null=True)
+    acknowledged = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name_plural = 'Clearing batches'
+
+
 class FundTransfer(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    # Composite indexes below start with user and account, single column indexes are not needed
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, db_index=False)
     iban_beneficiary = IBANField()
     bic_beneficiary = models.CharField(max_length=11, blank=True)
     bank_beneficiary = models.CharField(max_length=200, blank=True)
     name_beneficiary = models.CharField(max_length=150, blank=True)
-    amount = models.FloatField(default=0, validators=[MinValueValidator(0)])
-    amount_bgn = models.FloatField(default=0, validators=[MinValueValidator(0)])
+    # Minor units of transfer currency and of BGN
+    amount = MoneyField(default=0, validators=[MinValueValidator(0)])
+    amount_bgn = MoneyField(default=0, validators=[MinValueValidator(0)])
     currency = models.ForeignKey(Currency, on_delete=models.CASCADE, default=1)
     details = models.CharField(max_length=150)
     created = models.DateTimeField(auto_now_add=True)
     last_updated = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=10, choices=[(s.name, s.value) for s in TransferStatusEnum], default='I')
     otp_generated = models.CharField(max_length=10, blank=True)
+    otp_generated_at = models.DateTimeField(blank=True, null=True)
     pin_otp = models.CharField(max_length=10, blank=True)
     user_approved = models.ForeignKey(User, related_name='ft_approval', on_delete=models.CASCADE, blank=True, null=True)
     reference_cbs = models.CharField(max_length=20, blank=True)
     payment_system = models.CharField(max_length=7, choices=[(p.name, p.value) for p in PaymentSystemEnum], default='I')
+    # Outbound file of transfers cleared by an external payment system
+    clearing_batch = models.ForeignKey(ClearingBatch, on_delete=models.PROTECT, related_name='fund_transfers',
+                                       blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Clearing queues: approved transfers of a payment system waiting for a batch
+            models.Index(fields=['status', 'payment_system', 'clearing_batch'], name='ft_clearing_queue_idx'),
+            # Statement credits: iban_beneficiary + status + last_updated range
+            models.Index(fields=['iban_beneficiary', 'status', 'last_updated'], name='ft_statement_credit_idx'),
+            # Statement debits: account + status + last_updated range
+            models.Index(fields=['account', 'status', 'last_updated'], name='ft_statement_debit_idx'),
+            # Transfers list by account (customer's accounts, account_id filter), created range, keyset order
+            models.Index(fields=['account', 'created', 'id'], name='ft_account_created_idx'),
+            # Transfers list of accountant: user + created range, keyset order
+            models.Index(fields=['user', 'created', 'id'], name='ft_user_created_idx'),
+            # Transfers list of admin users: created range, keyset order
+            models.Index(fields=['created', 'id'], name='ft_created_idx'),
+        ]
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only account posting written when a fund transfer is settled.
+    Amount is signed (debits are negative) and in minor units of account currency,
+    balance is the account balance after the posting. Postings of sharded (hot) accounts
+    get their balance when the balance shards are compacted (fund_transfers.shards).
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='ledger_entries', db_index=False)
+    fund_transfer = models.ForeignKey(FundTransfer, on_delete=models.PROTECT, related_name='ledger_entries')
+    posted = models.DateTimeField(default=timezone.now)
+    amount = MoneyField()
+    balance = MoneyField(null=True)
+
+    class Meta:
+        indexes = [
+            # Statement: account + posted range, opening balance: last posting before period
+            models.Index(fields=['account', 'posted', 'id'], name='ledger_account_posted_idx'),
+        ]
+        verbose_name_plural = 'Ledger entries'
+
+
+class DailyTurnover(models.Model):
+    """
+    Postings of one day rolled up per account and user who initiated the fund transfers.
+    Updated at settlement, rebuilt from the ledger by rebuild_turnover command.
+    Totals are in minor units of account currency, which is kept here for reports by user.
+    Credits to sharded (hot) accounts are spread over shard rows like their balance, other rows have shard 0.
+    """
+    day = models.DateField()
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='daily_turnovers', db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_turnovers', db_index=False)
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+    debit = MoneyField(default=0)
+    credit = MoneyField(default=0)
+    shard = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('account', 'user', 'day', 'shard')
+        indexes = [
+            # Reports by account and period, unique index above serves account + user lookups
+            models.Index(fields=['account', 'day'], name='turnover_account_day_idx'),
+            models.Index(fields=['user', 'day'], name='turnover_user_day_idx'),
+        ]
+
+
+class TransferEvent(models.Model):
+    """
+    Append-only log of fund transfer status changes, ordered by a gap-free sequence number.
+    Events are written in the transaction of the change and numbered after commit (fund_transfers.events),
+    so consumers read only committed changes and resume after the last sequence number they have processed.
+    Events are kept when their fund transfer is deleted.
+    """
+    DELETED = 'D'
+
+    # Null until the event is numbered after commit
+    sequence = models.BigIntegerField(unique=True, null=True, blank=True)
+    fund_transfer = models.ForeignKey(FundTransfer, on_delete=models.DO_NOTHING, db_constraint=False,
+                                      related_name='events')
+    account = models.ForeignKey(Account, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+                                related_name='+')
+    # User who made the change
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=10, choices=[(s.name, s.value) for s in TransferStatusEnum] +
+                              [(DELETED, 'Deleted')])
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Incremental reads of one account's events
+            models.Index(fields=['account', 'sequence'], name='event_account_sequence_idx'),
+        ]
+
+
+class TransferEventConsumer(models.Model):
+    """
+    Last event sequence number processed by a named consumer
+    """
+    name = models.CharField(max_length=100, unique=True)
+    offset = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class ApprovalBatch(models.Model):
+    """
+    Set of initiated fund transfers approved together with one PIN + OTP
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='approval_batches')
+    fund_transfers = models.ManyToManyField(FundTransfer, related_name='approval_batches')
+    created = models.DateTimeField(auto_now_add=True)
+    last_updated = models.DateTimeField(auto_now=True)
+    status = models.CharField(max_length=10, choices=[(s.name, s.value) for s in TransferStatusEnum], default='I')
+    otp_generated = models.CharField(max_length=10, blank=True)
+    otp_generated_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name_plural = 'Approval batches'
+
+    @property
+    def fund_transfer_ids(self):
+        return [fund_transfer.pk for fund_transfer in self.fund_transfers.all()]
@@ -0,0 +1,114 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (created, id), newest first.
+    The cursor holds created and id of the last row of the page, so every page
+    is read with a range condition instead of an offset and costs the same at any depth.
+    """
+    page_size = 100
+    max_page_size = 1000
+    stream_chunk_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.next_cursor = None
+
+        # Views return an empty list for invalid filters
+        if not isinstance(queryset, QuerySet):
+            return list(queryset)
+
+        page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request.query_params.get(self.cursor_query_param))
+
+        rows = list(self.keyset(queryset, cursor)[:page_size + 1])
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_cursor = self.encode_cursor(rows[-1])
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    @staticmethod
+    def keyset(queryset, cursor=None):
+        """
+        Orders queryset newest first and skips rows up to cursor
+        :param queryset:
+        :param cursor: (created, id) of the last row already returned
+        :return: queryset
+        """
+        queryset = queryset.order_by('-created', '-id')
+        if cursor is not None:
+            created, pk = cursor
+            queryset = queryset.filter(Q(created__lt=created) | Q(created=created, id__lt=pk))
+        return queryset
+
+    @staticmethod
+    def encode_cursor(row):
+        value = json.dumps([row.created.isoformat(), row.id])
+        return urlsafe_b64encode(value.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            created, pk = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+            created = parse_datetime(created)
+            if created is None:
+                raise ValueError(cursor)
+            return created, int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def stream(self, queryset, get_serializer):
+        """
+        Generates JSON array of all rows, serializing one keyset chunk at a time
+        :param queryset:
+        :param get_serializer: view's get_serializer
+        :return: generator of JSON text parts
+        """
+        encoder = JSONEncoder()
+        yield '['
+        cursor = None
+        separator = ''
+        while isinstance(queryset, QuerySet):
+            rows = list(self.keyset(queryset, cursor)[:self.stream_chunk_size])
+            if not rows:
+                break
+            for item in get_serializer(rows, many=True).data:
+                yield separator + encoder.encode(item)
+                separator = ','
+            if len(rows) < self.stream_chunk_size:
+                break
+            cursor = rows[-1].created, rows[-1].id
+        yield ']'
@@ -0,0 +1,44 @@
+import codecs
+import csv
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class FundTransfersCSVParser(BaseParser):
+    """
+    Parses CSV batch of fund transfers (payment / payroll files) to the same
+    structure as JSON input. Columns:
+    account_iban, iban_beneficiary, bic_beneficiary, bank_beneficiary, name_beneficiary,
+    details, amount, currency_code, payment_system
+    """
+    media_type = 'text/csv'
+
+    nested_columns = {
+        'account_iban': ('account', 'iban'),
+        'currency_code': ('currency', 'code'),
+    }
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            reader = csv.DictReader(codecs.iterdecode(stream, encoding))
+            return [self.to_transfer(row) for row in reader]
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise ParseError(f'CSV parse error - {e}')
+
+    def to_transfer(self, row):
+        transfer = {}
+        for column, value in row.items():
+            if column is None:
+                raise csv.Error('too many values in a line')
+            column = column.strip()
+            value = (value or '').strip()
+            if column in self.nested_columns:
+                key, nested_key = self.nested_columns[column]
+                transfer[key] = {nested_key: value}
+            elif value:
+                transfer[column] = value
+        return transfer
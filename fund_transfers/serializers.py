@@ -1,15 +1,46 @@
 import datetime
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
+from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
 from rest_framework.validators import ValidationError
 from rest_framework.utils import model_meta
 
-from .models import FundTransfer
+from .events import record_events
+from .models import FundTransfer, LedgerEntry, ApprovalBatch, TransferEvent, TransferEventConsumer
+from .settlement import settlement_engine
 
-from registrations.models import Currency, Account, Manager
+from registrations.iban import iban_index
+from registrations.models import Account, Manager
+from registrations.money import MoneySerializerField, to_bgn, to_major, to_money
+from registrations.reference import get_conversion_currency_or_404, reference_data
 from registrations.serializers import CurrencyShortSerializer, UserShortSerializer, AccountShortSerializer
 from registrations.utils import ExtendedTools
-from notifications.tasks import send_sms
+from notifications.tasks import enqueue_sms
+
+
+def validate_beneficiary(attrs):
+    """
+    Internal transfers must credit a Django bank IBAN, checked by the bank code without a query
+    """
+    if attrs.get('payment_system', 'I') == 'I' and not iban_index.is_local(attrs['iban_beneficiary']):
+        raise ValidationError({'iban_beneficiary': ['Beneficiary is not in Django bank! '
+                                                    'Transfers to other banks should use an external payment system.']})
+    return attrs
+
+
+def validate_amount(attrs):
+    """
+    Amount should not be more precise than minor units of its currency
+    """
+    currency = reference_data.get_currency(attrs['currency']['code']) if 'currency' in attrs else None
+    if currency is not None and 'amount' in attrs and \
+            to_major(to_money(attrs['amount'], currency), currency) != attrs['amount']:
+        raise ValidationError({'amount': [f'Ensure that there are no more than {currency.minor_unit} decimal places '
+                                          f'for {currency.code}.']})
+    return attrs
 
 
 class FundTransferSerializer(serializers.ModelSerializer):
@@ -17,6 +48,8 @@ class FundTransferSerializer(serializers.ModelSerializer):
     user_approved = UserShortSerializer(read_only=True)
     account = AccountShortSerializer()
     currency = CurrencyShortSerializer()
+    amount = MoneySerializerField(currency_source='currency', min_value=0)
+    amount_bgn = MoneySerializerField(read_only=True)
 
     class Meta:
         model = FundTransfer
@@ -28,6 +61,9 @@ class FundTransferSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'user', 'amount_bgn', 'created', 'last_updated', 'status', 'user_approved',
                             'reference_cbs')
 
+    def validate(self, attrs):
+        return validate_amount(validate_beneficiary(attrs))
+
     def create(self, validated_data):
 
         user = self.context['request'].user
@@ -38,12 +74,35 @@ class FundTransferSerializer(serializers.ModelSerializer):
         validated_data['account'] = account
 
         currency_data = validated_data.pop('currency')
-        currency = get_object_or_404(Currency, code=currency_data['code'])
+        currency = get_conversion_currency_or_404(currency_data['code'])
         validated_data['currency'] = currency
 
-        validated_data['amount_bgn'] = round(validated_data['amount'] * currency.rate_to_bgn, 2)
+        validated_data['amount'] = to_money(validated_data['amount'], currency)
+        validated_data['amount_bgn'] = to_bgn(validated_data['amount'], currency)
+
+        with transaction.atomic():
+            instance = super(FundTransferSerializer, self).create(validated_data)
+            record_events([instance], instance.status, user=user)
+        return instance
+
+
+class FundTransferBatchLineSerializer(serializers.ModelSerializer):
+    """
+    Validates one line of a batch submission.
+    Account and currency are resolved for the whole batch by the view.
+    """
+    account = AccountShortSerializer()
+    currency = CurrencyShortSerializer()
+    amount = MoneySerializerField(currency_source='currency', min_value=0)
+
+    class Meta:
+        model = FundTransfer
+
+        fields = ('iban_beneficiary', 'bic_beneficiary', 'bank_beneficiary', 'name_beneficiary', 'details',
+                  'amount', 'currency', 'account', 'payment_system')
 
-        return super(FundTransferSerializer, self).create(validated_data)
+    def validate(self, attrs):
+        return validate_amount(validate_beneficiary(attrs))
 
 
 class FundTransferDetailSerializer(ExtendedTools, serializers.ModelSerializer):
@@ -51,6 +110,7 @@ class FundTransferDetailSerializer(ExtendedTools, serializers.ModelSerializer):
     user_approved = UserShortSerializer(read_only=True)
     account = AccountShortSerializer()
     currency = CurrencyShortSerializer()
+    amount = MoneySerializerField(currency_source='currency', min_value=0)
 
     class Meta:
         model = FundTransfer
@@ -61,22 +121,8 @@ class FundTransferDetailSerializer(ExtendedTools, serializers.ModelSerializer):
 
         read_only_fields = ('id', 'user', 'created', 'last_updated', 'user_approved', 'reference_cbs')
 
-    @staticmethod
-    def update_account_balance(account, amount_bgn):
-        # If we got account instance - it is the debit account
-        # Otherwise it should be IBAN for credit account
-        if not isinstance(account, Account):
-            try:
-                account = Account.objects.get(iban=account)
-            except Account.DoesNotExist:
-                return
-
-        amount = round(amount_bgn / account.currency.rate_to_bgn, 2)
-        if account.balance + amount >= 0:
-            account.balance = round(account.balance + amount, 2)
-            account.save()
-        else:
-            raise ValidationError('Not sufficient account balance! Transfer rejected!')
+    def validate(self, attrs):
+        return validate_amount(attrs)
 
     def update(self, instance, validated_data):
         """
@@ -94,57 +140,223 @@ class FundTransferDetailSerializer(ExtendedTools, serializers.ModelSerializer):
         validated_data['account'] = account
 
         currency_data = validated_data.pop('currency')
-        currency = get_object_or_404(Currency, code=currency_data['code'])
+        currency = get_conversion_currency_or_404(currency_data['code'])
         validated_data['currency'] = currency
 
-        validated_data['amount_bgn'] = round(validated_data['amount'] * currency.rate_to_bgn, 2)
+        validated_data['amount'] = to_money(validated_data['amount'], currency)
+        validated_data['amount_bgn'] = to_bgn(validated_data['amount'], currency)
 
         # Status should be Initiated, Approved or Rejected
         if validated_data['status'] not in ['I', 'A', 'R']:
             raise ValidationError('Transfers should be Approved or Rejected!')
 
-        # We process FT only if it is in Authorized status
-        if validated_data['status'] == 'A' or (validated_data['status'] == 'I' and validated_data['pin_otp']):
-            extended_user = self.get_extended_user(user)
+        with transaction.atomic():
+            if validated_data['status'] == 'R':
+                settlement_engine.claim(instance, to_status='R')
+            elif validated_data['status'] == 'I' and not validated_data['pin_otp']:
+                # Edit locks the row if it is still Initiated, so a concurrent approval is not overwritten
+                settlement_engine.claim(instance, to_status='I')
+
+            # We process FT only if it is in Authorized status
+            if validated_data['status'] == 'A' or (validated_data['status'] == 'I' and validated_data['pin_otp']):
+                extended_user = self.get_extended_user(user)
+
+                if validated_data['pin_otp'] or validated_data['status'] == 'A':
+                    # Validate correct PIN + OTP
+                    if validated_data['pin_otp'] != extended_user.pin + instance.otp_generated:
+                        raise ValidationError("Invalid PIN + OTP!")
+
+                if isinstance(extended_user, Manager):
+                    # If there is a limit for manager, we validate it
+                    if extended_user.limit_per_transfer and \
+                            validated_data['amount_bgn'] > to_money(extended_user.limit_per_transfer):
+                        raise ValidationError("Manager's limit per transfer exceeded!")
+
+                settlement_engine.claim(instance)
+                instance.payment_system = validated_data.get('payment_system', instance.payment_system)
+                settlement_engine.settle(instance, account, validated_data['iban_beneficiary'],
+                                         validated_data['amount_bgn'])
+
+                # Transfers of external payment systems are Processed when clearing acknowledges them
+                validated_data['status'] = 'A' if settlement_engine.is_external(instance) else 'P'
+                validated_data['reference_cbs'] = f'FT{datetime.date.today().strftime("%Y%m%d")}{instance.id:06d}'
+
+                enqueue_sms(to_phone_number=extended_user.mobile_phone,
+                            message_body=f'Ordered transfer {instance.id} '
+                            f'({to_major(validated_data["amount"], currency)} {currency.code})')
+
+            # Same as in rest_framework.serializers
+            info = model_meta.get_field_info(instance)
+            for attr, value in validated_data.items():
+                if attr in info.relations and info.relations[attr].to_many:
+                    field = getattr(instance, attr)
+                    field.set(value)
+                else:
+                    setattr(instance, attr, value)
+            # Only changed columns are written
+            instance.save(update_fields=[*validated_data.keys(), 'last_updated'])
+
+            if instance.status != 'I':
+                record_events([instance], instance.status, user=user)
+
+        return instance
+
+
+class ApprovalBatchSerializer(serializers.ModelSerializer):
+    """
+    Creates batch of Initiated fund transfers from accounts of the user
+    """
+    user = UserShortSerializer(read_only=True)
+    fund_transfers = serializers.ListField(child=serializers.IntegerField(), source='fund_transfer_ids', min_length=1,
+                                           max_length=getattr(settings, 'FUND_TRANSFER_BATCH_MAX_LINES', 10000))
+
+    class Meta:
+        model = ApprovalBatch
+
+        fields = ('id', 'user', 'fund_transfers', 'created', 'last_updated', 'status')
+
+        read_only_fields = ('id', 'user', 'created', 'last_updated', 'status')
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        fund_transfer_ids = set(validated_data['fund_transfer_ids'])
+
+        # One query for all transfers of the batch
+        found_ids = set(FundTransfer.objects.filter(pk__in=fund_transfer_ids, status='I', account__users__pk=user.id)
+                        .values_list('pk', flat=True))
+        missing_ids = sorted(fund_transfer_ids - found_ids)
+        if missing_ids:
+            raise ValidationError({'fund_transfers': [f'Initiated fund transfers not found: {missing_ids}']})
+
+        with transaction.atomic():
+            approval_batch = ApprovalBatch.objects.create(user=user)
+            approval_batch.fund_transfers.add(*found_ids)
+
+        return approval_batch
 
-            if validated_data['pin_otp'] or validated_data['status'] == 'A':
-                # Validate correct PIN + OTP
-                if validated_data['pin_otp'] != extended_user.pin + instance.otp_generated:
-                    raise ValidationError("Invalid PIN + OTP!")
 
-            if isinstance(extended_user, Manager):
-                # If there is a limit for manager, we validate it
-                if extended_user.limit_per_transfer and validated_data['amount_bgn'] > extended_user.limit_per_transfer:
-                    raise ValidationError("Manager's limit per transfer exceeded!")
+class ApprovalBatchDetailSerializer(ExtendedTools, serializers.ModelSerializer):
+    """
+    Approves all fund transfers of the batch with one PIN + OTP
+    """
+    user = UserShortSerializer(read_only=True)
+    fund_transfers = serializers.ListField(child=serializers.IntegerField(), source='fund_transfer_ids', read_only=True)
+    pin_otp = serializers.CharField(max_length=20, write_only=True)
+    results = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ApprovalBatch
 
-            self.update_account_balance(account, -validated_data['amount_bgn'])
-            self.update_account_balance(validated_data['iban_beneficiary'], validated_data['amount_bgn'])
+        fields = ('id', 'user', 'fund_transfers', 'created', 'last_updated', 'status', 'pin_otp', 'results')
 
-            validated_data['status'] = 'P'
-            validated_data['reference_cbs'] = f'FT{datetime.date.today().strftime("%Y%m%d")}{instance.id:06d}'
+        read_only_fields = ('id', 'user', 'created', 'last_updated', 'status')
 
-            send_sms(to_phone_number=extended_user.mobile_phone,
-                     message_body=f'Ordered transfer {instance.id} '
-                     f'({validated_data["amount"]:.2f} {validated_data["currency"].code})')
+    def get_results(self, obj):
+        return getattr(obj, 'results', [])
 
-        # Same as in rest_framework.serializers
-        info = model_meta.get_field_info(instance)
-        for attr, value in validated_data.items():
-            if attr in info.relations and info.relations[attr].to_many:
-                field = getattr(instance, attr)
-                field.set(value)
-            else:
-                setattr(instance, attr, value)
-        instance.save()
+    def update(self, instance, validated_data):
+        """
+        Settles fund transfers of the batch in one transaction
+        :param instance:
+        :param validated_data:
+        :return: approval batch with per transfer results
+        """
+        user = self.context['request'].user
+        extended_user = self.get_extended_user(user)
+
+        # Validate correct PIN + OTP
+        if not instance.otp_generated or validated_data['pin_otp'] != extended_user.pin + instance.otp_generated:
+            raise ValidationError("Invalid PIN + OTP!")
+
+        fund_transfer_ids = instance.fund_transfer_ids
+        fund_transfers = list(instance.fund_transfers.filter(account__users__pk=user.id).order_by('pk'))
+        found_ids = {fund_transfer.pk for fund_transfer in fund_transfers}
+        errors = {fund_transfer_id: ['Fund transfer not found!']
+                  for fund_transfer_id in fund_transfer_ids if fund_transfer_id not in found_ids}
+
+        # If there is a limit for manager, we validate it per transfer
+        if isinstance(extended_user, Manager) and extended_user.limit_per_transfer:
+            for fund_transfer in fund_transfers:
+                if fund_transfer.amount_bgn > to_money(extended_user.limit_per_transfer):
+                    errors[fund_transfer.pk] = ["Manager's limit per transfer exceeded!"]
+            fund_transfers = [fund_transfer for fund_transfer in fund_transfers if fund_transfer.pk not in errors]
+
+        with transaction.atomic():
+            if not ApprovalBatch.objects.filter(pk=instance.pk, status='I').update(status='P',
+                                                                                   last_updated=timezone.now()):
+                raise ValidationError('Approval batch is already processed!')
+            instance.status = 'P'
+
+            processed = []
+            for fund_transfer_id, outcome in settlement_engine.settle_batch(fund_transfers).items():
+                if isinstance(outcome, ValidationError):
+                    errors[fund_transfer_id] = outcome.detail
+                else:
+                    processed.append(fund_transfer_id)
+
+            if processed:
+                # All processed transfers are updated with one statement
+                today = datetime.date.today().strftime("%Y%m%d")
+                FundTransfer.objects.filter(pk__in=processed).update(
+                    status=Case(When(payment_system='I', then=Value('P')), default=Value('A'),
+                                output_field=CharField()),
+                    user_approved=user, last_updated=timezone.now(),
+                    reference_cbs=Case(*[When(pk=fund_transfer_id, then=Value(f'FT{today}{fund_transfer_id:06d}'))
+                                         for fund_transfer_id in processed], output_field=CharField()))
+                processed = set(processed)
+                for status, external in (('P', False), ('A', True)):
+                    record_events([fund_transfer for fund_transfer in fund_transfers if fund_transfer.pk in processed
+                                   and settlement_engine.is_external(fund_transfer) == external], status, user=user)
+
+                enqueue_sms(to_phone_number=extended_user.mobile_phone,
+                            message_body=f'Ordered {len(processed)} transfers of batch {instance.id}')
+
+        instance.results = [
+            {'fund_transfer': fund_transfer_id, 'status': 'error', 'errors': errors[fund_transfer_id]}
+            if fund_transfer_id in errors else {'fund_transfer': fund_transfer_id, 'status': 'processed'}
+            for fund_transfer_id in fund_transfer_ids
+        ]
 
         return instance
 
 
 class StatementSerializer(serializers.ModelSerializer):
-    amount_debit = serializers.FloatField()
-    amount_credit = serializers.FloatField()
+    """
+    Ledger entry as statement line, amounts are in the currency of serializer context
+    """
+    amount_debit = serializers.SerializerMethodField()
+    amount_credit = serializers.SerializerMethodField()
+    balance = MoneySerializerField(read_only=True)
+    reference_cbs = serializers.CharField(source='fund_transfer.reference_cbs', read_only=True)
+    name_beneficiary = serializers.CharField(source='fund_transfer.name_beneficiary', read_only=True)
+    details = serializers.CharField(source='fund_transfer.details', read_only=True)
 
     class Meta:
-        model = FundTransfer
+        model = LedgerEntry
+
+        fields = ('id', 'fund_transfer', 'posted', 'amount_debit', 'amount_credit', 'balance', 'reference_cbs',
+                  'name_beneficiary', 'details')
+
+    def get_amount_debit(self, obj):
+        return to_major(-obj.amount if obj.amount < 0 else 0, self.context.get('currency'))
+
+    def get_amount_credit(self, obj):
+        return to_major(obj.amount if obj.amount > 0 else 0, self.context.get('currency'))
+
+
+class TransferEventSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TransferEvent
+
+        fields = ('sequence', 'fund_transfer', 'account', 'user', 'status', 'created')
+
+
+class TransferEventConsumerSerializer(serializers.ModelSerializer):
+    offset = serializers.IntegerField(min_value=0)
+
+    class Meta:
+        model = TransferEventConsumer
+
+        fields = ('name', 'offset', 'updated')
 
-        fields = ('id', 'last_updated', 'amount_debit', 'amount_credit', 'reference_cbs', 'name_beneficiary', 'details')
+        read_only_fields = ('name', 'updated')
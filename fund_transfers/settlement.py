@@ -0,0 +1,263 @@
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from rest_framework.validators import ValidationError
+
+from registrations.iban import iban_index
+from registrations.models import Account
+from registrations.money import Money, from_bgn
+from .models import FundTransfer, LedgerEntry
+from .shards import credit_shard, fold_shards
+from .turnover import record_turnover
+
+
+Settlement = namedtuple('Settlement', ['debit_account', 'debit_amount', 'credit_account', 'credit_amount'])
+
+
+class SettlementEngine:
+    """
+    Moves fund transfer amounts between accounts.
+    Accounts are locked in primary key order, so concurrent settlements can not deadlock,
+    and balances are changed by the database with F() expressions, so no update is lost.
+    Credits to sharded (hot) accounts go to balance shards without locking the account row,
+    debits from them fold the shards into the locked account when its balance is not sufficient.
+    All amounts are Money, balances are changed in integer minor units.
+    Must be called inside transaction.atomic() together with the fund transfer update.
+    """
+
+    @staticmethod
+    def claim(fund_transfer, from_status='I', to_status='A'):
+        """
+        Moves fund transfer to to_status only if it is still in from_status.
+        Locks the fund transfer row until the end of transaction, so it is processed only once.
+        :param fund_transfer:
+        :param from_status:
+        :param to_status:
+        """
+        claimed = FundTransfer.objects.filter(pk=fund_transfer.pk, status=from_status).update(status=to_status)
+        if not claimed:
+            raise ValidationError('Fund transfer is already processed!')
+
+    @staticmethod
+    def lock_accounts(account_ids):
+        """
+        Locks accounts in deterministic (primary key) order
+        :param account_ids:
+        :return: dict of locked accounts by pk
+        """
+        accounts = Account.objects.select_for_update(of=('self',)).select_related('currency')\
+            .filter(pk__in=account_ids).order_by('pk')
+        return {account.pk: account for account in accounts}
+
+    def lock_settlement_accounts(self, debit_account_ids, credit_accounts):
+        """
+        Locks debit accounts and credit accounts without balance shards.
+        Sharded credit accounts are read without lock.
+        :param debit_account_ids:
+        :param credit_accounts: list of (pk, balance_shards)
+        :return: dict of accounts by pk
+        """
+        hot_account_ids = {pk for pk, balance_shards in credit_accounts if balance_shards} - set(debit_account_ids)
+        accounts = self.lock_accounts(set(debit_account_ids) |
+                                      {pk for pk, balance_shards in credit_accounts if pk not in hot_account_ids})
+        if hot_account_ids:
+            accounts.update({account.pk: account for account in
+                             Account.objects.select_related('currency').filter(pk__in=hot_account_ids)})
+            # Shards were turned off after the routing index read them, such accounts are credited in place
+            unsharded = [pk for pk in hot_account_ids if pk in accounts and not accounts[pk].balance_shards]
+            if unsharded:
+                accounts.update(self.lock_accounts(unsharded))
+        return accounts
+
+    @staticmethod
+    def routed_account(accounts, iban, route):
+        """
+        :param accounts: dict of accounts by pk
+        :param iban: IBAN of beneficiary
+        :param route: Route of the routing index or None
+        :return: beneficiary Account or None if it is not found or the route is stale
+        """
+        account = accounts.get(route.account_id) if route is not None else None
+        if account is None or account.iban != iban:
+            # Account deleted or its pk reused in another worker process
+            iban_index.discard(iban)
+            return None
+        return account
+
+    @staticmethod
+    def to_account_currency(account, amount_bgn):
+        return from_bgn(amount_bgn, account.currency)
+
+    @staticmethod
+    def debit(account, amount):
+        """
+        :param account: locked Account
+        :param amount: Money
+        :return: amount folded from balance shards to account balance
+        """
+        folded = 0
+        if account.balance_shards and account.balance < amount:
+            folded = fold_shards(account)
+        # Balance condition is checked by the database in the same statement
+        debited = Account.objects.filter(pk=account.pk, balance__gte=amount).update(balance=F('balance') - amount)
+        if not debited:
+            raise ValidationError('Not sufficient account balance! Transfer rejected!')
+        return folded
+
+    @staticmethod
+    def credit(account, amount):
+        if account.balance_shards:
+            credit_shard(account, amount)
+        else:
+            Account.objects.filter(pk=account.pk).update(balance=F('balance') + amount)
+
+    def post(self, fund_transfer, debit_account, credit_account, amount_bgn, posted):
+        """
+        Moves amount between locked accounts and updates their balances in place.
+        :param fund_transfer: settled FundTransfer
+        :param debit_account: locked Account
+        :param credit_account: locked Account or None for external beneficiary
+        :param amount_bgn: transfer amount in BGN as Money
+        :param posted: posting time
+        :return: Settlement and list of ledger entries to be created
+        """
+        debit_amount = self.to_account_currency(debit_account, amount_bgn)
+        folded = self.debit(debit_account, debit_amount)
+        credit_amount = None
+        if credit_account is not None:
+            credit_amount = self.to_account_currency(credit_account, amount_bgn)
+            self.credit(credit_account, credit_amount)
+
+        # Locked balance is current, so running balance is computed without reading the row again
+        debit_account.balance += folded - debit_amount
+        entries = [LedgerEntry(account=debit_account, fund_transfer=fund_transfer, posted=posted,
+                               amount=-debit_amount, balance=self.running_balance(debit_account))]
+        if credit_account is not None:
+            if not credit_account.balance_shards:
+                credit_account.balance += credit_amount
+            entries.append(LedgerEntry(account=credit_account, fund_transfer=fund_transfer, posted=posted,
+                                       amount=credit_amount, balance=self.running_balance(credit_account)))
+
+        return Settlement(debit_account, debit_amount, credit_account, credit_amount), entries
+
+    @staticmethod
+    def running_balance(account):
+        # Balance of sharded account is known after compaction
+        return None if account.balance_shards else account.balance
+
+    @staticmethod
+    def is_external(fund_transfer):
+        """
+        Transfers of external payment systems are only debited here, the beneficiary is credited by clearing
+        """
+        return fund_transfer.payment_system != 'I'
+
+    @staticmethod
+    def check_beneficiary(credit_account):
+        if credit_account is None:
+            raise ValidationError('Beneficiary account not found in Django bank! '
+                                  'Transfers to other banks should use an external payment system.')
+
+    def settle(self, fund_transfer, debit_account, iban_beneficiary, amount_bgn):
+        """
+        Debits account and credits beneficiary account of Django bank. Transfers of external payment systems
+        are only debited and wait for clearing (fund_transfers.clearing).
+        Postings with running balances are appended to the ledger and added to daily turnovers.
+        :param fund_transfer: settled FundTransfer
+        :param debit_account: Account instance
+        :param iban_beneficiary: IBAN of credit account
+        :param amount_bgn: transfer amount in BGN
+        :return: Settlement with amounts in accounts' currencies
+        """
+        with transaction.atomic():
+            route = None
+            if not self.is_external(fund_transfer):
+                route = iban_index.get(iban_beneficiary)
+                self.check_beneficiary(route)
+
+            accounts = self.lock_settlement_accounts(
+                [debit_account.pk], [(route.account_id, route.balance_shards)] if route else [])
+            credit_account = None
+            if route is not None:
+                credit_account = self.routed_account(accounts, iban_beneficiary, route)
+                self.check_beneficiary(credit_account)
+            settlement, entries = self.post(fund_transfer, accounts[debit_account.pk], credit_account, amount_bgn,
+                                            timezone.now())
+
+            LedgerEntry.objects.bulk_create(entries)
+            record_turnover(entries)
+
+        return settlement
+
+    def settle_batch(self, fund_transfers):
+        """
+        Settles initiated fund transfers in one transaction.
+        Accounts of all transfers are locked once, every transfer is claimed and posted in its own savepoint,
+        so a failed transfer does not roll back the others.
+        :param fund_transfers: list of FundTransfer
+        :return: dict of Settlement or ValidationError by fund transfer pk
+        """
+        outcomes = {}
+        with transaction.atomic():
+            ibans = {fund_transfer.iban_beneficiary for fund_transfer in fund_transfers
+                     if not self.is_external(fund_transfer)}
+            routes = iban_index.lookup(ibans)
+
+            accounts = self.lock_settlement_accounts({fund_transfer.account_id for fund_transfer in fund_transfers},
+                                                     [(route.account_id, route.balance_shards)
+                                                      for route in routes.values()])
+            posted = timezone.now()
+            entries = []
+
+            for fund_transfer in fund_transfers:
+                debit_account = accounts[fund_transfer.account_id]
+                credit_account = None
+                if not self.is_external(fund_transfer):
+                    credit_account = self.routed_account(accounts, fund_transfer.iban_beneficiary,
+                                                         routes.get(fund_transfer.iban_beneficiary))
+                try:
+                    with transaction.atomic():
+                        if not self.is_external(fund_transfer):
+                            self.check_beneficiary(credit_account)
+                        self.claim(fund_transfer)
+                        settlement, transfer_entries = self.post(fund_transfer, debit_account, credit_account,
+                                                                 fund_transfer.amount_bgn, posted)
+                except ValidationError as e:
+                    # Balances in place are changed only after the database updates succeed
+                    outcomes[fund_transfer.pk] = e
+                else:
+                    entries.extend(transfer_entries)
+                    outcomes[fund_transfer.pk] = settlement
+
+            LedgerEntry.objects.bulk_create(entries)
+            record_turnover(entries)
+
+        return outcomes
+
+    def reverse(self, fund_transfer):
+        """
+        Credits back the debit of a fund transfer rejected by clearing
+        :param fund_transfer: debited FundTransfer
+        :return: reversed amount in account currency
+        """
+        with transaction.atomic():
+            account = Account.objects.filter(pk=fund_transfer.account_id).values_list('pk', 'balance_shards').get()
+            account = self.lock_settlement_accounts([], [account])[account[0]]
+            debited = -Money(LedgerEntry.objects.filter(fund_transfer=fund_transfer, account=account)
+                             .aggregate(total=Sum('amount'))['total'] or 0)
+            if debited <= 0:
+                return debited
+
+            self.credit(account, debited)
+            if not account.balance_shards:
+                account.balance += debited
+            entries = [LedgerEntry(account=account, fund_transfer=fund_transfer, posted=timezone.now(),
+                                   amount=debited, balance=self.running_balance(account))]
+            LedgerEntry.objects.bulk_create(entries)
+            record_turnover(entries)
+        return debited
+
+
+settlement_engine = SettlementEngine()
@@ -0,0 +1,97 @@
+import random
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, Sum, When
+
+from registrations.models import Account, AccountBalanceShard
+from registrations.money import Money, MoneyField
+from .models import LedgerEntry
+
+# Ledger entries given running balance by one update statement
+COMPACTION_CHUNK_SIZE = 500
+
+
+def credit_shard(account, amount):
+    """
+    Adds credit to a random balance shard of hot account. Account row is not locked,
+    so credits to the account wait only for credits to the same shard.
+    :param account: Account with balance_shards > 0
+    :param amount: Money in account currency
+    """
+    shard = random.randrange(account.balance_shards)
+    credited = AccountBalanceShard.objects.filter(account=account, shard=shard)\
+        .update(balance=F('balance') + amount)
+    if credited:
+        return
+    try:
+        with transaction.atomic():
+            AccountBalanceShard.objects.create(account=account, shard=shard, balance=amount)
+    except IntegrityError:
+        # Shard was created by a concurrent credit
+        AccountBalanceShard.objects.filter(account=account, shard=shard).update(balance=F('balance') + amount)
+
+
+def lock_shards(account):
+    """
+    Locks all balance shards of hot account, creating the missing ones, so credits to the account
+    wait for the end of the transaction
+    :param account: Account with balance_shards > 0
+    """
+    existing = set(AccountBalanceShard.objects.filter(account=account).values_list('shard', flat=True))
+    for shard in range(account.balance_shards):
+        if shard not in existing:
+            AccountBalanceShard.objects.get_or_create(account=account, shard=shard)
+    list(AccountBalanceShard.objects.select_for_update().filter(account=account).order_by('shard')
+         .values_list('pk', flat=True))
+
+
+def fold_shards(account):
+    """
+    Moves shard balances to the locked account row. Balance of account instance is not changed,
+    so the caller can change it after the whole transaction step succeeds.
+    :param account: Account locked by select_for_update
+    :return: folded amount
+    """
+    # All shards are locked, so credits in progress are committed before they are read
+    shards = list(AccountBalanceShard.objects.select_for_update().filter(account=account)
+                  .order_by('shard').values_list('pk', 'balance'))
+    folded = Money(sum(balance for pk, balance in shards))
+    if folded:
+        AccountBalanceShard.objects.filter(pk__in=[pk for pk, balance in shards if balance]).update(balance=0)
+        Account.objects.filter(pk=account.pk).update(balance=F('balance') + folded)
+    return folded
+
+
+def compact(account):
+    """
+    Folds balance shards of account and gives running balances to its ledger entries posted while
+    the account was sharded, in posted order.
+    :param account:
+    :return: tuple of folded amount and number of updated ledger entries
+    """
+    with transaction.atomic():
+        account = Account.objects.select_for_update().get(pk=account.pk)
+        # Credits committed before the shards are locked are folded together with their ledger entries
+        folded = fold_shards(account)
+        account.balance += folded
+
+        entries = LedgerEntry.objects.filter(account=account)
+        first = entries.filter(balance__isnull=True).order_by('posted', 'id').values_list('posted', 'id').first()
+        if first is None:
+            return folded, 0
+        pending = entries.filter(Q(posted__gt=first[0]) | Q(posted=first[0], id__gte=first[1]))\
+            .order_by('posted', 'id').values_list('id', 'amount')
+
+        # Balance before the first entry without running balance
+        balance = account.balance - Money(pending.aggregate(total=Sum('amount'))['total'] or 0)
+        running = []
+        for pk, amount in pending.iterator():
+            balance += amount
+            running.append((pk, balance))
+
+        for i in range(0, len(running), COMPACTION_CHUNK_SIZE):
+            chunk = running[i:i + COMPACTION_CHUNK_SIZE]
+            LedgerEntry.objects.filter(pk__in=[pk for pk, balance in chunk])\
+                .update(balance=Case(*[When(pk=pk, then=balance) for pk, balance in chunk],
+                                     output_field=MoneyField()))
+    return folded, len(running)
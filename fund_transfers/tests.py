@@ -1,4 +1,42 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, OperationalError
+from django.db.models import ProtectedError, QuerySet
+from django.db.migrations.state import ProjectState
+from django.test import TransactionTestCase
+from django.utils import timezone
+from rest_framework.validators import ValidationError
+
+from bank_api.db import check_persistent_connections
+from bank_api.idempotency import CacheIdempotencyStore, IdempotencyKeyInUse, IdempotencyMixin, idempotency_store
+from bank_api.instrumentation import QueryRecorder, request_metrics
 from registrations.tests import *
+from registrations.iban import Route, iban_index
+from registrations.money import to_major, to_money
+from notifications.models import Notification
+from .management.commands.convert_money import MONEY_FIELDS, column_type, float_field
+from .clearing import ClearingWorker, ingest_acknowledgement
+from .events import number_events, record_events
+from .models import FundTransfer, LedgerEntry, ApprovalBatch, DailyTurnover, TransferEvent, TransferEventConsumer, \
+    ClearingBatch
+from .pagination import KeysetPagination
+from .permissions import IsProperStatus
+from .settlement import settlement_engine
+from .shards import compact
+from .turnover import add_turnover, rebuild_turnover
+from .ledger import transfer_postings, backfill_ledger
 
 
 class BaseFundTransfersTestCase(BaseRegistrationsTestCase):
@@ -29,3 +67,1206 @@ class FundTransfersTestCase(BaseFundTransfersTestCase):
         }
         response = self.client.post(self.base_url, data=data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_approve_fund_transfer_moves_balances(self):
+        fund_transfer = FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                                    iban_beneficiary=self.account_1_customer_person.iban,
+                                                    amount=to_money(250), amount_bgn=to_money(250), currency=self.bgn,
+                                                    details='Test fund transfer', otp_generated='123456')
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.client.put(f'{self.base_url}{fund_transfer.pk}/',
+                                   data=self.approval_data(fund_transfer), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(Notification.objects.filter(to=self.manager.mobile_phone, status='P').exists())
+        self.account_1_customer_company.refresh_from_db()
+        self.account_1_customer_person.refresh_from_db()
+        self.assertEqual(self.account_1_customer_company.balance, to_money(11750))
+        self.assertEqual(self.account_1_customer_person.balance, to_money(1250))
+        self.assertEqual(FundTransfer.objects.get(pk=fund_transfer.pk).status, 'P')
+
+    def test_approve_fund_transfer_with_insufficient_balance_changes_nothing(self):
+        fund_transfer = FundTransfer.objects.create(user=self.person.user, account=self.account_1_customer_person,
+                                                    iban_beneficiary=self.account_1_customer_company.iban,
+                                                    amount=to_money(5000), amount_bgn=to_money(5000), currency=self.bgn,
+                                                    details='Test fund transfer', otp_generated='123456')
+        self.client.login(username=self.person.user.username, password='123')
+        response = self.client.put(f'{self.base_url}{fund_transfer.pk}/',
+                                   data=self.approval_data(fund_transfer), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Notification.objects.exists())
+        self.account_1_customer_company.refresh_from_db()
+        self.account_1_customer_person.refresh_from_db()
+        self.assertEqual(self.account_1_customer_person.balance, to_money(1000))
+        self.assertEqual(self.account_1_customer_company.balance, to_money(12000))
+        self.assertEqual(FundTransfer.objects.get(pk=fund_transfer.pk).status, 'I')
+
+    def test_create_internal_fund_transfer_to_other_bank_is_rejected(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        data = {
+            "iban_beneficiary": "BG80BNBG96611020345678",
+            "name_beneficiary": "Other bank",
+            "details": "Test fund transfer",
+            "amount": "250",
+            "currency": {"code": "BGN"},
+            "account": {"iban": self.account_1_customer_company.iban},
+            "payment_system": "I"
+        }
+        response = self.client.post(self.base_url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('iban_beneficiary', response.data)
+
+        data['payment_system'] = 'B'
+        response = self.client.post(self.base_url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_amount_more_precise_than_currency_is_rejected(self):
+        Currency.objects.create(code='JPY', name='Japanese yen', rate_to_bgn=Decimal('0.0118'), minor_unit=0)
+        self.client.login(username=self.manager.user.username, password='123')
+        data = {
+            "iban_beneficiary": self.account_1_customer_person.iban,
+            "name_beneficiary": "Peter Petrov",
+            "details": "Test fund transfer",
+            "amount": "250.50",
+            "currency": {"code": "JPY"},
+            "account": {"iban": self.account_1_customer_company.iban},
+            "payment_system": "I"
+        }
+        response = self.client.post(self.base_url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('amount', response.data)
+
+    def test_stale_route_is_not_credited(self):
+        fund_transfer = FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                                    iban_beneficiary=self.account_1_customer_person.iban,
+                                                    amount=to_money(250), amount_bgn=to_money(250), currency=self.bgn,
+                                                    details='Test fund transfer')
+        # Route to the account of another IBAN, as after a deletion in another worker process
+        iban_index.lookup([fund_transfer.iban_beneficiary])
+        iban_index._routes[fund_transfer.iban_beneficiary] = Route(self.account_2_customer_person.pk, self.eur.pk, 0)
+
+        with self.assertRaises(ValidationError):
+            settlement_engine.settle(fund_transfer, self.account_1_customer_company, fund_transfer.iban_beneficiary,
+                                     fund_transfer.amount_bgn)
+        self.assertEqual(Account.objects.get(pk=self.account_2_customer_person.pk).balance, to_money(2000, self.eur))
+        self.assertEqual(iban_index.get(fund_transfer.iban_beneficiary).account_id, self.account_1_customer_person.pk)
+
+    def test_edit_and_delete_after_concurrent_approval_should_fail(self):
+        fund_transfer = FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                                    iban_beneficiary=self.account_1_customer_person.iban,
+                                                    amount=to_money(250), amount_bgn=to_money(250), currency=self.bgn,
+                                                    details='Test fund transfer')
+        data = dict(self.approval_data(fund_transfer), status='I', pin_otp='', details='Edited')
+
+        def approve_after_check(permission, request, view, obj):
+            # Transfer is approved by a concurrent request after the status check
+            FundTransfer.objects.filter(pk=obj.pk).update(status='P')
+            return obj.status == 'I'
+
+        self.client.login(username=self.manager.user.username, password='123')
+        with mock.patch.object(IsProperStatus, 'has_object_permission', approve_after_check):
+            response = self.client.put(f'{self.base_url}{fund_transfer.pk}/', data=data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(FundTransfer.objects.get(pk=fund_transfer.pk).status, 'P')
+
+            FundTransfer.objects.filter(pk=fund_transfer.pk).update(status='I')
+            response = self.client.delete(f'{self.base_url}{fund_transfer.pk}/')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(FundTransfer.objects.get(pk=fund_transfer.pk).status, 'P')
+
+        FundTransfer.objects.filter(pk=fund_transfer.pk).update(status='I')
+        response = self.client.put(f'{self.base_url}{fund_transfer.pk}/', data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(FundTransfer.objects.get(pk=fund_transfer.pk).details, 'Edited')
+
+    @staticmethod
+    def approval_data(fund_transfer):
+        return {
+            "iban_beneficiary": fund_transfer.iban_beneficiary,
+            "name_beneficiary": "Beneficiary",
+            "details": fund_transfer.details,
+            "amount": to_major(fund_transfer.amount),
+            "currency": {"code": fund_transfer.currency.code},
+            "account": {"iban": fund_transfer.account.iban},
+            "payment_system": "I",
+            "status": "A",
+            "pin_otp": "0000" + fund_transfer.otp_generated,
+        }
+
+
+class IdempotencyTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        idempotency_store.clear()
+        self.data = {
+            "iban_beneficiary": self.account_1_customer_person.iban,
+            "name_beneficiary": "Peter Petrov",
+            "details": "Invoice 42",
+            "amount": "250",
+            "currency": {"code": "BGN"},
+            "account": {"iban": self.account_1_customer_company.iban},
+            "payment_system": "I"
+        }
+
+    def post(self, data, key):
+        return self.client.post(self.base_url, data=data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_create_is_replayed(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        first = self.post(self.data, 'create-1')
+        retry = self.post(self.data, 'create-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertEqual(FundTransfer.objects.count(), 1)
+
+        # Other key is another transfer
+        self.post(self.data, 'create-2')
+        self.assertEqual(FundTransfer.objects.count(), 2)
+
+    def test_key_reused_for_other_request_should_fail(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        self.post(self.data, 'create-1')
+        response = self.post(dict(self.data, amount='300'), 'create-1')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(FundTransfer.objects.count(), 1)
+
+    def test_duplicate_in_flight_should_fail(self):
+        request = mock.Mock(data=self.data)
+        idempotency_store.begin((self.manager.user.pk, 'POST', '/api/v1/fund_transfers/', 'create-1'),
+                                IdempotencyMixin.fingerprint(request))
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.post(self.data, 'create-1')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(FundTransfer.objects.exists())
+
+    def test_retry_served_by_other_worker_is_replayed(self):
+        # Worker processes share the store through a Django cache
+        CacheIdempotencyStore('default').clear()
+        self.client.login(username=self.manager.user.username, password='123')
+        with mock.patch('bank_api.idempotency.idempotency_store', CacheIdempotencyStore('default')):
+            first = self.post(self.data, 'create-1')
+        with mock.patch('bank_api.idempotency.idempotency_store', CacheIdempotencyStore('default')):
+            retry = self.post(self.data, 'create-1')
+            in_flight = CacheIdempotencyStore('default')
+            in_flight.begin('create-2', 'fingerprint')
+            with self.assertRaises(IdempotencyKeyInUse):
+                in_flight.begin('create-2', 'fingerprint')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertEqual(FundTransfer.objects.count(), 1)
+
+    def test_retried_approval_settles_once(self):
+        fund_transfer = FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                                    iban_beneficiary=self.account_1_customer_person.iban,
+                                                    amount=to_money(250), amount_bgn=to_money(250), currency=self.bgn,
+                                                    details='Test fund transfer', otp_generated='123456')
+        self.client.login(username=self.manager.user.username, password='123')
+        data = FundTransfersTestCase.approval_data(fund_transfer)
+        for _ in range(2):
+            response = self.client.put(f'{self.base_url}{fund_transfer.pk}/', data=data, format='json',
+                                       HTTP_IDEMPOTENCY_KEY='approve-1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(LedgerEntry.objects.filter(fund_transfer=fund_transfer).count(), 2)
+        self.assertEqual(Notification.objects.filter(to=self.manager.mobile_phone).count(), 1)
+        self.account_1_customer_company.refresh_from_db()
+        self.assertEqual(self.account_1_customer_company.balance, to_money(11750))
+
+    def test_failed_request_can_be_retried(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.post(dict(self.data, account={"iban": "BG80BNBG96611020345678"}), 'create-1')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        # Key is released and the corrected request is processed
+        self.assertEqual(self.post(self.data, 'create-1').status_code, status.HTTP_201_CREATED)
+
+
+class FundTransfersListTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.transfers = [
+            FundTransfer.objects.create(user=self.accountant.user, account=account,
+                                        iban_beneficiary=self.account_1_customer_person.iban,
+                                        amount=i + 1, amount_bgn=i + 1, currency=self.bgn, details=f'Transfer {i}')
+            for i, account in enumerate([self.account_1_customer_company, self.account_2_customer_company] * 3)
+        ]
+        self.client.login(username=self.manager.user.username, password='123')
+
+    def test_cursor_pages_cover_all_transfers_newest_first(self):
+        ids = []
+        url = self.base_url + '?page_size=4'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 4)
+            ids += [transfer['id'] for transfer in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(ids, sorted([transfer.id for transfer in self.transfers], reverse=True))
+
+    def test_cursor_pagination_keeps_filters(self):
+        account_id = self.account_2_customer_company.id
+        response = self.client.get(self.base_url, {'account_id': account_id, 'page_size': 2})
+        next_response = self.client.get(response.data['next'])
+        self.assertIsNone(next_response.data['next'])
+        self.assertEqual([transfer['account']['id'] for transfer in response.data['results'] + next_response.data['results']],
+                         [account_id] * 3)
+
+    def test_list_query_count_independent_of_rows(self):
+        self.client.get(self.base_url)
+        with CaptureQueriesContext(connection) as queries_before:
+            self.client.get(self.base_url)
+        for transfer in self.transfers:
+            transfer.pk = None
+            transfer.user_approved = self.manager.user
+            transfer.save()
+        with CaptureQueriesContext(connection) as queries_after:
+            response = self.client.get(self.base_url)
+        self.assertEqual(len(response.data['results']), len(self.transfers) * 2)
+        self.assertEqual(len(queries_before), len(queries_after))
+
+    def test_invalid_cursor_should_fail(self):
+        response = self.client.get(self.base_url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stream_returns_all_transfers(self):
+        with mock.patch.object(KeysetPagination, 'stream_chunk_size', 4):
+            response = self.client.get(self.base_url, {'stream': 'true'})
+            data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual([transfer['id'] for transfer in data],
+                         sorted([transfer.id for transfer in self.transfers], reverse=True))
+
+
+class FundTransfersBatchTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.batch_url = f'{self.base_url}batch/'
+        self.client.login(username=self.manager.user.username, password='123')
+
+    def line(self, amount='100', account_iban='BG97DJNG828020USD00015'):
+        return {
+            "iban_beneficiary": "BG79DJNG828042BGN00014",
+            "name_beneficiary": "Employee",
+            "details": "Salary",
+            "amount": amount,
+            "currency": {"code": "BGN"},
+            "account": {"iban": account_iban},
+            "payment_system": "I"
+        }
+
+    def test_batch_json_returns_results_per_line(self):
+        lines = [self.line(), self.line(amount='-1'), self.line(account_iban=self.account_1_customer_person.iban),
+                 self.line(amount='200')]
+        response = self.client.post(self.batch_url, data=lines, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['created', 'error', 'error', 'created'])
+        self.assertIn('amount', response.data['results'][1]['errors'])
+        self.assertIn('account', response.data['results'][2]['errors'])
+        self.assertEqual(sorted(FundTransfer.objects.values_list('amount', flat=True)), [to_money(100), to_money(200)])
+
+    def test_batch_csv(self):
+        content = (
+            'account_iban,iban_beneficiary,name_beneficiary,details,amount,currency_code,payment_system\n'
+            'BG97DJNG828020USD00015,BG79DJNG828042BGN00014,Employee 1,Salary,100,BGN,I\n'
+            'BG97DJNG828020USD00015,BG79DJNG828042BGN00014,Employee 2,Salary,150,XXX,I\n'
+        )
+        response = self.client.post(self.batch_url, data=content, content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertIn('currency', response.data['results'][1]['errors'])
+        self.assertEqual(FundTransfer.objects.get().name_beneficiary, 'Employee 1')
+
+    def test_batch_without_valid_lines_should_fail(self):
+        response = self.client.post(self.batch_url, data=[self.line(amount='-1')], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(FundTransfer.objects.exists())
+
+    def test_retried_batch_is_replayed(self):
+        idempotency_store.clear()
+        lines = [self.line(), self.line(amount='200')]
+        first = self.client.post(self.batch_url, data=lines, format='json', HTTP_IDEMPOTENCY_KEY='batch-1')
+        retry = self.client.post(self.batch_url, data=lines, format='json', HTTP_IDEMPOTENCY_KEY='batch-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data['results'], first.data['results'])
+        self.assertEqual(FundTransfer.objects.count(), 2)
+
+    def test_batch_query_count_independent_of_lines(self):
+        reference_data.currencies()
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(self.batch_url, data=[self.line()] * 2, format='json')
+        with CaptureQueriesContext(connection) as large:
+            self.client.post(self.batch_url, data=[self.line()] * 50, format='json')
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(FundTransfer.objects.count(), 52)
+
+
+class ApprovalBatchTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.batches_url = f'{self.base_url}approval_batches/'
+        self.fund_transfers = [
+            FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                        iban_beneficiary=self.account_1_customer_person.iban,
+                                        amount=to_money(amount), amount_bgn=to_money(amount), currency=self.bgn,
+                                        details='Supplier')
+            for amount in (5000, 7000, 5000, 5000)
+        ]
+        self.client.login(username=self.manager.user.username, password='123')
+
+    def create_batch(self):
+        response = self.client.post(self.batches_url, format='json',
+                                    data={'fund_transfers': [fund_transfer.pk for fund_transfer in self.fund_transfers]})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(f'http://127.0.0.1:8000/api/v1/notifications/send_otp/batch/{response.data["id"]}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return ApprovalBatch.objects.get()
+
+    def test_approve_batch_settles_transfers_with_results_per_transfer(self):
+        approval_batch = self.create_batch()
+        response = self.client.put(f'{self.batches_url}{approval_batch.pk}/', format='json',
+                                   data={'pin_otp': '0000' + approval_batch.otp_generated})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['processed', 'error', 'processed', 'error'])
+        self.assertEqual(response.data['results'][1]['errors'], ["Manager's limit per transfer exceeded!"])
+
+        self.account_1_customer_company.refresh_from_db()
+        self.account_1_customer_person.refresh_from_db()
+        self.assertEqual(self.account_1_customer_company.balance, to_money(2000))
+        self.assertEqual(self.account_1_customer_person.balance, to_money(11000))
+        self.assertEqual([fund_transfer.status for fund_transfer in FundTransfer.objects.order_by('pk')],
+                         ['P', 'I', 'P', 'I'])
+        self.assertEqual(FundTransfer.objects.get(pk=self.fund_transfers[2].pk).reference_cbs[-6:],
+                         f'{self.fund_transfers[2].pk:06d}')
+        self.assertEqual(LedgerEntry.objects.count(), 4)
+        self.assertEqual(ApprovalBatch.objects.get().status, 'P')
+
+    def test_approve_batch_with_invalid_otp_changes_nothing(self):
+        approval_batch = self.create_batch()
+        response = self.client.put(f'{self.batches_url}{approval_batch.pk}/', format='json', data={'pin_otp': '1'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(FundTransfer.objects.exclude(status='I').exists())
+        self.assertEqual(ApprovalBatch.objects.get().status, 'I')
+
+    def test_patch_batch_is_not_allowed(self):
+        approval_batch = self.create_batch()
+        response = self.client.patch(f'{self.batches_url}{approval_batch.pk}/', format='json', data={})
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        self.assertEqual(ApprovalBatch.objects.get().status, 'I')
+
+    def test_batch_with_foreign_transfer_should_fail(self):
+        foreign = FundTransfer.objects.create(user=self.person.user, account=self.account_1_customer_person,
+                                              iban_beneficiary=self.account_1_customer_company.iban,
+                                              amount=10, amount_bgn=10, currency=self.bgn, details='Foreign')
+        response = self.client.post(self.batches_url, format='json', data={'fund_transfers': [foreign.pk]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(ApprovalBatch.objects.exists())
+
+
+class TransferEventsTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.events_url = f'{self.base_url}events/'
+        self.client.login(username=self.manager.user.username, password='123')
+        self.data = {
+            "iban_beneficiary": self.account_1_customer_person.iban,
+            "name_beneficiary": "Peter Petrov",
+            "details": "Invoice 42",
+            "amount": "250",
+            "currency": {"code": "BGN"},
+            "account": {"iban": self.account_1_customer_company.iban},
+            "payment_system": "I"
+        }
+
+    def create_transfers(self, count):
+        ids = []
+        for _ in range(count):
+            response = self.client.post(self.base_url, data=self.data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            ids.append(response.data['id'])
+        FundTransfer.objects.filter(pk__in=ids).update(otp_generated='123456')
+        return list(FundTransfer.objects.filter(pk__in=ids).order_by('pk'))
+
+    def test_status_changes_are_logged_in_sequence(self):
+        approved, rejected, deleted = self.create_transfers(3)
+        response = self.client.put(f'{self.base_url}{approved.pk}/',
+                                   data=FundTransfersTestCase.approval_data(approved), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.put(f'{self.base_url}{rejected.pk}/',
+                                   data=dict(FundTransfersTestCase.approval_data(rejected), status='R'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.delete(f'{self.base_url}{deleted.pk}/').status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+        self.assertFalse(TransferEvent.objects.filter(sequence__isnull=False).exists())
+        self.assertEqual(number_events(), 6)
+        self.assertEqual(list(TransferEvent.objects.order_by('sequence').values_list('sequence', 'fund_transfer',
+                                                                                      'status')),
+                         [(1, approved.pk, 'I'), (2, rejected.pk, 'I'), (3, deleted.pk, 'I'), (4, approved.pk, 'P'),
+                          (5, rejected.pk, 'R'), (6, deleted.pk, 'D')])
+        self.assertFalse(TransferEvent.objects.exclude(user=self.manager.user).exists())
+
+    def test_batches_log_created_and_processed_transfers(self):
+        response = self.client.post(f'{self.base_url}batch/', data=[self.data, self.data], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        ids = [result['id'] for result in response.data['results']]
+        number_events()
+        self.assertEqual(list(TransferEvent.objects.order_by('sequence').values_list('fund_transfer', flat=True)),
+                         ids)
+
+        response = self.client.post(f'{self.base_url}approval_batches/', data={'fund_transfers': ids}, format='json')
+        approval_batch = ApprovalBatch.objects.get(pk=response.data['id'])
+        approval_batch.otp_generated = '123456'
+        approval_batch.save()
+        response = self.client.put(f'{self.base_url}approval_batches/{approval_batch.pk}/', format='json',
+                                   data={'pin_otp': '0000123456'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        number_events()
+        self.assertEqual(list(TransferEvent.objects.filter(sequence__gt=2).order_by('sequence')
+                              .values_list('fund_transfer', 'status')), [(ids[0], 'P'), (ids[1], 'P')])
+
+    def test_events_are_read_after_offset(self):
+        self.create_transfers(3)
+        # Events were numbered by an earlier read
+        number_events()
+        self.client.login(username=self.admin_user.username, password='123')
+        response = self.client.get(self.events_url + '?after=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response)
+        self.assertEqual([event['sequence'] for event in response.data['events']], [2, 3])
+        self.assertEqual(response.data['last_sequence'], 3)
+
+        response = self.client.get(self.events_url + '?after=3')
+        self.assertEqual(response.data['events'], [])
+        self.assertEqual(response.data['last_sequence'], 3)
+
+    def test_consumer_reads_after_committed_offset(self):
+        self.create_transfers(3)
+        self.client.login(username=self.admin_user.username, password='123')
+        consumer_url = f'{self.events_url}consumers/ledger-sync/'
+        response = self.client.get(self.events_url + '?consumer=ledger-sync&limit=2')
+        self.assertEqual([event['sequence'] for event in response.data['events']], [1, 2])
+
+        self.assertEqual(self.client.put(consumer_url, data={'offset': 2}, format='json').data['offset'], 2)
+        # Late commit of a lower offset does not move it back
+        self.assertEqual(self.client.put(consumer_url, data={'offset': 1}, format='json').data['offset'], 2)
+        response = self.client.get(self.events_url + '?consumer=ledger-sync')
+        self.assertEqual([event['sequence'] for event in response.data['events']], [3])
+
+        self.assertEqual(self.client.delete(consumer_url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(self.client.get(self.events_url + '?consumer=ledger-sync').data['events']), 3)
+
+    def test_events_are_numbered_in_commit_order(self):
+        first, second = self.create_transfers(2)
+        # Event of a transaction committed after the second one was numbered
+        TransferEvent.objects.filter(fund_transfer=first).delete()
+        self.assertEqual(number_events(), 1)
+        record_events([first], 'I')
+        self.assertEqual(number_events(), 1)
+        self.assertEqual(number_events(), 0)
+
+        self.client.login(username=self.admin_user.username, password='123')
+        response = self.client.get(self.events_url + '?after=1')
+        self.assertEqual([(event['sequence'], event['fund_transfer']) for event in response.data['events']],
+                         [(2, first.pk)])
+
+    def test_events_are_for_admins_only(self):
+        self.assertEqual(self.client.get(self.events_url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_tail_command_commits_consumer_offset(self):
+        self.create_transfers(2)
+        out = StringIO()
+        call_command('tail_transfer_events', consumer='audit', stdout=out)
+        self.assertEqual([json.loads(line)['sequence'] for line in out.getvalue().splitlines()], [1, 2])
+        self.assertEqual(TransferEventConsumer.objects.get(name='audit').offset, 2)
+
+        self.create_transfers(1)
+        out = StringIO()
+        call_command('tail_transfer_events', consumer='audit', stdout=out)
+        self.assertEqual([json.loads(line)['sequence'] for line in out.getvalue().splitlines()], [3])
+
+
+class ClearingTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.client.login(username=self.manager.user.username, password='123')
+        self.outbox = tempfile.TemporaryDirectory()
+        self.addCleanup(self.outbox.cleanup)
+
+    def approve_external(self, amount=100, payment_system='E'):
+        fund_transfer = FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                                    iban_beneficiary='DE89370400440532013000',
+                                                    bic_beneficiary='COBADEFF', amount=to_money(amount),
+                                                    amount_bgn=to_money(amount), currency=self.bgn,
+                                                    details='Invoice', otp_generated='123456',
+                                                    payment_system=payment_system)
+        data = dict(FundTransfersTestCase.approval_data(fund_transfer), payment_system=payment_system)
+        response = self.client.put(f'{self.base_url}{fund_transfer.pk}/', data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return FundTransfer.objects.get(pk=fund_transfer.pk)
+
+    def acknowledgement(self, batch, statuses):
+        transactions = ''.join(f'<TxInfAndSts><OrgnlEndToEndId>{reference}</OrgnlEndToEndId>'
+                               f'<TxSts>{transaction_status}</TxSts></TxInfAndSts>'
+                               for reference, transaction_status in statuses)
+        return StringIO(f'<?xml version="1.0" encoding="UTF-8"?>'
+                        f'<Document xmlns="urn:iso:std:iso:20022:tech:xsd:pain.002.001.03"><CstmrPmtStsRpt>'
+                        f'<OrgnlGrpInfAndSts><OrgnlMsgId>{batch.message_id}</OrgnlMsgId></OrgnlGrpInfAndSts>'
+                        f'<OrgnlPmtInfAndSts>{transactions}</OrgnlPmtInfAndSts></CstmrPmtStsRpt></Document>')
+
+    def test_external_transfer_is_debited_and_queued(self):
+        fund_transfer = self.approve_external()
+        self.assertEqual(fund_transfer.status, 'A')
+        self.assertIsNone(fund_transfer.clearing_batch)
+        self.account_1_customer_company.refresh_from_db()
+        self.assertEqual(self.account_1_customer_company.balance, to_money(11900))
+        self.assertEqual(TransferEvent.objects.get().status, 'A')
+
+    def test_internal_transfer_to_other_bank_should_fail(self):
+        fund_transfer = FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                                    iban_beneficiary='DE89370400440532013000', amount=to_money(100),
+                                                    amount_bgn=to_money(100), currency=self.bgn, details='Invoice',
+                                                    otp_generated='123456')
+        response = self.client.put(f'{self.base_url}{fund_transfer.pk}/',
+                                   data=FundTransfersTestCase.approval_data(fund_transfer), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.account_1_customer_company.refresh_from_db()
+        self.assertEqual(self.account_1_customer_company.balance, to_money(12000))
+
+    def test_queues_are_flushed_on_size_or_age(self):
+        queues = {'E': {'batch_size': 2, 'max_wait': 3600, 'service_level': 'SEPA'},
+                  'T': {'batch_size': 100, 'max_wait': 3600, 'service_level': 'URGP'}}
+        with self.settings(CLEARING_QUEUES=queues):
+            worker = ClearingWorker(outbox_dir=self.outbox.name)
+            sepa = [self.approve_external(), self.approve_external(200)]
+            target2 = self.approve_external(payment_system='T')
+            batch, = worker.run_once()
+
+            self.assertEqual(batch.payment_system, 'E')
+            self.assertEqual(batch.status, 'S')
+            self.assertEqual(set(batch.fund_transfers.all()), set(sepa))
+            with open(os.path.join(self.outbox.name, batch.file_name)) as f:
+                content = f.read()
+            self.assertIn(f'<MsgId>{batch.message_id}</MsgId>', content)
+            self.assertIn('<NbOfTxs>2</NbOfTxs>', content)
+            self.assertIn(f'<EndToEndId>{sepa[1].reference_cbs}</EndToEndId>', content)
+            self.assertIn('<InstdAmt Ccy="BGN">200.00</InstdAmt>', content)
+
+            # TARGET2 queue waits until it is old enough
+            self.assertEqual(worker.run_once(), [])
+            FundTransfer.objects.filter(pk=target2.pk).update(last_updated=timezone.now() - timedelta(hours=2))
+            batch, = worker.run_once()
+            self.assertEqual(list(batch.fund_transfers.all()), [target2])
+
+    def test_acknowledgement_settles_and_reverses_rejected(self):
+        accepted, rejected = self.approve_external(), self.approve_external(300)
+        batch, = ClearingWorker(outbox_dir=self.outbox.name).run_once(force=True)
+        result = ingest_acknowledgement(self.acknowledgement(batch, [(accepted.reference_cbs, 'ACSC'),
+                                                                     (rejected.reference_cbs, 'RJCT')]))
+        self.assertEqual(result, {'processed': 1, 'rejected': 1})
+        self.assertEqual(FundTransfer.objects.get(pk=accepted.pk).status, 'P')
+        self.assertEqual(FundTransfer.objects.get(pk=rejected.pk).status, 'E')
+        self.account_1_customer_company.refresh_from_db()
+        self.assertEqual(self.account_1_customer_company.balance, to_money(11900))
+        self.assertEqual(LedgerEntry.objects.filter(fund_transfer=rejected).order_by('pk').last().balance,
+                         to_money(11900))
+        self.assertEqual(ClearingBatch.objects.get().status, 'A')
+        self.assertEqual(list(TransferEvent.objects.filter(status__in=['P', 'E']).order_by('sequence')
+                              .values_list('fund_transfer', 'status')), [(accepted.pk, 'P'), (rejected.pk, 'E')])
+
+        # Report ingested again changes nothing
+        result = ingest_acknowledgement(self.acknowledgement(batch, [(rejected.reference_cbs, 'RJCT')]))
+        self.assertEqual(result, {'processed': 0, 'rejected': 0})
+        self.account_1_customer_company.refresh_from_db()
+        self.assertEqual(self.account_1_customer_company.balance, to_money(11900))
+
+
+class StatementTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.today = timezone.now().date().isoformat()
+
+    def settle(self, account, iban_beneficiary, amount_bgn):
+        amount_bgn = to_money(amount_bgn)
+        fund_transfer = FundTransfer.objects.create(user=self.manager.user, account=account,
+                                                    iban_beneficiary=iban_beneficiary, amount=amount_bgn,
+                                                    amount_bgn=amount_bgn, currency=self.bgn, details='Statement')
+        settlement_engine.settle(fund_transfer, account, iban_beneficiary, amount_bgn)
+        fund_transfer.status = 'P'
+        fund_transfer.save()
+        return fund_transfer
+
+    def get_statement(self, account, from_date, to_date):
+        return self.client.get(self.base_url + 'statement/',
+                               {'account_id': account.pk, 'from_date': from_date, 'to_date': to_date})
+
+    def test_statement_has_opening_and_closing_balances(self):
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+        self.settle(self.account_1_customer_person, self.account_1_customer_company.iban, 30)
+
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.get_statement(self.account_1_customer_company, self.today, self.today)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['opening_balance'], 12000)
+        self.assertEqual(response.data['closing_balance'], 11930)
+        self.assertEqual([(entry['amount_debit'], entry['amount_credit'], entry['balance'])
+                          for entry in response.data['entries']],
+                         [(100, 0, 11900), (0, 30, 11930)])
+
+    def test_statement_amounts_are_in_minor_units_of_account_currency(self):
+        kwd = Currency.objects.create(code='KWD', name='Kuwaiti dinar', rate_to_bgn=Decimal('5.71'), minor_unit=3)
+        Account.objects.filter(pk=self.account_1_customer_company.pk).update(currency=kwd, balance=1234567)
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.get_statement(self.account_1_customer_company, self.today, self.today)
+        self.assertEqual(response.data['opening_balance'], Decimal('1234.567'))
+        self.assertEqual([(entry['amount_debit'], entry['amount_credit'], entry['balance'])
+                          for entry in response.data['entries']],
+                         [(Decimal('17.513'), 0, Decimal('1217.054'))])
+
+    def test_statement_for_period_without_postings(self):
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.get_statement(self.account_1_customer_company, '2019-01-01', '2019-01-31')
+        self.assertEqual(response.data['opening_balance'], 12000)
+        self.assertEqual(response.data['closing_balance'], 12000)
+        self.assertEqual(response.data['entries'], [])
+
+        response = self.get_statement(self.account_1_customer_company, '2099-01-01', '2099-01-31')
+        self.assertEqual(response.data['opening_balance'], 11900)
+
+    def test_statement_of_foreign_account_should_fail(self):
+        self.client.login(username=self.person.user.username, password='123')
+        response = self.get_statement(self.account_1_customer_company, self.today, self.today)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_statement_export_csv(self):
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+        self.settle(self.account_1_customer_person, self.account_1_customer_company.iban, 30)
+
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.client.get(self.base_url + 'statement/', {
+            'account_id': self.account_1_customer_company.pk, 'from_date': self.today, 'to_date': self.today,
+            'export': 'csv'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'posted,fund_transfer,amount_debit,amount_credit,balance,reference_cbs,'
+                                   'name_beneficiary,details')
+        self.assertEqual([line.split(',')[2:5] for line in lines[1:]],
+                         [['100.00', '0.00', '11900.00'], ['0.00', '30.00', '11930.00']])
+
+    def test_statement_export_ndjson(self):
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.client.get(self.base_url + 'statement/', {
+            'account_id': self.account_1_customer_company.pk, 'from_date': self.today, 'to_date': self.today,
+            'export': 'ndjson'})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(lines[0]['opening_balance'], 12000)
+        self.assertEqual([(line['amount_debit'], line['amount_credit'], line['balance']) for line in lines[1:]],
+                         [(100, 0, 11900)])
+
+        response = self.client.get(self.base_url + 'statement/', {
+            'account_id': self.account_1_customer_company.pk, 'from_date': self.today, 'to_date': self.today,
+            'export': 'xlsx'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_backfill_ledger_from_processed_transfers(self):
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+        # Processed before the ledger existed
+        FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                    iban_beneficiary=self.account_1_customer_person.iban, amount=to_money(50),
+                                    amount_bgn=to_money(50),
+                                    currency=self.bgn, details='Old transfer', status='P')
+        FundTransfer.objects.filter(details='Old transfer').update(last_updated=timezone.now() - timedelta(days=1))
+
+        self.assertEqual(backfill_ledger(self.account_1_customer_company), 1)
+        self.assertEqual(backfill_ledger(self.account_1_customer_company), 0)
+        entries = LedgerEntry.objects.filter(account=self.account_1_customer_company).order_by('posted', 'id')
+        self.assertEqual([(entry.amount, entry.balance) for entry in entries],
+                         [(to_money(-50), to_money(12000)), (to_money(-100), to_money(11900))])
+
+    def test_backfill_ledger_of_sharded_account(self):
+        Account.objects.filter(pk=self.account_1_customer_person.pk).update(balance_shards=4)
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+        FundTransfer.objects.create(user=self.manager.user, account=self.account_1_customer_company,
+                                    iban_beneficiary=self.account_1_customer_person.iban, amount=to_money(50),
+                                    amount_bgn=to_money(50), currency=self.bgn, details='Old transfer', status='P')
+        FundTransfer.objects.filter(details='Old transfer').update(last_updated=timezone.now() - timedelta(days=1))
+
+        # Credit to the sharded account has no running balance until compaction
+        self.assertEqual(backfill_ledger(self.account_1_customer_person), 1)
+        entries = LedgerEntry.objects.filter(account=self.account_1_customer_person).order_by('posted', 'id')
+        self.assertEqual([(entry.amount, entry.balance) for entry in entries],
+                         [(to_money(50), to_money(1000)), (to_money(100), None)])
+
+    def test_transfer_with_postings_is_not_deleted(self):
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+        with self.assertRaises(ProtectedError):
+            FundTransfer.objects.get().delete()
+        self.assertEqual(LedgerEntry.objects.count(), 2)
+
+
+class TurnoverTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.today = timezone.localdate()
+
+    def settle(self, user, account, iban_beneficiary, amount_bgn):
+        amount_bgn = to_money(amount_bgn)
+        fund_transfer = FundTransfer.objects.create(user=user, account=account, iban_beneficiary=iban_beneficiary,
+                                                    amount=amount_bgn, amount_bgn=amount_bgn, currency=self.bgn,
+                                                    details='Turnover')
+        settlement_engine.settle(fund_transfer, account, iban_beneficiary, amount_bgn)
+
+    def get_report(self, **params):
+        params.setdefault('from_date', self.today.isoformat())
+        params.setdefault('to_date', self.today.isoformat())
+        return self.client.get(self.base_url + 'reports/turnover/', params)
+
+    def test_settlement_updates_daily_turnover(self):
+        self.settle(self.manager.user, self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+        self.settle(self.manager.user, self.account_1_customer_company, self.account_1_customer_person.iban, 50)
+        self.settle(self.person.user, self.account_1_customer_person, self.account_1_customer_company.iban, 30)
+
+        turnovers = DailyTurnover.objects.filter(day=self.today)
+        self.assertEqual(sorted((t.account_id, t.user_id, t.count, t.debit, t.credit) for t in turnovers), sorted([
+            (self.account_1_customer_company.pk, self.manager.user.pk, 2, to_money(150), 0),
+            (self.account_1_customer_person.pk, self.manager.user.pk, 2, 0, to_money(150)),
+            (self.account_1_customer_person.pk, self.person.user.pk, 1, to_money(30), 0),
+            (self.account_1_customer_company.pk, self.person.user.pk, 1, 0, to_money(30)),
+        ]))
+
+    def test_credits_to_sharded_account_are_spread_over_shard_rows(self):
+        Account.objects.filter(pk=self.account_1_customer_person.pk).update(balance_shards=4)
+        for _ in range(8):
+            self.settle(self.manager.user, self.account_1_customer_company, self.account_1_customer_person.iban, 10)
+
+        turnovers = DailyTurnover.objects.filter(account=self.account_1_customer_person)
+        self.assertTrue(all(0 <= turnover.shard < 4 for turnover in turnovers))
+        self.assertEqual(sum(turnover.count for turnover in turnovers), 8)
+        self.assertEqual(sum(turnover.credit for turnover in turnovers), to_money(80))
+        self.assertEqual(DailyTurnover.objects.get(account=self.account_1_customer_company).shard, 0)
+
+    def test_concurrently_created_turnover_is_updated(self):
+        key = {'day': self.today, 'account_id': self.account_1_customer_person.pk, 'user_id': self.manager.user.pk,
+               'shard': 0}
+        add_turnover(currency_id=self.bgn.pk, count=1, debit=0, credit=to_money(10), **key)
+        update = QuerySet.update
+        calls = []
+
+        def update_after_concurrent_insert(queryset, **kwargs):
+            calls.append(kwargs)
+            # First update runs before the row of a concurrent settlement is committed
+            return 0 if len(calls) == 1 else update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', update_after_concurrent_insert):
+            add_turnover(currency_id=self.bgn.pk, count=1, debit=0, credit=to_money(5), **key)
+        turnover = DailyTurnover.objects.get(**key)
+        self.assertEqual((turnover.count, turnover.credit), (2, to_money(15)))
+
+    def test_rebuild_turnover_from_ledger(self):
+        self.settle(self.manager.user, self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+        self.settle(self.person.user, self.account_1_customer_person, self.account_1_customer_company.iban, 30)
+        expected = sorted(DailyTurnover.objects.values_list('day', 'account', 'user', 'currency', 'count', 'debit',
+                                                            'credit'))
+        DailyTurnover.objects.update(count=0, debit=0, credit=0)
+
+        out = StringIO()
+        call_command('rebuild_turnover', stdout=out)
+        self.assertIn('4 daily turnovers created', out.getvalue())
+        self.assertEqual(sorted(DailyTurnover.objects.values_list('day', 'account', 'user', 'currency', 'count',
+                                                                  'debit', 'credit')), expected)
+
+    def test_rebuild_turnover_of_sharded_account(self):
+        Account.objects.filter(pk=self.account_1_customer_person.pk).update(balance_shards=4)
+        for _ in range(3):
+            self.settle(self.manager.user, self.account_1_customer_company, self.account_1_customer_person.iban, 10)
+        balance = Account.objects.get(pk=self.account_1_customer_person.pk).aggregated_balance
+
+        self.assertEqual(rebuild_turnover(self.account_1_customer_person), 1)
+        turnover = DailyTurnover.objects.get(account=self.account_1_customer_person)
+        self.assertEqual((turnover.count, turnover.credit), (3, to_money(30)))
+        # Missing shards are created to be locked, balance is not changed
+        self.assertEqual(AccountBalanceShard.objects.filter(account=self.account_1_customer_person).count(), 4)
+        self.assertEqual(Account.objects.get(pk=self.account_1_customer_person.pk).aggregated_balance, balance)
+
+    def test_turnover_report_by_account_and_user(self):
+        self.settle(self.manager.user, self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+        self.settle(self.person.user, self.account_1_customer_person, self.account_1_customer_company.iban, 30)
+
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.get_report()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response)
+        # Accounts of manager's customer only
+        self.assertEqual([(row['account'], row['currency'], row['count'], row['debit'], row['credit'])
+                          for row in response.data['results']],
+                         [(self.account_1_customer_company.iban, 'BGN', 2, 100, 30)])
+
+        response = self.get_report(group_by='user')
+        self.assertEqual([(row['user'], row['count'], row['debit'], row['credit'])
+                          for row in response.data['results']],
+                         [('manager', 1, 100, 0), (None, 1, 0, 30)])
+
+        response = self.get_report(from_date='2019-01-01', to_date='2019-12-31', group_by='month')
+        self.assertEqual(response.data['results'], [])
+
+    def test_turnover_report_of_accountant_has_own_accounts_only(self):
+        self.settle(self.accountant.user, self.account_1_customer_company, self.account_1_customer_person.iban, 100)
+
+        self.client.login(username=self.accountant.user.username, password='123')
+        response = self.get_report(user_id=self.accountant.user.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(row['account'], row['count'], row['debit'], row['credit'])
+                          for row in response.data['results']],
+                         [(self.account_1_customer_company.iban, 1, 100, 0)])
+
+    def test_turnover_report_with_invalid_parameters_should_fail(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        self.assertEqual(self.get_report(from_date='2019-13-01').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_report(group_by='customer').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ConvertMoneyTestCase(BaseFundTransfersTestCase):
+
+    def test_integer_money_columns_are_refused(self):
+        # Minor units of integer columns are lost already
+        with self.assertRaises(CommandError):
+            call_command('convert_money', stdout=StringIO())
+
+
+class ConvertFloatMoneyTestCase(TransactionTestCase):
+    """
+    Conversion of a database with money columns still float
+    """
+
+    def setUp(self):
+        eur = Currency.objects.create(code='EUR', name='Euro', rate_to_bgn=Decimal('1.95583'))
+        product = AccountProduct.objects.create(code='10CA', name='Current account', type='C',
+                                                description='Current account', interest_rate=0.1)
+        self.account = Account.objects.create(product=product, iban='BG84DJNG828010EUR00013', currency=eur)
+        user = User.objects.create_user('manager', 'manager@mail.bg', '123')
+        self.fund_transfer = FundTransfer.objects.create(user=user, account=self.account, currency=eur,
+                                                         iban_beneficiary='BG88DJNG828010BGN00012',
+                                                         details='Old transfer')
+        # Models with float money columns, SQLite rebuilds a table with all fields of the altering model
+        state = ProjectState.from_apps(django_apps)
+        for model, name in MONEY_FIELDS:
+            model_state = state.models[model._meta.app_label, model._meta.model_name]
+            model_state.fields = [(field_name, float_field(field) if field_name == name else field)
+                                  for field_name, field in model_state.fields]
+        with connection.schema_editor() as schema_editor:
+            for model, name in MONEY_FIELDS:
+                float_model = state.apps.get_model(model._meta.app_label, model._meta.model_name)
+                schema_editor.alter_field(float_model, model._meta.get_field(name), float_model._meta.get_field(name))
+
+    def select(self, model, *columns):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {", ".join(columns)} FROM {model._meta.db_table}')
+            return cursor.fetchone()
+
+    def test_convert_money_runs_once(self):
+        self.assertEqual(column_type(Account, Account._meta.get_field('balance')), 'FloatField')
+        # Major unit floats as stored before minor units
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {Account._meta.db_table} SET balance = 2000.5')
+            cursor.execute(f'UPDATE {FundTransfer._meta.db_table} SET amount = 10.25, amount_bgn = 20.05')
+
+        call_command('convert_money', stdout=StringIO())
+        call_command('convert_money', stdout=StringIO())
+
+        for model, name in MONEY_FIELDS:
+            self.assertEqual(column_type(model, model._meta.get_field(name)), 'BigIntegerField')
+        # Values are read from the bigint columns as they are stored
+        balance, = self.select(Account, 'balance')
+        amounts = self.select(FundTransfer, 'amount', 'amount_bgn')
+        self.assertEqual((balance, amounts), (200050, (1025, 2005)))
+        self.assertTrue(all(type(value) is int for value in (balance, ) + amounts))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+class FundTransferIndexesTestCase(BaseFundTransfersTestCase):
+    """
+    Statement and list queries should be index range scans
+    """
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.to_date = timezone.now()
+        self.from_date = self.to_date - timedelta(days=30)
+
+    def assertUsesIndex(self, queryset, *index_names):
+        plan = queryset.explain()
+        for index_name in index_names:
+            self.assertIn(f'USING INDEX {index_name}', plan)
+
+    def test_statement_uses_indexes(self):
+        queryset = transfer_postings(self.account_1_customer_company, self.from_date, self.to_date)
+        self.assertUsesIndex(queryset, 'ft_statement_credit_idx', 'ft_statement_debit_idx')
+
+    def test_customer_transfers_list_uses_index(self):
+        queryset = FundTransfer.objects.filter(account__customer=self.customer_company, created__gte=self.from_date)
+        self.assertUsesIndex(KeysetPagination.keyset(queryset), 'ft_account_created_idx')
+
+    def test_account_transfers_list_uses_index(self):
+        queryset = FundTransfer.objects.filter(account__pk=self.account_1_customer_company.pk,
+                                               created__gte=self.from_date, created__lte=self.to_date)
+        self.assertUsesIndex(KeysetPagination.keyset(queryset), 'ft_account_created_idx')
+
+    def test_accountant_transfers_list_uses_index(self):
+        queryset = FundTransfer.objects.filter(user__pk=self.accountant.user.pk, created__gte=self.from_date)
+        self.assertUsesIndex(KeysetPagination.keyset(queryset), 'ft_user_created_idx')
+
+
+class SettlementConcurrencyTestCase(TransactionTestCase):
+    """
+    Stress test for concurrent approvals between the same two accounts in both directions
+    """
+    threads = 4
+    settlements_per_thread = 25
+
+    def setUp(self):
+        bgn = Currency.objects.create(code='BGN', name='Bulgarian lev', rate_to_bgn=1)
+        product = AccountProduct.objects.create(code='10CA', name='Current account', type='C',
+                                                description='Current account', interest_rate=0.1)
+        self.account_a = Account.objects.create(product=product, iban='BG88DJNG828010BGN00012',
+                                                balance=100000, currency=bgn)
+        self.account_b = Account.objects.create(product=product, iban='BG84DJNG828010EUR00013',
+                                                balance=100000, currency=bgn)
+        user = User.objects.create_user('manager', 'manager@mail.bg', '123')
+        self.fund_transfers = {
+            account.pk: FundTransfer.objects.create(user=user, account=account, iban_beneficiary=account.iban,
+                                                    amount=1, amount_bgn=1, currency=bgn, details='Stress test')
+            for account in (self.account_a, self.account_b)
+        }
+
+    def settle_many(self, debit_account, iban_beneficiary, amount, settled):
+        try:
+            for _ in range(self.settlements_per_thread):
+                while True:
+                    try:
+                        settlement_engine.settle(self.fund_transfers[debit_account.pk], debit_account,
+                                                 iban_beneficiary, amount)
+                        break
+                    except OperationalError:
+                        # SQLite reports a locked table instead of waiting for it
+                        time.sleep(random.uniform(0, 0.005))
+                settled.append(amount)
+        finally:
+            connection.close()
+
+    def test_concurrent_settlements_lose_no_updates(self):
+        settled_a_to_b, settled_b_to_a = [], []
+        workers = []
+        for i in range(self.threads):
+            if i % 2:
+                args = (self.account_a, self.account_b.iban, 10, settled_a_to_b)
+            else:
+                args = (self.account_b, self.account_a.iban, 3, settled_b_to_a)
+            workers.append(threading.Thread(target=self.settle_many, args=args))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        expected_settlements = self.threads // 2 * self.settlements_per_thread
+        self.assertEqual(len(settled_a_to_b), expected_settlements)
+        self.assertEqual(len(settled_b_to_a), expected_settlements)
+
+        self.account_a.refresh_from_db()
+        self.account_b.refresh_from_db()
+        self.assertEqual(self.account_a.balance, 100000 - sum(settled_a_to_b) + sum(settled_b_to_a))
+        self.assertEqual(self.account_b.balance, 100000 + sum(settled_a_to_b) - sum(settled_b_to_a))
+
+        # Running balances in the ledger follow each other without gaps
+        for account in (self.account_a, self.account_b):
+            balance = 100000
+            for entry in LedgerEntry.objects.filter(account=account).order_by('id'):
+                balance += entry.amount
+                self.assertEqual(entry.balance, balance)
+            self.assertEqual(balance, account.balance)
+
+    def test_concurrent_credits_to_sharded_account(self):
+        Account.objects.filter(pk=self.account_b.pk).update(balance_shards=4)
+        self.account_b.refresh_from_db()
+        settled_a_to_b, settled_b_to_a = [], []
+        workers = [threading.Thread(target=self.settle_many, args=(self.account_a, self.account_b.iban, 10,
+                                                                    settled_a_to_b))
+                   for _ in range(self.threads)]
+        workers.append(threading.Thread(target=self.settle_many, args=(self.account_b, self.account_a.iban, 3,
+                                                                       settled_b_to_a)))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.account_b.refresh_from_db()
+        self.assertEqual(self.account_b.aggregated_balance, 100000 + sum(settled_a_to_b) - sum(settled_b_to_a))
+
+        compact(self.account_b)
+        self.account_b.refresh_from_db()
+        self.assertEqual(self.account_b.balance, 100000 + sum(settled_a_to_b) - sum(settled_b_to_a))
+        self.assertFalse(AccountBalanceShard.objects.filter(account=self.account_b).exclude(balance=0).exists())
+        balance = 100000
+        for entry in LedgerEntry.objects.filter(account=self.account_b).order_by('posted', 'id'):
+            balance += entry.amount
+            self.assertEqual(entry.balance, balance)
+
+
+class BalanceShardsTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.today = timezone.now().date().isoformat()
+        # Collection account of the company
+        self.account_1_customer_company.balance_shards = 4
+        self.account_1_customer_company.save()
+
+    def settle(self, account, iban_beneficiary, amount_bgn):
+        amount_bgn = to_money(amount_bgn)
+        fund_transfer = FundTransfer.objects.create(user=self.person.user, account=account,
+                                                    iban_beneficiary=iban_beneficiary, amount=amount_bgn,
+                                                    amount_bgn=amount_bgn, currency=self.bgn, details='Collection')
+        return settlement_engine.settle(fund_transfer, account, iban_beneficiary, amount_bgn)
+
+    def test_credits_go_to_shards(self):
+        for _ in range(3):
+            self.settle(self.account_1_customer_person, self.account_1_customer_company.iban, 100)
+
+        account = Account.objects.get(pk=self.account_1_customer_company.pk)
+        self.assertEqual(account.balance, to_money(12000))
+        self.assertEqual(account.aggregated_balance, to_money(12300))
+        self.assertEqual(sum(AccountBalanceShard.objects.filter(account=account).values_list('balance', flat=True)),
+                         to_money(300))
+
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.client.get(self.base_url + 'statement/', {
+            'account_id': account.pk, 'from_date': self.today, 'to_date': self.today})
+        self.assertEqual(response.data['opening_balance'], 12000)
+        self.assertEqual(response.data['closing_balance'], 12300)
+        self.assertEqual([entry['balance'] for entry in response.data['entries']], [None, None, None])
+
+        response = self.client.get(f'http://127.0.0.1:8000/api/v1/registrations/accounts/{account.pk}/')
+        self.assertEqual(response.data['balance'], 12300)
+
+    def test_debit_is_checked_against_aggregated_balance(self):
+        self.settle(self.account_1_customer_person, self.account_1_customer_company.iban, 500)
+
+        # Needs the credit in shards
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 12400)
+        account = Account.objects.get(pk=self.account_1_customer_company.pk)
+        self.assertEqual(account.balance, to_money(100))
+        self.assertEqual(account.aggregated_balance, to_money(100))
+
+        with self.assertRaises(ValidationError):
+            self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 101)
+
+    def test_compaction_sets_running_balances(self):
+        self.settle(self.account_1_customer_person, self.account_1_customer_company.iban, 100)
+        self.settle(self.account_1_customer_company, self.account_1_customer_person.iban, 30)
+        self.settle(self.account_1_customer_person, self.account_1_customer_company.iban, 50)
+
+        out = StringIO()
+        call_command('compact_balance_shards', stdout=out)
+        self.assertIn('150.00 BGN folded, 3 ledger entries balanced', out.getvalue())
+
+        account = Account.objects.get(pk=self.account_1_customer_company.pk)
+        self.assertEqual(account.balance, to_money(12120))
+        entries = LedgerEntry.objects.filter(account=account).order_by('posted', 'id')
+        self.assertEqual([entry.balance for entry in entries], [to_money(12100), to_money(12070), to_money(12120)])
+
+
+class DatabaseProfileTestCase(BaseFundTransfersTestCase):
+    """
+    Settlement and statement tests above run on the configured backend:
+    DATABASE_ENGINE=postgresql python manage.py test runs them on PostgreSQL
+    """
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite PRAGMAs')
+    def test_sqlite_pragmas_are_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+            cursor.execute('PRAGMA synchronous')
+            # NORMAL
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_unusable_persistent_connection_is_closed_before_request(self):
+        broken = mock.Mock(connection=object(), settings_dict={'CONN_MAX_AGE': 60}, in_atomic_block=False)
+        broken.is_usable.return_value = False
+        healthy = mock.Mock(connection=object(), settings_dict={'CONN_MAX_AGE': 60}, in_atomic_block=False)
+        healthy.is_usable.return_value = True
+        with mock.patch('bank_api.db.connections') as connections:
+            connections.all.return_value = [broken, healthy]
+            check_persistent_connections()
+        broken.close.assert_called_once_with()
+        healthy.close.assert_not_called()
+
+
+class PerformanceInstrumentationTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fund_transfer = FundTransfer.objects.create(
+            user=self.manager.user, account=self.account_1_customer_company,
+            iban_beneficiary=self.account_1_customer_person.iban, bic_beneficiary='DJNG8280',
+            bank_beneficiary='Django Bank', name_beneficiary='Peter Petrov', details='Invoice 1',
+            amount=to_money(250), amount_bgn=to_money(250), currency=self.bgn)
+        self.metrics_url = 'http://127.0.0.1:8000/api/v1/metrics/'
+        request_metrics.reset()
+
+    def test_fund_transfers_endpoints_within_query_budget(self):
+        today = timezone.now().date().isoformat()
+        self.client.login(username=self.manager.user.username, password='123')
+        for url in ('', f'{self.fund_transfer.pk}/', 'approval_batches/',
+                    f'statement/?account_id={self.account_1_customer_company.pk}&from_date={today}&to_date={today}'):
+            response = self.client.get(self.base_url + url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertWithinQueryBudget(response)
+
+        response = self.client.get(f'http://127.0.0.1:8000/api/v1/notifications/send_otp/{self.fund_transfer.pk}/')
+        self.assertWithinQueryBudget(response)
+
+    def test_metrics_are_aggregated_per_url_name(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        for _ in range(3):
+            self.client.get(self.base_url)
+        response = self.client.get(self.metrics_url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.login(username=self.admin_user.username, password='123')
+        response = self.client.get(self.metrics_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['transfers']['count'], 3)
+        self.assertGreater(response.data['transfers']['queries']['max'], 0)
+        self.assertEqual(sum(response.data['transfers']['wall_ms']['buckets'].values()), 3)
+
+        response = self.client.delete(self.metrics_url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertNotIn('transfers', request_metrics.snapshot())
+
+    def test_repeated_queries_are_counted_as_duplicates(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for account in (self.account_1_customer_person, self.account_2_customer_person):
+                list(Account.objects.filter(pk=account.pk))
+            list(Currency.objects.all())
+        self.assertEqual(recorder.count, 3)
+        self.assertEqual(recorder.duplicates, 1)
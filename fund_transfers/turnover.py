@@ -0,0 +1,122 @@
+import random
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, CharField, Count, F, Q, Sum, When
+from django.db.models.functions import TruncDate, TruncMonth
+from django.utils import timezone
+
+from registrations.models import Account
+from registrations.money import Money, MoneyField
+from .models import DailyTurnover, LedgerEntry
+from .shards import lock_shards
+
+# Report grouping: name of the output key and field of DailyTurnover
+TURNOVER_GROUPS = {
+    'account': ('account', F('account__iban')),
+    'user': ('user', F('user__username')),
+    'day': ('day', F('day')),
+    'month': ('month', TruncMonth('day')),
+}
+
+
+def add_turnover(day, account_id, user_id, shard, currency_id, count, debit, credit):
+    """
+    Adds totals to the daily turnover row, creating it if it does not exist yet
+    """
+    turnover = DailyTurnover.objects.filter(day=day, account_id=account_id, user_id=user_id, shard=shard)
+    changes = {'count': F('count') + count, 'debit': F('debit') + debit, 'credit': F('credit') + credit}
+    if turnover.update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            DailyTurnover.objects.create(day=day, account_id=account_id, user_id=user_id, shard=shard,
+                                         currency_id=currency_id, count=count, debit=debit, credit=credit)
+    except IntegrityError:
+        # Row was created by a concurrent settlement
+        turnover.update(**changes)
+
+
+def record_turnover(entries):
+    """
+    Adds ledger entries of a settlement to daily turnovers, in the settlement transaction,
+    so turnovers are committed together with the balances.
+    Credits to sharded accounts are posted without the account lock, they go to a random shard row,
+    so concurrent credits to a hot account do not wait for one turnover row.
+    :param entries: created LedgerEntry instances
+    """
+    rollups = {}
+    for entry in entries:
+        shard = 0
+        if entry.account.balance_shards and entry.amount > 0:
+            shard = random.randrange(entry.account.balance_shards)
+        key = (timezone.localdate(entry.posted), entry.account.pk, entry.fund_transfer.user_id, shard)
+        count, debit, credit, currency_id = rollups.get(key, (0, Money(0), Money(0), entry.account.currency_id))
+        if entry.amount < 0:
+            debit -= entry.amount
+        else:
+            credit += entry.amount
+        rollups[key] = count + 1, debit, credit, currency_id
+
+    for (day, account_id, user_id, shard), (count, debit, credit, currency_id) in sorted(rollups.items()):
+        add_turnover(day, account_id, user_id, shard, currency_id, count, debit, credit)
+
+
+def rebuild_turnover(account):
+    """
+    Recalculates daily turnovers of account from its ledger entries.
+    Account row is locked, and balance shards of a hot account too, as its credits do not lock the account,
+    so settlements of the account wait for the rebuild.
+    :param account:
+    :return: number of created daily turnovers
+    """
+    with transaction.atomic():
+        account = Account.objects.select_for_update().get(pk=account.pk)
+        if account.balance_shards:
+            lock_shards(account)
+        DailyTurnover.objects.filter(account=account).delete()
+
+        rollups = LedgerEntry.objects.filter(account=account)\
+            .annotate(day=TruncDate('posted'))\
+            .values('day', 'fund_transfer__user')\
+            .annotate(count=Count('id'),
+                      debit=Sum(Case(When(amount__lt=0, then=-F('amount')), default=0, output_field=MoneyField())),
+                      credit=Sum(Case(When(amount__gt=0, then=F('amount')), default=0, output_field=MoneyField())))\
+            .order_by('day', 'fund_transfer__user')
+
+        turnovers = [DailyTurnover(day=rollup['day'], account=account, user_id=rollup['fund_transfer__user'],
+                                   currency_id=account.currency_id, count=rollup['count'],
+                                   debit=rollup['debit'], credit=rollup['credit'])
+                     for rollup in rollups]
+        DailyTurnover.objects.bulk_create(turnovers)
+    return len(turnovers)
+
+
+def turnover_report(turnovers, from_date, to_date, group_by='account', customer=None):
+    """
+    Period totals from daily turnovers, one row per group and currency
+    :param turnovers: DailyTurnover queryset visible to the user
+    :param from_date: first day of period
+    :param to_date: last day of period
+    :param group_by: one of TURNOVER_GROUPS
+    :param customer: Customer of the user, postings initiated by users of other customers are reported
+    with user None
+    :return: list of dicts with totals in major units
+    """
+    key, expression = TURNOVER_GROUPS[group_by]
+    if group_by == 'user' and customer is not None:
+        expression = Case(When(Q(user__person__customer=customer) | Q(user__manager__customer=customer) |
+                               Q(user__accountant__customer=customer), then=expression),
+                          default=None, output_field=CharField())
+    rows = turnovers.filter(day__gte=from_date, day__lte=to_date)\
+        .annotate(group=expression)\
+        .values('group', 'currency__code', 'currency__minor_unit')\
+        .annotate(total_count=Sum('count'), total_debit=Sum('debit'), total_credit=Sum('credit'))\
+        .order_by(F('group').asc(nulls_last=True), 'currency__code')
+
+    return [{
+        key: row['group'],
+        'currency': row['currency__code'],
+        'count': row['total_count'],
+        'debit': Money(row['total_debit']).to_major(row['currency__minor_unit']),
+        'credit': Money(row['total_credit']).to_major(row['currency__minor_unit']),
+    } for row in rows]
@@ -5,4 +5,11 @@ urlpatterns = [
     path('', views.FundTransfersList.as_view(), name='transfers'),
     path('<int:pk>/', views.FundTransfersDetail.as_view(), name='transfers_details'),
     path('statement/', views.StatementList.as_view(), name='statement'),
+    path('batch/', views.FundTransfersBatch.as_view(), name='transfers_batch'),
+    path('approval_batches/', views.ApprovalBatchList.as_view(), name='approval_batches'),
+    path('approval_batches/<int:pk>/', views.ApprovalBatchDetail.as_view(), name='approval_batch_details'),
+    path('reports/turnover/', views.TurnoverReport.as_view(), name='turnover_report'),
+    path('events/', views.TransferEventList.as_view(), name='transfer_events'),
+    path('events/consumers/<str:name>/', views.TransferEventConsumerDetail.as_view(),
+         name='transfer_event_consumer'),
 ]
\ No newline at end of file
@@ -1,22 +1,53 @@
+from collections import OrderedDict
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db.models import F, Value, FloatField
-from rest_framework import generics
-from rest_framework.permissions import IsAuthenticated
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework import generics, status, views
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.validators import ValidationError
 
-from .models import FundTransfer
-from .serializers import FundTransferSerializer, FundTransferDetailSerializer, StatementSerializer
+from .events import commit_offset, read_events, record_events
+from .exports import StatementExport
+from .ledger import get_opening_balance, get_statement
+from .models import FundTransfer, ApprovalBatch, DailyTurnover, TransferEvent, TransferEventConsumer
+from .parsers import FundTransfersCSVParser
+from .settlement import settlement_engine
+from .serializers import FundTransferSerializer, FundTransferDetailSerializer, FundTransferBatchLineSerializer, \
+    ApprovalBatchSerializer, ApprovalBatchDetailSerializer, StatementSerializer, TransferEventSerializer, \
+    TransferEventConsumerSerializer
+from .pagination import KeysetPagination
 from .permissions import IsFundTransferAccountOwner, IsProperStatus
+from .turnover import TURNOVER_GROUPS, turnover_report
 
-from registrations.utils import ExtendedTools
+from bank_api.idempotency import IdempotencyMixin
+from registrations.utils import ExtendedTools, OptimizedQuerysetMixin
 from registrations.models import Accountant, Manager, Person, Account
+from registrations.money import to_bgn, to_major, to_money
+from registrations.reference import conversion_currencies
 from registrations.permissions import IsManager, IsPerson
 
 
-class FundTransfersList(ExtendedTools, generics.ListCreateAPIView):
+class FundTransfersList(IdempotencyMixin, ExtendedTools, OptimizedQuerysetMixin, generics.ListCreateAPIView):
     # Authenticated users only
     permission_classes = [IsAuthenticated]
 
     serializer_class = FundTransferSerializer
+    pagination_class = KeysetPagination
+
+    def list(self, request, *args, **kwargs):
+        # Opt-in streaming of all filtered transfers as one JSON array
+        if request.query_params.get('stream') in ('1', 'true'):
+            queryset = self.filter_queryset(self.get_queryset())
+            return StreamingHttpResponse(self.paginator.stream(queryset, self.get_serializer),
+                                         content_type='application/json')
+        return super().list(request, *args, **kwargs)
 
     def get_queryset(self):
         query_set = FundTransfer.objects.all()
@@ -59,7 +90,7 @@ class FundTransfersList(ExtendedTools, generics.ListCreateAPIView):
         return query_set
 
 
-class FundTransfersDetail(ExtendedTools, generics.RetrieveUpdateDestroyAPIView):
+class FundTransfersDetail(IdempotencyMixin, ExtendedTools, generics.RetrieveUpdateDestroyAPIView):
     # Authenticated users with rights for account, no Accountants and only Initiated FTs
     permission_classes = [IsAuthenticated, IsFundTransferAccountOwner, IsManager | IsPerson, IsProperStatus]
 
@@ -79,44 +110,291 @@ class FundTransfersDetail(ExtendedTools, generics.RetrieveUpdateDestroyAPIView):
 
         return query_set
 
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            # Status was checked before the lock, the transfer may have been processed since
+            settlement_engine.claim(instance, to_status='I')
+            record_events([instance], TransferEvent.DELETED, user=self.request.user)
+            instance.delete()
+
 
 class StatementList(generics.ListAPIView):
     permission_classes = [IsAuthenticated, ]
 
     serializer_class = StatementSerializer
 
-    def get_queryset(self):
+    def list(self, request, *args, **kwargs):
 
         account_id = self.request.query_params.get('account_id', None)
         from_date = self.request.query_params.get('from_date', None)
         to_date = self.request.query_params.get('to_date', None)
 
         if account_id is None or from_date is None or to_date is None:
-            return []
-
-        to_date = to_date + ' 23:59:59'
-
-        account = get_object_or_404(Account, pk=account_id, users__pk=self.request.user.id)
-
-        # Credit transfers query for account
-        query_credits = FundTransfer.objects.filter(iban_beneficiary=account.iban,
-                                                    last_updated__gte=from_date,
-                                                    last_updated__lte=to_date,
-                                                    status='P'
-                                                    ).values(
-            'id', 'last_updated', 'reference_cbs', 'name_beneficiary', 'details',
-            amount_debit=Value(0, FloatField()), amount_credit=F('amount_bgn') / account.currency.rate_to_bgn
-        )
-        # Debit transfers query for account
-        query_debits = FundTransfer.objects.filter(account__pk=account.id,
-                                                   last_updated__gte=from_date,
-                                                   last_updated__lte=to_date,
-                                                   status='P'
-                                                   ).values(
-            'id', 'last_updated', 'reference_cbs', 'name_beneficiary', 'details',
-            amount_debit=F('amount_bgn') / account.currency.rate_to_bgn, amount_credit=Value(0, FloatField())
-        )
-
-        query_all = query_credits.union(query_debits).order_by('last_updated')
-
-        return query_all
+            raise ValidationError('account_id, from_date and to_date are required!')
+
+        from_date, to_date = self.get_period(from_date, to_date)
+
+        account = get_object_or_404(Account.objects.select_related('currency'),
+                                    pk=account_id, users__pk=self.request.user.id)
+
+        # Large periods are exported as a stream of CSV or JSON lines
+        export_format = self.request.query_params.get('export')
+        if export_format is not None:
+            return self.export(account, from_date, to_date, export_format)
+
+        opening_balance, closing_balance, entries = get_statement(account, from_date, to_date)
+        serializer = self.get_serializer(entries.select_related('fund_transfer'), many=True)
+        serializer.context['currency'] = account.currency
+
+        return Response(OrderedDict([
+            ('account', account.iban),
+            ('currency', account.currency.code),
+            ('opening_balance', to_major(opening_balance, account.currency)),
+            ('closing_balance', to_major(closing_balance, account.currency)),
+            ('entries', serializer.data),
+        ]))
+
+    @staticmethod
+    def export(account, from_date, to_date, export_format):
+        if export_format not in StatementExport.formats:
+            raise ValidationError(f'export should be one of {", ".join(StatementExport.formats)}!')
+
+        statement_export = StatementExport(account, from_date, to_date, get_opening_balance(account, from_date))
+        response = StreamingHttpResponse(getattr(statement_export, export_format)(),
+                                         content_type=StatementExport.formats[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{statement_export.filename(export_format)}"'
+        return response
+
+    @staticmethod
+    def get_period(from_date, to_date):
+        """
+        Converts from_date and to_date query parameters to the first and the last moment of the period
+        :param from_date: YYYY-MM-DD
+        :param to_date: YYYY-MM-DD
+        :return: tuple of aware datetimes
+        """
+        try:
+            from_date, to_date = parse_date(from_date), parse_date(to_date)
+        except ValueError:
+            from_date = None
+        if from_date is None or to_date is None:
+            raise ValidationError('Dates should be in YYYY-MM-DD format!')
+        return (timezone.make_aware(datetime.combine(from_date, time.min)),
+                timezone.make_aware(datetime.combine(to_date, time.max)))
+
+
+class FundTransfersBatch(IdempotencyMixin, ExtendedTools, views.APIView):
+    """
+    Batch submission of fund transfers (payment / payroll files) as JSON list or CSV.
+    Accounts and currencies of all lines are resolved with one lookup each,
+    valid lines are inserted in chunks and results are returned per line.
+    """
+    permission_classes = [IsAuthenticated, ]
+    parser_classes = [JSONParser, FundTransfersCSVParser]
+
+    def post(self, request):
+        # Own handler overrides IdempotencyMixin.post, so the key is checked explicitly
+        return self.idempotent(self.create_batch, request)
+
+    def create_batch(self, request):
+        lines = request.data
+        if not isinstance(lines, list) or not lines:
+            raise ValidationError('List of fund transfers expected!')
+        max_lines = getattr(settings, 'FUND_TRANSFER_BATCH_MAX_LINES', 10000)
+        if len(lines) > max_lines:
+            raise ValidationError(f'Batch should contain up to {max_lines} fund transfers!')
+
+        lines_data = []
+        for line in lines:
+            serializer = FundTransferBatchLineSerializer(data=line)
+            serializer.is_valid()
+            lines_data.append((serializer.validated_data, serializer.errors))
+
+        # One query for the source accounts and one for the currencies of all lines
+        ibans = {line_data['account']['iban'] for line_data, errors in lines_data if not errors}
+        accounts = {account.iban: account for account in
+                    Account.objects.filter(iban__in=ibans, users__pk=request.user.id)}
+        currencies = conversion_currencies(line_data['currency']['code'] for line_data, errors in lines_data
+                                           if not errors)
+
+        results = []
+        fund_transfers = []
+        for number, (line_data, errors) in enumerate(lines_data, start=1):
+            if not errors:
+                account = accounts.get(line_data.pop('account')['iban'])
+                currency = currencies.get(line_data.pop('currency')['code'])
+                if account is None:
+                    errors = {'account': ['Account not found!']}
+                elif currency is None:
+                    errors = {'currency': ['Currency not found!']}
+
+            if errors:
+                results.append({'line': number, 'status': 'error', 'errors': errors})
+                continue
+
+            line_data['amount'] = to_money(line_data['amount'], currency)
+            fund_transfers.append(FundTransfer(user=request.user, account=account, currency=currency,
+                                               amount_bgn=to_bgn(line_data['amount'], currency), **line_data))
+            results.append({'line': number, 'status': 'created'})
+
+        with transaction.atomic():
+            if connection.features.can_return_ids_from_bulk_insert:
+                # Primary keys are set by bulk insert (PostgreSQL)
+                FundTransfer.objects.bulk_create(fund_transfers,
+                                                 batch_size=getattr(settings, 'FUND_TRANSFER_BATCH_CHUNK_SIZE', 1000))
+            elif connection.vendor == 'sqlite':
+                FundTransfer.objects.bulk_create(fund_transfers,
+                                                 batch_size=getattr(settings, 'FUND_TRANSFER_BATCH_CHUNK_SIZE', 1000))
+                # SQLite locks the whole database from the insert until commit,
+                # so the last rows of the user are the inserted ones
+                ids = FundTransfer.objects.filter(user__pk=request.user.pk).order_by('-pk')\
+                    .values_list('pk', flat=True)[:len(fund_transfers)]
+                for fund_transfer, fund_transfer_id in zip(fund_transfers, reversed(list(ids))):
+                    fund_transfer.pk = fund_transfer_id
+            else:
+                # Concurrent inserts of other transactions may interleave, rows are inserted one by one
+                for fund_transfer in fund_transfers:
+                    fund_transfer.save(force_insert=True)
+            record_events(fund_transfers, 'I', user=request.user)
+
+        created = iter(fund_transfers)
+        for result in results:
+            if result['status'] == 'created':
+                result['id'] = next(created).pk
+
+        return Response({'created': len(fund_transfers), 'failed': len(results) - len(fund_transfers),
+                         'results': results},
+                        status=status.HTTP_201_CREATED if fund_transfers else status.HTTP_400_BAD_REQUEST)
+
+
+class ApprovalBatchList(IdempotencyMixin, generics.ListCreateAPIView):
+    # Managers and persons approving transfers from their accounts
+    permission_classes = [IsAuthenticated, IsManager | IsPerson]
+
+    serializer_class = ApprovalBatchSerializer
+
+    def get_queryset(self):
+        return ApprovalBatch.objects.filter(user__pk=self.request.user.pk).prefetch_related('fund_transfers')
+
+
+class ApprovalBatchDetail(IdempotencyMixin, generics.RetrieveUpdateAPIView):
+    """
+    PUT with pin_otp approves and settles all fund transfers of the batch
+    """
+    permission_classes = [IsAuthenticated, IsManager | IsPerson]
+    # Approval needs pin_otp, so partial updates are not allowed
+    http_method_names = ['get', 'put', 'head', 'options']
+
+    serializer_class = ApprovalBatchDetailSerializer
+
+    def get_queryset(self):
+        return ApprovalBatch.objects.filter(user__pk=self.request.user.pk)
+
+
+class TurnoverReport(ExtendedTools, views.APIView):
+    """
+    Debit and credit totals with number of postings for a period from daily turnovers,
+    grouped by account, user, day or month (group_by parameter) and currency
+    """
+    permission_classes = [IsAuthenticated, ]
+
+    def get(self, request):
+        try:
+            from_date = parse_date(request.query_params.get('from_date', ''))
+            to_date = parse_date(request.query_params.get('to_date', ''))
+        except ValueError:
+            from_date = None
+        if from_date is None or to_date is None:
+            raise ValidationError('from_date and to_date are required in YYYY-MM-DD format!')
+
+        group_by = request.query_params.get('group_by', 'account')
+        if group_by not in TURNOVER_GROUPS:
+            raise ValidationError(f'group_by should be one of {", ".join(TURNOVER_GROUPS)}!')
+
+        turnovers = DailyTurnover.objects.all()
+        customer = None
+        if not request.user.is_staff:
+            extended_user = self.get_extended_user(user=request.user)
+
+            # Accountants see postings they initiated on their own accounts, so the credit leg
+            # of a transfer to another account is not counted twice
+            if isinstance(extended_user, Accountant):
+                turnovers = turnovers.filter(user__pk=request.user.pk, account__users__pk=request.user.pk)
+            elif isinstance(extended_user, Manager) or isinstance(extended_user, Person):
+                turnovers = turnovers.filter(account__customer=extended_user.customer)
+                customer = extended_user.customer
+            else:
+                turnovers = turnovers.none()
+
+        for key in ('account_id', 'user_id'):
+            value = request.query_params.get(key)
+            if value is not None:
+                try:
+                    turnovers = turnovers.filter(**{key: int(value)})
+                except ValueError:
+                    raise ValidationError(f'{key} should be a number!')
+
+        return Response(OrderedDict([
+            ('from_date', from_date),
+            ('to_date', to_date),
+            ('group_by', group_by),
+            ('results', turnover_report(turnovers, from_date, to_date, group_by, customer=customer)),
+        ]))
+
+
+class TransferEventList(views.APIView):
+    """
+    Fund transfer status changes after a sequence number (after parameter) or after the offset
+    committed by a consumer (consumer parameter), oldest first
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        params = {}
+        for key in ('after', 'limit', 'account_id'):
+            value = request.query_params.get(key)
+            if value is not None:
+                try:
+                    params[key] = int(value)
+                except ValueError:
+                    raise ValidationError(f'{key} should be a number!')
+
+        consumer = request.query_params.get('consumer')
+        if consumer is not None:
+            if 'after' in params:
+                raise ValidationError('after and consumer should not be used together!')
+            params['after'] = TransferEventConsumer.objects.filter(name=consumer)\
+                .values_list('offset', flat=True).first() or 0
+
+        after = params.pop('after', 0)
+        max_limit = getattr(settings, 'TRANSFER_EVENTS_PAGE_SIZE', 500)
+        limit = min(max(params.pop('limit', max_limit), 1), max_limit)
+        events = read_events(after=after, limit=limit, **params)
+
+        return Response(OrderedDict([
+            ('after', after),
+            # Offset to read next events after and to commit when these are processed
+            ('last_sequence', events[-1].sequence if events else after),
+            ('events', TransferEventSerializer(events, many=True).data),
+        ]))
+
+
+class TransferEventConsumerDetail(views.APIView):
+    """
+    Offset of event consumer: PUT commits the last processed sequence number, DELETE starts over
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, name):
+        consumer = get_object_or_404(TransferEventConsumer, name=name)
+        return Response(TransferEventConsumerSerializer(consumer).data)
+
+    def put(self, request, name):
+        serializer = TransferEventConsumerSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        consumer = commit_offset(name, serializer.validated_data['offset'])
+        return Response(TransferEventConsumerSerializer(consumer).data)
+
+    def delete(self, request, name):
+        TransferEventConsumer.objects.filter(name=name).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
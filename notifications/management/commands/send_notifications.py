@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from notifications.worker import NotificationWorker
+
+
+class Command(BaseCommand):
+    help = 'Delivers pending notifications from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process one batch and exit')
+        parser.add_argument('--workers', type=int, help='Number of sending threads')
+        parser.add_argument('--batch-size', type=int, help='Notifications claimed per batch')
+        parser.add_argument('--poll-interval', type=float, default=1, help='Seconds to wait when outbox is empty')
+
+    def handle(self, *args, **options):
+        worker = NotificationWorker(workers=options['workers'], batch_size=options['batch_size'])
+        try:
+            if options['once']:
+                processed = worker.run_once()
+                self.stdout.write(f'{processed} notifications processed')
+            else:
+                worker.run_forever(poll_interval=options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            worker.shutdown()
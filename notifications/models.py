@@ -1,8 +1,25 @@
 from django.db import models
+from django.utils import timezone
 
 
 class Notification(models.Model):
+    """
+    Outbox of notifications. Rows are created as Pending inside the request transaction
+    and delivered by the send_notifications worker command.
+    """
     type = models.CharField(max_length=4, choices=[('M', 'Mail'), ('S', 'SMS')])
     to = models.CharField(max_length=200, default='')
     contents = models.TextField()
     status = models.CharField(max_length=10, choices=[('P', 'Pending'), ('S', 'Success'), ('F', 'Failed')], default='P')
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    sent = models.DateTimeField(blank=True, null=True)
+    # Message id returned by the SMS provider, e.g. Twilio SID
+    message_id = models.CharField(max_length=64, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='notification_outbox_idx'),
+        ]
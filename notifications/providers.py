@@ -0,0 +1,111 @@
+import threading
+import time
+from os import environ
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SMSProvider:
+    """
+    Base class for SMS delivery providers used by the notifications worker
+    """
+    def send(self, to_phone_number, message_body):
+        """
+        Sends SMS or raises an exception
+        :param to_phone_number:
+        :param message_body:
+        :return: provider's message id
+        """
+        raise NotImplementedError
+
+
+class TwilioSMSProvider(SMSProvider):
+    """
+    Twilio client is created once per provider and its HTTP session
+    keeps a pool of connections to Twilio shared by all worker threads
+    """
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from twilio.http.http_client import TwilioHttpClient
+                    from twilio.rest import Client
+
+                    http_client = TwilioHttpClient(pool_connections=True)
+                    http_client.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+                    # Account SID and Auth Token from twilio.com/console
+                    self._client = Client(environ["TWILIO_ACCOUNT_SID"], environ["TWILIO_AUTH_TOKEN"],
+                                          http_client=http_client)
+        return self._client
+
+    def send(self, to_phone_number, message_body):
+        message = self.client.messages.create(
+            to=to_phone_number,
+            from_=environ["TWILIO_NUMBER"],  # Active Number from twilio.com/console/phone-numbers
+            body=message_body)
+        return message.sid
+
+
+class HTTPSMSProvider(SMSProvider):
+    """
+    SMS gateway with a JSON HTTP API: POST {"to": ..., "body": ...} to settings.SMS_HTTP_URL,
+    the response is {"id": ...}. One session keeps a pool of connections to the gateway
+    shared by all worker threads.
+    """
+    def __init__(self, pool_size=10, url=None, token=None, timeout=None):
+        self.url = url or settings.SMS_HTTP_URL
+        self.timeout = timeout or getattr(settings, 'SMS_HTTP_TIMEOUT', 10)
+        self.session = requests.Session()
+        self.session.mount(self.url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        token = token or getattr(settings, 'SMS_HTTP_TOKEN', None)
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def send(self, to_phone_number, message_body):
+        response = self.session.post(self.url, json={'to': to_phone_number, 'body': message_body},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['id']
+
+
+class FakeSMSProvider(SMSProvider):
+    """
+    Local provider for tests and benchmarks. Keeps sent messages in memory.
+    :param fail_times: number of first calls that fail
+    :param latency: seconds to wait per message, simulating provider round trip
+    """
+    def __init__(self, fail_times=0, latency=0, pool_size=None):
+        self.fail_times = fail_times
+        self.latency = latency
+        self.sent = []
+        self._calls = 0
+        self._lock = threading.Lock()
+
+    def send(self, to_phone_number, message_body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._calls += 1
+            if self._calls <= self.fail_times:
+                raise ConnectionError('Fake SMS provider failure')
+            self.sent.append((to_phone_number, message_body))
+            return f'FAKE{len(self.sent):06d}'
+
+
+def get_sms_provider(pool_size=10):
+    """
+    Creates SMS provider configured in settings.SMS_PROVIDER
+    :param pool_size: connections to keep open to the provider
+    :return: SMSProvider instance
+    """
+    provider_class = import_string(getattr(settings, 'SMS_PROVIDER', 'notifications.providers.TwilioSMSProvider'))
+    return provider_class(pool_size=pool_size)
@@ -1,35 +1,12 @@
-# from django.conf import settings
-from os import environ
+from .models import Notification
 
-from twilio.rest import Client
 
-
-def send_sms(to_phone_number, message_body):
+def enqueue_sms(to_phone_number, message_body):
     '''
-    Send sms
+    Adds sms to notifications outbox. Call it inside the transaction of the business change,
+    so sms is delivered only if the change is committed.
     :param to_phone_number:
     :param message_body:
-    :return:
+    :return: pending Notification
     '''
-    # # Account SID from twilio.com/console
-    # account_sid = settings.TWILIO_ACCOUNT_SID
-    # # Auth Token from twilio.com/console
-    # auth_token = settings.TWILIO_AUTH_TOKEN
-    # # Active Number from twilio.com/console/phone-numbers
-    # from_number = settings.TWILIO_NUMBER
-
-    # Account SID from twilio.com/console
-    account_sid = environ["TWILIO_ACCOUNT_SID"]
-    # Auth Token from twilio.com/console
-    auth_token = environ["TWILIO_AUTH_TOKEN"]
-    # Active Number from twilio.com/console/phone-numbers
-    from_number = environ["TWILIO_NUMBER"]
-
-    client = Client(account_sid, auth_token)
-
-    message = client.messages.create(
-        to=to_phone_number,  # "+359885001483",
-        from_=from_number,  # "+17094002369",
-        body=message_body)  # "Hello from Python!")
-
-    print(f"Twilio SMS message SID = {message.sid}")
+    return Notification.objects.create(type='S', to=to_phone_number, contents=message_body)
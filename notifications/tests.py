@@ -1,3 +1,169 @@
-from django.test import TestCase
+from datetime import timedelta
 
-# Create your tests here.
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import status
+
+from bank_api.throttling import parse_rate, take_token
+
+from fund_transfers.tests import BaseFundTransfersTestCase
+from fund_transfers.models import FundTransfer
+from registrations.money import to_money
+from .models import Notification
+from .providers import FakeSMSProvider
+from .worker import NotificationWorker
+
+
+class NotificationOTPTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.base_url = 'http://127.0.0.1:8000/api/v1/notifications/'
+        self.fund_transfer = FundTransfer.objects.create(user=self.manager.user,
+                                                         account=self.account_1_customer_company,
+                                                         iban_beneficiary=self.account_1_customer_person.iban,
+                                                         amount=to_money(250), amount_bgn=to_money(250),
+                                                         currency=self.bgn,
+                                                         details='Test fund transfer')
+
+    def test_send_otp_enqueues_sms(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        otp = FundTransfer.objects.get(pk=self.fund_transfer.pk).otp_generated
+        notification = Notification.objects.get()
+        self.assertEqual(notification.status, 'P')
+        self.assertEqual(notification.to, self.manager.mobile_phone)
+        self.assertIn(otp, notification.contents)
+
+    def test_unexpired_otp_is_sent_again(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+        # OTP is saved once
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "fund_transfers_fundtransfer"')]
+        self.assertEqual(len(updates), 1)
+        fund_transfer = FundTransfer.objects.get(pk=self.fund_transfer.pk)
+
+        self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+        self.assertEqual(FundTransfer.objects.get(pk=self.fund_transfer.pk).otp_generated_at,
+                         fund_transfer.otp_generated_at)
+        self.assertEqual([fund_transfer.otp_generated in notification.contents
+                          for notification in Notification.objects.all()], [True, True])
+
+        # Expired OTP is replaced
+        FundTransfer.objects.filter(pk=self.fund_transfer.pk)\
+            .update(otp_generated_at=timezone.now() - timedelta(seconds=settings.OTP_TTL + 1))
+        self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+        self.assertGreater(FundTransfer.objects.get(pk=self.fund_transfer.pk).otp_generated_at,
+                           fund_transfer.otp_generated_at)
+
+    def test_otp_requests_are_throttled_per_fund_transfer(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        capacity, refill = parse_rate(settings.THROTTLE_RATES['otp_target'])
+        for _ in range(capacity):
+            response = self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertLessEqual(int(response['Retry-After']), refill + 1)
+        self.assertEqual(Notification.objects.count(), capacity)
+
+    def test_otp_requests_of_other_users_do_not_throttle_owner(self):
+        capacity, refill = parse_rate(settings.THROTTLE_RATES['otp_target'])
+        self.client.login(username=self.person.user.username, password='123')
+        for _ in range(capacity + 1):
+            self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+        self.assertFalse(Notification.objects.exists())
+
+        self.client.login(username=self.manager.user.username, password='123')
+        response = self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_token_bucket_refills_over_time(self):
+        bucket, wait = None, 0
+        for _ in range(2):
+            bucket, wait = take_token(bucket, 2, 10, now=100)
+            self.assertEqual(wait, 0)
+        bucket, wait = take_token(bucket, 2, 10, now=104)
+        self.assertAlmostEqual(wait, 6)
+        bucket, wait = take_token(bucket, 2, 10, now=110)
+        self.assertEqual(wait, 0)
+
+    def test_accountant_should_not_get_otp(self):
+        self.client.login(username=self.accountant.user.username, password='123')
+        response = self.client.get(f'{self.base_url}send_otp/{self.fund_transfer.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Notification.objects.exists())
+
+
+class NotificationWorkerTestCase(BaseFundTransfersTestCase):
+
+    def setUp(self):
+        BaseFundTransfersTestCase.setUp(self)
+        self.notification = Notification.objects.create(type='S', to='+359885001483', contents='OTP: 000001')
+
+    def test_worker_sends_pending_notifications(self):
+        provider = FakeSMSProvider()
+        worker = NotificationWorker(provider=provider, workers=2)
+        self.assertEqual(worker.run_once(), 1)
+        worker.shutdown()
+
+        self.notification.refresh_from_db()
+        self.assertEqual(self.notification.status, 'S')
+        self.assertEqual(self.notification.message_id, 'FAKE000001')
+        self.assertEqual(provider.sent, [('+359885001483', 'OTP: 000001')])
+
+    def test_worker_keeps_sends_in_flight_until_outbox_is_empty(self):
+        Notification.objects.create(type='S', to='+359885001484', contents='OTP: 000002')
+        provider = FakeSMSProvider(fail_times=1)
+        worker = NotificationWorker(provider=provider, workers=2, batch_size=1)
+        self.assertEqual(worker.run_forever(poll_interval=0.01, until_empty=True), 2)
+        worker.shutdown()
+
+        # Failed send is retried later, the next notification is claimed meanwhile
+        self.assertEqual(Notification.objects.filter(status='P', attempts=1).count(), 1)
+        self.assertEqual(Notification.objects.filter(status='S').count(), 1)
+        self.assertEqual(len(provider.sent), 1)
+
+    def test_slow_send_is_not_claimed_again(self):
+        provider = FakeSMSProvider(latency=0.3)
+        worker = NotificationWorker(provider=provider, workers=2, claim_timeout=0.05)
+        self.assertEqual(worker.run_forever(poll_interval=0.01, until_empty=True), 1)
+        worker.shutdown()
+
+        self.notification.refresh_from_db()
+        self.assertEqual((self.notification.status, self.notification.attempts), ('S', 1))
+        self.assertEqual(len(provider.sent), 1)
+
+    def test_worker_retries_with_backoff(self):
+        worker = NotificationWorker(provider=FakeSMSProvider(fail_times=1), workers=2, retry_backoff=10)
+        worker.run_once()
+
+        self.notification.refresh_from_db()
+        self.assertEqual(self.notification.status, 'P')
+        self.assertEqual(self.notification.attempts, 1)
+        self.assertGreater(self.notification.next_attempt, timezone.now() + timedelta(seconds=5))
+        # Not due yet
+        self.assertEqual(worker.run_once(), 0)
+
+        Notification.objects.filter(pk=self.notification.pk).update(next_attempt=timezone.now())
+        worker.run_once()
+        worker.shutdown()
+        self.notification.refresh_from_db()
+        self.assertEqual(self.notification.status, 'S')
+
+    def test_worker_fails_after_max_attempts(self):
+        worker = NotificationWorker(provider=FakeSMSProvider(fail_times=2), workers=2, max_attempts=2)
+        worker.run_once()
+        Notification.objects.filter(pk=self.notification.pk).update(next_attempt=timezone.now())
+        worker.run_once()
+        worker.shutdown()
+
+        self.notification.refresh_from_db()
+        self.assertEqual(self.notification.status, 'F')
+        self.assertEqual(self.notification.error, 'Fake SMS provider failure')
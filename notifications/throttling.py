@@ -0,0 +1,29 @@
+from bank_api.throttling import TokenBucketThrottle
+
+
+class OTPUserThrottle(TokenBucketThrottle):
+    """
+    OTP SMS sent to one user
+    """
+    scope = 'otp_user'
+
+    def get_key(self, request, view):
+        return request.user.pk if request.user.is_authenticated else None
+
+
+class OTPTargetThrottle(TokenBucketThrottle):
+    """
+    OTP SMS sent to one user for one fund transfer or approval batch.
+    Throttles run before the view checks ownership, so the bucket is per user too and
+    requests of other users for a transfer do not use up the OTPs of its owner.
+    """
+    scope = 'otp_target'
+
+    def get_key(self, request, view):
+        if not request.user.is_authenticated:
+            return None
+        if 'transfer_pk' in view.kwargs:
+            return f'transfer:{view.kwargs["transfer_pk"]}:user:{request.user.pk}'
+        if 'batch_pk' in view.kwargs:
+            return f'batch:{view.kwargs["batch_pk"]}:user:{request.user.pk}'
+        return None
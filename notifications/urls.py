@@ -3,5 +3,6 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('send_otp/<int:transfer_pk>/', views.NotificationOTP.as_view(), name='send_otp')
+    path('send_otp/<int:transfer_pk>/', views.NotificationOTP.as_view(), name='send_otp'),
+    path('send_otp/batch/<int:batch_pk>/', views.NotificationBatchOTP.as_view(), name='send_batch_otp'),
 ]
@@ -1,32 +1,48 @@
+from datetime import timedelta
 from random import randint
+
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import views
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.status import HTTP_200_OK, HTTP_400_BAD_REQUEST
 
-from .models import Notification
-from .tasks import send_sms
+from .tasks import enqueue_sms
+from .throttling import OTPTargetThrottle, OTPUserThrottle
 
 from registrations.utils import ExtendedTools
-from fund_transfers.models import FundTransfer
+from fund_transfers.models import FundTransfer, ApprovalBatch
 from registrations.models import Account, Accountant
+from registrations.money import to_major
 
 
-class NotificationOTP(ExtendedTools, views.APIView):
+def get_otp(instance):
     """
-    Generates OTP, saves it to FT, sends it by SMS and returns status only
+    Returns unexpired OTP of fund transfer or approval batch or generates a new one.
+    Saves only the OTP fields of instance.
+    :param instance: FundTransfer or ApprovalBatch
+    :return: OTP
     """
-    permission_classes = [IsAuthenticated, ]
+    now = timezone.now()
+    if instance.otp_generated and instance.otp_generated_at and \
+            instance.otp_generated_at > now - timedelta(seconds=getattr(settings, 'OTP_TTL', 300)):
+        return instance.otp_generated
 
-    @staticmethod
-    def generate_otp(fund_transfer):
-        otp = randint(1, 1000000)
-        otp = f'{otp:06d}'
+    instance.otp_generated = f'{randint(0, 999999):06d}'
+    instance.otp_generated_at = now
+    instance.save(update_fields=['otp_generated', 'otp_generated_at', 'last_updated'])
+    return instance.otp_generated
 
-        fund_transfer.otp_generated = otp
-        fund_transfer.save()
-        return otp
+
+class NotificationOTP(ExtendedTools, views.APIView):
+    """
+    Sends OTP of FT by SMS (a new one or the unexpired one) and returns status only
+    """
+    permission_classes = [IsAuthenticated, ]
+    throttle_classes = [OTPTargetThrottle, OTPUserThrottle]
 
     def get(self, request, transfer_pk):
 
@@ -36,21 +52,40 @@ class NotificationOTP(ExtendedTools, views.APIView):
         if Account.objects.filter(pk=fund_transfer.account.pk).filter(users__pk=request.user.pk).exists()\
                 and not isinstance(extended_user, Accountant):
 
-            # Generate OTP
-            otp = self.generate_otp(fund_transfer)
-
-            # Save to FT
-            fund_transfer.otp_generated = otp
-            fund_transfer.save()
+            with transaction.atomic():
+                otp = get_otp(fund_transfer)
 
-            # Send by SMS
-            notification = Notification(type='S', to=extended_user.mobile_phone,
-                                        contents=f' OTP: {otp} for Fund Transfer {transfer_pk} '
-                                        f'({fund_transfer.amount:.2f} {fund_transfer.currency.code})')
-            send_sms(to_phone_number=notification.to, message_body=notification.contents)
-            notification.status = 'S'
-            notification.save()
+                # SMS is sent by the notifications worker after commit
+                enqueue_sms(to_phone_number=extended_user.mobile_phone,
+                            message_body=f' OTP: {otp} for Fund Transfer {transfer_pk} '
+                            f'({to_major(fund_transfer.amount, fund_transfer.currency)} {fund_transfer.currency.code})')
 
             return Response(status=HTTP_200_OK)
 
         return Response(status=HTTP_400_BAD_REQUEST)
+
+
+class NotificationBatchOTP(ExtendedTools, views.APIView):
+    """
+    Sends one OTP for all fund transfers of approval batch by SMS
+    """
+    permission_classes = [IsAuthenticated, ]
+    throttle_classes = [OTPTargetThrottle, OTPUserThrottle]
+
+    def get(self, request, batch_pk):
+
+        extended_user = self.get_extended_user(request.user)
+        approval_batch = get_object_or_404(klass=ApprovalBatch, pk=batch_pk, user__pk=request.user.pk, status='I')
+
+        if isinstance(extended_user, Accountant):
+            return Response(status=HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            otp = get_otp(approval_batch)
+
+            # SMS is sent by the notifications worker after commit
+            enqueue_sms(to_phone_number=extended_user.mobile_phone,
+                        message_body=f' OTP: {otp} for Approval Batch {batch_pk} '
+                        f'({approval_batch.fund_transfers.count()} fund transfers)')
+
+        return Response(status=HTTP_200_OK)
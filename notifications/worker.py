@@ -0,0 +1,127 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Notification
+from .providers import get_sms_provider
+
+
+class NotificationWorker:
+    """
+    Drains the notifications outbox.
+    Pending rows are claimed by the main thread, sent by a pool of threads sharing one provider client
+    and marked Success or, after max_attempts, Failed. Failed attempts are retried with exponential backoff.
+    run_forever keeps up to batch_size notifications in flight and claims more as sends complete,
+    so a slow provider response does not hold back the rest of its batch. Claims of notifications
+    in flight are extended until their sends complete, so they are not claimed and sent again.
+    """
+    def __init__(self, provider=None, workers=None, batch_size=None, max_attempts=None, retry_backoff=None,
+                 claim_timeout=60):
+        self.workers = workers or getattr(settings, 'NOTIFICATION_WORKERS', 8)
+        self.batch_size = batch_size or getattr(settings, 'NOTIFICATION_BATCH_SIZE', 100)
+        self.max_attempts = max_attempts or getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 5)
+        self.retry_backoff = retry_backoff or getattr(settings, 'NOTIFICATION_RETRY_BACKOFF', 30)
+        self.claim_timeout = claim_timeout
+        self.provider = provider or get_sms_provider(pool_size=self.workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def claim_batch(self, limit=None, exclude=()):
+        """
+        Claims due pending notifications. A claim postpones next attempt by claim_timeout,
+        so a notification of a crashed worker is picked up again later.
+        :param limit: notifications to claim, batch_size by default
+        :param exclude: ids of notifications in flight
+        :return: list of claimed notifications
+        """
+        now = timezone.now()
+        due = Notification.objects.filter(status='P', type='S', next_attempt__lte=now).exclude(pk__in=exclude)\
+            .order_by('next_attempt', 'id')[:limit or self.batch_size]
+
+        claimed = []
+        for notification in due:
+            if Notification.objects.filter(pk=notification.pk, status='P', attempts=notification.attempts)\
+                    .update(attempts=F('attempts') + 1, next_attempt=now + timedelta(seconds=self.claim_timeout)):
+                notification.attempts += 1
+                claimed.append(notification)
+        return claimed
+
+    def extend_claims(self, notifications):
+        """
+        Postpones next attempt of notifications still being sent by claim_timeout
+        """
+        Notification.objects.filter(pk__in=[notification.pk for notification in notifications], status='P')\
+            .update(next_attempt=timezone.now() + timedelta(seconds=self.claim_timeout))
+
+    def retry_delay(self, attempts):
+        return timedelta(seconds=self.retry_backoff * 2 ** (attempts - 1))
+
+    def submit(self, notification):
+        return self.executor.submit(self.provider.send, notification.to, notification.contents)
+
+    def record(self, notification, future):
+        """
+        Saves result of a completed send
+        """
+        try:
+            message_id = future.result()
+        except Exception as e:
+            if notification.attempts >= self.max_attempts:
+                Notification.objects.filter(pk=notification.pk).update(status='F', error=str(e))
+            else:
+                Notification.objects.filter(pk=notification.pk).update(
+                    next_attempt=timezone.now() + self.retry_delay(notification.attempts), error=str(e))
+        else:
+            Notification.objects.filter(pk=notification.pk).update(status='S', sent=timezone.now(), error='',
+                                                                   message_id=message_id or '')
+
+    def run_once(self):
+        """
+        Sends one batch of notifications
+        :return: number of processed notifications
+        """
+        notifications = self.claim_batch()
+        futures = [(notification, self.submit(notification)) for notification in notifications]
+
+        for notification, future in futures:
+            self.record(notification, future)
+
+        return len(notifications)
+
+    def run_forever(self, poll_interval=1, until_empty=False):
+        """
+        Sends notifications continuously
+        :param poll_interval: seconds to wait when nothing is due or in flight
+        :param until_empty: return when nothing is due or in flight instead of waiting
+        :return: number of processed notifications, if until_empty
+        """
+        in_flight = {}
+        processed = 0
+        extended = time.monotonic()
+        while True:
+            # Sends have no deadline, claims are renewed at half of claim_timeout
+            if in_flight and time.monotonic() - extended >= self.claim_timeout / 2:
+                self.extend_claims(in_flight.values())
+                extended = time.monotonic()
+
+            if len(in_flight) < self.batch_size:
+                exclude = [notification.pk for notification in in_flight.values()]
+                for notification in self.claim_batch(limit=self.batch_size - len(in_flight), exclude=exclude):
+                    in_flight[self.submit(notification)] = notification
+
+            if not in_flight:
+                if until_empty:
+                    return processed
+                time.sleep(poll_interval)
+                continue
+
+            done, pending = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                self.record(in_flight.pop(future), future)
+            processed += len(done)
+
+    def shutdown(self):
+        self.executor.shutdown()
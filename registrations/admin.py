@@ -9,3 +9,5 @@ admin.site.register(Customer)
 admin.site.register(Currency)
 admin.site.register(AccountProduct)
 admin.site.register(Account)
+admin.site.register(IBANBlock)
+admin.site.register(AccountBalanceShard)
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class RegistrationsConfig(AppConfig):
     name = 'registrations'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        # Database connection tuning and health checks of the project
+        from bank_api import db  # noqa: F401
@@ -0,0 +1,217 @@
+import threading
+import time
+import uuid
+
+import jwt
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import router
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+
+from bank_api.cache import LRUCache
+from .roles import role_resolver
+
+ACCESS_TOKEN = 'access'
+REFRESH_TOKEN = 'refresh'
+
+
+class LocalRevocationList:
+    """
+    Ids of revoked tokens of this worker process, each kept until its token expires
+    """
+    def __init__(self, max_size=100000):
+        self._revoked = LRUCache(max_size=max_size)
+        self._lock = threading.Lock()
+
+    def revoke(self, jti, ttl):
+        with self._lock:
+            self._revoked.set(jti, True, ttl=ttl)
+
+    def claim(self, jti, ttl):
+        """
+        Revokes token unless it is revoked already
+        :return: True if revoked by this call
+        """
+        with self._lock:
+            if self._revoked.get(jti, False):
+                return False
+            self._revoked.set(jti, True, ttl=ttl)
+            return True
+
+    def is_revoked(self, jti):
+        return self._revoked.get(jti, False)
+
+    def clear(self):
+        self._revoked.clear()
+
+
+class CacheRevocationList:
+    """
+    Ids of revoked tokens shared by worker processes in a Django cache (settings.CACHES)
+    """
+    key_prefix = 'revoked_token:'
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def revoke(self, jti, ttl):
+        self.cache.set(self.key_prefix + jti, True, timeout=int(ttl) + 1)
+
+    def claim(self, jti, ttl):
+        """
+        Revokes token unless it is revoked already, atomically across worker processes
+        :return: True if revoked by this call
+        """
+        return self.cache.add(self.key_prefix + jti, True, timeout=int(ttl) + 1)
+
+    def is_revoked(self, jti):
+        return self.cache.get(self.key_prefix + jti, False)
+
+    def clear(self):
+        self.cache.clear()
+
+
+def get_revocation_list():
+    alias = getattr(settings, 'JWT_REVOCATION_CACHE', None)
+    if alias:
+        return CacheRevocationList(alias)
+    return LocalRevocationList(max_size=getattr(settings, 'JWT_REVOCATION_CACHE_SIZE', 100000))
+
+
+revocation_list = get_revocation_list()
+
+
+def issue_token(user, token_type):
+    """
+    Signs token for user
+    :param user: User instance
+    :param token_type: ACCESS_TOKEN or REFRESH_TOKEN
+    :return: encoded token
+    """
+    now = int(time.time())
+    ttl = settings.JWT_ACCESS_TOKEN_TTL if token_type == ACCESS_TOKEN else settings.JWT_REFRESH_TOKEN_TTL
+    claims = {
+        'type': token_type,
+        'jti': uuid.uuid4().hex,
+        'iat': now,
+        'exp': now + ttl,
+        'user_id': user.pk,
+    }
+    if token_type == ACCESS_TOKEN:
+        # Enough to authorize requests without loading user or extended user
+        claims.update({
+            'username': user.get_username(),
+            'is_staff': user.is_staff,
+            'is_superuser': user.is_superuser,
+            'role': role_resolver.get_role(user),
+        })
+    return jwt.encode(claims, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM).decode()
+
+
+def issue_tokens(user):
+    """
+    :param user: active User
+    :return: dict with access and refresh token
+    """
+    return {
+        ACCESS_TOKEN: issue_token(user, ACCESS_TOKEN),
+        REFRESH_TOKEN: issue_token(user, REFRESH_TOKEN),
+    }
+
+
+def decode_token(token, token_type):
+    """
+    Verifies signature, expiry, type and revocation of token
+    :param token: encoded token
+    :param token_type: expected type
+    :return: claims
+    """
+    try:
+        claims = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise exceptions.AuthenticationFailed('Token has expired!')
+    except jwt.InvalidTokenError:
+        raise exceptions.AuthenticationFailed('Invalid token!')
+    if claims.get('type') != token_type:
+        raise exceptions.AuthenticationFailed(f'{token_type.capitalize()} token is expected!')
+    if revocation_list.is_revoked(claims['jti']):
+        raise exceptions.AuthenticationFailed('Token has been revoked!')
+    return claims
+
+
+def revoke_token(claims):
+    """
+    Revokes token until it expires
+    :param claims: claims of decoded token
+    """
+    revocation_list.revoke(claims['jti'], ttl=max(claims['exp'] - time.time(), 1))
+
+
+def claim_token(claims):
+    """
+    Revokes token until it expires, so it is used only once
+    :param claims: claims of decoded token
+    :return: False if the token has been revoked or claimed by a concurrent request
+    """
+    return revocation_list.claim(claims['jti'], ttl=max(claims['exp'] - time.time(), 1))
+
+
+def refresh_tokens(refresh_token):
+    """
+    Issues new tokens for refresh token. Refresh token is rotated: it is revoked and a new one is issued,
+    so user, activity and role are checked again on every refresh.
+    :param refresh_token: encoded refresh token
+    :return: dict with access and refresh token
+    """
+    claims = decode_token(refresh_token, REFRESH_TOKEN)
+    user = get_user_model().objects.filter(pk=claims['user_id'], is_active=True).first()
+    if user is None:
+        raise exceptions.AuthenticationFailed('User is inactive or deleted!')
+    # Concurrent refreshes with the same token get one pair of tokens
+    if not claim_token(claims):
+        raise exceptions.AuthenticationFailed('Token has been revoked!')
+    return issue_tokens(user)
+
+
+class JWTAuthentication(BaseAuthentication):
+    """
+    Stateless authentication by signed access token in the header 'Authorization: Bearer <token>'.
+    User is built from the token claims without a query and carries the role of the claims,
+    so role permissions are checked without loading the extended user.
+    Claims are valid until the token expires (settings.JWT_ACCESS_TOKEN_TTL), changes of the user
+    or their role take effect on the next refresh.
+    """
+    keyword = b'bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword:
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header!')
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header!')
+
+        claims = decode_token(token, ACCESS_TOKEN)
+        return self.get_user(claims), claims
+
+    @staticmethod
+    def get_user(claims):
+        """
+        User with the fields of claims as if loaded from the database, other fields are deferred
+        and loaded on first access
+        """
+        model = get_user_model()
+        values = {model._meta.pk.attname: claims['user_id'], 'username': claims['username'],
+                  'is_staff': claims['is_staff'], 'is_superuser': claims['is_superuser'], 'is_active': True}
+        field_names = [field.attname for field in model._meta.concrete_fields if field.attname in values]
+        user = model.from_db(router.db_for_read(model), field_names, [values[name] for name in field_names])
+        role_resolver.set_role(user, claims['role'])
+        return user
+
+    def authenticate_header(self, request):
+        return 'Bearer'
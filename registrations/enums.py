@@ -16,3 +16,8 @@ class AccountStatusEnum(Enum):
     A = "Active"
     C = "Closed"
 
+
+class UserRoleEnum(Enum):
+    P = "Person"
+    M = "Manager"
+    A = "Accountant"
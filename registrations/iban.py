@@ -0,0 +1,244 @@
+import atexit
+import itertools
+import os
+import socket
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+from sequences.models import Sequence
+
+from .models import Account, IBANBlock
+
+IBAN_SEQUENCE = 'iban_sequence'
+COUNTRY_CODE = 'BG'
+
+Route = namedtuple('Route', ['account_id', 'currency_id', 'balance_shards'])
+
+
+def iban_digits(value):
+    """
+    Letters to numbers as in ISO 13616 (A = 10 ... Z = 35)
+    """
+    return ''.join(str(int(character, 36)) for character in value)
+
+
+# Country code with 00 check digits is moved to the end for mod 97 check
+COUNTRY_SUFFIX = int(iban_digits(COUNTRY_CODE + '00'))
+COUNTRY_SUFFIX_LENGTH = len(iban_digits(COUNTRY_CODE + '00'))
+
+# Country code, check digits, bank code, 2 characters of product code and currency code precede the sequence
+SEQUENCE_OFFSET = len(COUNTRY_CODE) + 2 + len(Account.DJANGO_BANK_BIC) + 2 + 3
+
+
+def iban_sequence(iban):
+    """
+    :param iban: Django bank account IBAN
+    :return: sequence value of the account number
+    """
+    return int(iban[SEQUENCE_OFFSET:])
+
+
+class IBANBlockAllocator:
+    """
+    Hands out Django bank account IBANs from blocks of sequence values reserved per worker process.
+    The sequence row is locked once per block instead of once per account, mod 97 terms of
+    the sequence part are precomputed for the whole block and values are taken with itertools.count,
+    which needs no lock. Unused values of released blocks are recorded as gaps (see IBANBlock).
+    Blocks are reserved in their own transaction, so allocation should not run inside a transaction
+    which may be rolled back.
+    """
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        # Block, its precomputed values, counter and owner process are replaced together
+        self._current = None
+        self._prefixes = {}
+        atexit.register(self._release_at_exit)
+
+    @property
+    def worker(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def reserve(self):
+        """
+        Reserves next block of sequence values
+        :return: IBANBlock
+        """
+        with transaction.atomic():
+            sequence, created = Sequence.objects.select_for_update()\
+                .get_or_create(name=IBAN_SEQUENCE, defaults={'last': self.block_size})
+            if created:
+                start = 1
+            else:
+                start = sequence.last + 1
+                sequence.last += self.block_size
+                sequence.save(update_fields=['last'])
+            return IBANBlock.objects.create(start=start, end=start + self.block_size - 1, worker=self.worker)
+
+    @staticmethod
+    def precompute(block):
+        """
+        Sequence part of every value of block with its mod 97 terms:
+        IBAN number is prefix * 10 ** (len(sequence) + 6) + sequence * 10 ** 6 + country suffix
+        :param block: IBANBlock
+        :return: tuple of (sequence string, sequence term, prefix multiplier)
+        """
+        values = []
+        for value in range(block.start, block.end + 1):
+            sequence = f'{value:05d}'
+            values.append((sequence,
+                           (value * 10 ** COUNTRY_SUFFIX_LENGTH + COUNTRY_SUFFIX) % 97,
+                           pow(10, len(sequence) + COUNTRY_SUFFIX_LENGTH, 97)))
+        return tuple(values)
+
+    def prefix(self, product, currency):
+        """
+        Bank code and account type part of IBAN with its mod 97 remainder
+        """
+        key = (product.code[:2], currency.code)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            value = f'{Account.DJANGO_BANK_BIC}{key[0]}{key[1]}'
+            prefix = self._prefixes[key] = value, int(iban_digits(value)) % 97
+        return prefix
+
+    def _next_value(self):
+        current = self._current
+        # Worker processes forked with a block should not use it
+        if current is not None and current[3] == os.getpid():
+            block, values, counter, pid = current
+            index = next(counter)
+            if index < len(values):
+                return values[index]
+
+        with self._lock:
+            if self._current is current:
+                self.release()
+                block = self.reserve()
+                self._current = block, self.precompute(block), itertools.count(), os.getpid()
+        return self._next_value()
+
+    def next(self, product, currency):
+        """
+        :param product: AccountProduct
+        :param currency: Currency
+        :return: new account IBAN
+        """
+        sequence, sequence_term, multiplier = self._next_value()
+        prefix, prefix_term = self.prefix(product, currency)
+        check_digits = 98 - (prefix_term * multiplier + sequence_term) % 97
+        return f'{COUNTRY_CODE}{check_digits:02d}{prefix}{sequence}'
+
+    def release(self):
+        """
+        Records first unused value of current block, the rest of it is a gap
+        """
+        current, self._current = self._current, None
+        if current is None or current[3] != os.getpid():
+            return
+        block, values, counter, pid = current
+        used = min(next(counter), len(values))
+        IBANBlock.objects.filter(pk=block.pk).update(released=timezone.now(), next_value=block.start + used)
+
+    def _release_at_exit(self):
+        try:
+            self.release()
+        except DatabaseError:
+            # Database may be gone already, the block stays unreleased and is reported as abandoned
+            pass
+
+
+iban_allocator = IBANBlockAllocator(block_size=getattr(settings, 'IBAN_BLOCK_SIZE', 100))
+
+
+class IBANRoutingIndex:
+    """
+    In-process index of Django bank account IBANs, so fund transfers are routed without a query.
+    IBANs without the Django bank code are foreign and rejected by the bank code alone.
+    Accounts are loaded whole on first use and kept current by post_save / post_delete signals
+    of this process (see signals). IBANs with the bank code missing from the index, e.g. of accounts
+    created by other worker processes or by bulk_create, are looked up in the database and added.
+    Routes of other processes' changes may be stale, their users check the routed account (see settlement).
+    """
+    def __init__(self, bank_code=Account.DJANGO_BANK_BIC):
+        self.bank_code = bank_code
+        self._lock = threading.Lock()
+        self._routes = None
+
+    def is_local(self, iban):
+        """
+        :param iban:
+        :return: True if IBAN has the Django bank code
+        """
+        return iban.replace(' ', '').upper()[4:4 + len(self.bank_code)] == self.bank_code
+
+    @staticmethod
+    def _query(ibans=None):
+        accounts = Account.objects.all() if ibans is None else Account.objects.filter(iban__in=ibans)
+        return {iban: Route(pk, currency_id, balance_shards) for iban, pk, currency_id, balance_shards
+                in accounts.values_list('iban', 'pk', 'currency_id', 'balance_shards').iterator()}
+
+    def _get_routes(self):
+        routes = self._routes
+        if routes is None:
+            with self._lock:
+                if self._routes is None:
+                    self._routes = self._query()
+                routes = self._routes
+        return routes
+
+    def lookup(self, ibans):
+        """
+        Routes of a batch of IBANs, IBANs missing from the index are looked up by one query
+        :param ibans: iterable of IBANs
+        :return: dict of Route by IBAN, foreign and unknown IBANs are left out
+        """
+        ibans = [iban for iban in ibans if self.is_local(iban)]
+        if not ibans:
+            return {}
+        routes = self._get_routes()
+        found = {}
+        missing = set()
+        for iban in ibans:
+            route = routes.get(iban)
+            if route is None:
+                missing.add(iban)
+            else:
+                found[iban] = route
+        if missing:
+            loaded = self._query(missing)
+            with self._lock:
+                if self._routes is not None:
+                    self._routes.update(loaded)
+            found.update(loaded)
+        return found
+
+    def get(self, iban):
+        """
+        :param iban:
+        :return: Route or None if IBAN is not of a Django bank account
+        """
+        return self.lookup([iban]).get(iban)
+
+    def add(self, account):
+        """
+        :param account: saved Account
+        """
+        with self._lock:
+            if self._routes is not None:
+                self._routes[account.iban] = Route(account.pk, account.currency_id, account.balance_shards)
+
+    def discard(self, iban):
+        with self._lock:
+            if self._routes is not None:
+                self._routes.pop(iban, None)
+
+    def clear(self):
+        with self._lock:
+            self._routes = None
+
+
+iban_index = IBANRoutingIndex()
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from registrations.iban import iban_sequence
+from registrations.models import Account, IBANBlock
+
+
+class Command(BaseCommand):
+    help = 'Reports unused IBAN sequence values of released blocks and of blocks abandoned by crashed workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale', type=int, default=24 * 60,
+                            help='Minutes after which an unreleased block is considered abandoned')
+        parser.add_argument('--release', action='store_true', help='Release abandoned blocks after the last used value')
+
+    def handle(self, *args, **options):
+        for block in IBANBlock.objects.filter(released__isnull=False).order_by('start'):
+            if block.next_value <= block.end:
+                self.stdout.write(f'{block}: {block.next_value}-{block.end} unused')
+
+        abandoned = IBANBlock.objects.filter(released__isnull=True,
+                                             reserved__lt=timezone.now() - timedelta(minutes=options['stale']))
+        abandoned = list(abandoned.order_by('start'))
+        if abandoned:
+            ibans = Account.objects.filter(iban__contains=Account.DJANGO_BANK_BIC).values_list('iban', flat=True)
+            used_values = {iban_sequence(iban) for iban in ibans}
+
+        for block in abandoned:
+            used = [value for value in range(block.start, block.end + 1) if value in used_values]
+            next_value = used[-1] + 1 if used else block.start
+            self.stdout.write(f'{block}: abandoned, {len(used)} used, {next_value}-{block.end} unused')
+            if options['release']:
+                IBANBlock.objects.filter(pk=block.pk).update(released=timezone.now(), next_value=next_value)
@@ -4,6 +4,7 @@ from django.core.validators import MinValueValidator, MaxValueValidator
 from django_iban.fields import IBANField
 
 from .enums import *
+from .money import MoneyField, MINOR_UNIT
 from .validators import *
 
 
@@ -27,7 +28,10 @@ class Currency(models.Model):
     """
     code = models.CharField(max_length=3, unique=True)
     name = models.CharField(max_length=50)
-    rate_to_bgn = models.FloatField(validators=[MinValueValidator(0)])
+    # Fixed-point rate, amounts are converted with it exactly (see money)
+    rate_to_bgn = models.DecimalField(max_digits=14, decimal_places=6, validators=[MinValueValidator(0)])
+    # Number of decimal places of minor unit (ISO 4217 exponent)
+    minor_unit = models.PositiveSmallIntegerField(default=MINOR_UNIT, validators=[MaxValueValidator(4)])
 
     def __str__(self):
         return f"{self.code} {self.name}"
@@ -110,11 +114,66 @@ class Account(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, null=True)
     users = models.ManyToManyField(User)
     iban = IBANField(enforce_database_constraint=True, unique=True)
-    balance = models.FloatField(validators=[MinValueValidator(0)], default=0)
+    # Minor units of account currency
+    balance = MoneyField(validators=[MinValueValidator(0)], default=0)
     currency = models.ForeignKey(Currency, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=7, choices=[(s.name, s.value) for s in AccountStatusEnum], default='A')
+    # Hot accounts (collection, payroll) receive credits in this number of AccountBalanceShard rows, 0 - disabled
+    balance_shards = models.PositiveSmallIntegerField(default=0)
 
     def __str__(self):
         return f"{self.iban} {self.currency.code}"
 
+    @property
+    def aggregated_balance(self):
+        """
+        Balance with credits not yet compacted from balance shards
+        """
+        if not self.balance_shards:
+            return self.balance
+        if 'shards_balance' in self.__dict__:
+            # Annotated by with_aggregated_balance
+            shards = self.shards_balance or 0
+        else:
+            shards = self.shards.aggregate(total=models.Sum('balance'))['total'] or 0
+        return self.balance + shards
+
+
+def with_aggregated_balance(query_set):
+    """
+    Annotates sum of balance shards, so aggregated_balance of listed accounts needs no query per account
+    :param query_set: Account queryset
+    """
+    return query_set.annotate(shards_balance=models.Sum('shards__balance'))
+
+
+class AccountBalanceShard(models.Model):
+    """
+    Part of hot account balance receiving credits, so concurrent credits do not wait for the account row.
+    Shards are added to Account balance by debits which need them and by compact_balance_shards command.
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='shards', db_index=False)
+    shard = models.PositiveSmallIntegerField()
+    # Minor units of account currency
+    balance = MoneyField(default=0)
+
+    class Meta:
+        unique_together = ('account', 'shard')
+
+
+class IBANBlock(models.Model):
+    """
+    Block of IBAN sequence values reserved by one worker process (see iban).
+    Values from next_value to end of released blocks were never used.
+    Blocks never released belong to running or crashed workers.
+    """
+    start = models.PositiveIntegerField()
+    end = models.PositiveIntegerField()
+    worker = models.CharField(max_length=100)
+    reserved = models.DateTimeField(auto_now_add=True)
+    released = models.DateTimeField(blank=True, null=True)
+    next_value = models.PositiveIntegerField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.start}-{self.end} {self.worker}"
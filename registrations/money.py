@@ -0,0 +1,150 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import models
+from rest_framework import serializers
+
+# Minor unit exponent of BGN and default for currencies (ISO 4217)
+MINOR_UNIT = 2
+# Largest minor unit exponent of ISO 4217 currencies
+MAX_MINOR_UNIT = 4
+
+
+class Money(int):
+    """
+    Amount in minor units of its currency (stotinki, cents).
+    Sums and differences stay Money, so balances are computed in integer math
+    and can be passed to F() expressions as they are.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return f'Money({int(self)})'
+
+    def __add__(self, other):
+        result = int.__add__(self, other)
+        return result if result is NotImplemented else Money(result)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        result = int.__sub__(self, other)
+        return result if result is NotImplemented else Money(result)
+
+    def __rsub__(self, other):
+        result = int.__rsub__(self, other)
+        return result if result is NotImplemented else Money(result)
+
+    def __neg__(self):
+        return Money(-int(self))
+
+    def __abs__(self):
+        return Money(abs(int(self)))
+
+    @classmethod
+    def from_major(cls, value, minor_unit=MINOR_UNIT):
+        """
+        :param value: amount in major units - Decimal, str or number
+        :param minor_unit: currency exponent
+        :return: Money rounded half up to minor units
+        """
+        if isinstance(value, float):
+            value = str(value)
+        return cls(Decimal(value).scaleb(minor_unit).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+    def to_major(self, minor_unit=MINOR_UNIT):
+        return Decimal(int(self)).scaleb(-minor_unit)
+
+
+def minor_unit(currency):
+    return getattr(currency, 'minor_unit', MINOR_UNIT)
+
+
+def to_money(value, currency=None):
+    """
+    Major units amount in currency to Money
+    :param value: amount in major units
+    :param currency: Currency, BGN if None
+    :return: Money
+    """
+    return Money.from_major(value, minor_unit(currency))
+
+
+def to_major(amount, currency=None):
+    return Money(amount).to_major(minor_unit(currency))
+
+
+def to_bgn(amount, currency):
+    """
+    Converts amount in currency to BGN with fixed-point rate, rounding once
+    :param amount: Money in currency
+    :param currency: Currency
+    :return: Money in BGN
+    """
+    rate = Decimal(str(currency.rate_to_bgn))
+    return Money.from_major(to_major(amount, currency) * rate)
+
+
+def from_bgn(amount_bgn, currency):
+    """
+    Converts BGN amount to currency with fixed-point rate, rounding once
+    :param amount_bgn: Money in BGN
+    :param currency: Currency
+    :return: Money in currency
+    """
+    rate = Decimal(str(currency.rate_to_bgn))
+    return Money.from_major(to_major(amount_bgn) / rate, minor_unit(currency))
+
+
+class MoneyField(models.BigIntegerField):
+    """
+    Amount in minor units of currency, stored as integer
+    """
+    description = 'Amount in minor currency units'
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else Money(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Money):
+            return value
+        return Money(super().to_python(value))
+
+
+class MoneySerializerField(serializers.DecimalField):
+    """
+    Money in API is decimal amount in major units of its currency, as JSON number.
+    Currency is found by currency_source, attribute path of currency or currency id on the serialized object,
+    or is the 'currency' of serializer context, BGN if neither is given.
+    Input has up to MAX_MINOR_UNIT decimal places, serializers convert it with to_money in its currency.
+    """
+    def __init__(self, currency_source=None, **kwargs):
+        self.currency_source = currency_source
+        kwargs.setdefault('max_digits', 17)
+        kwargs.setdefault('decimal_places', MAX_MINOR_UNIT)
+        kwargs.setdefault('coerce_to_string', False)
+        super().__init__(**kwargs)
+
+    def get_currency(self, instance):
+        if self.currency_source is None:
+            return self.context.get('currency')
+        currency = instance
+        for attribute in self.currency_source.split('.'):
+            currency = getattr(currency, attribute)
+        if isinstance(currency, int):
+            # Reference data is imported here, it imports models which use MoneyField
+            from .reference import reference_data
+            currency = reference_data.get_currency_by_id(currency)
+        return currency
+
+    def get_attribute(self, instance):
+        value = super().get_attribute(instance)
+        if isinstance(value, int):
+            return to_major(value, self.get_currency(instance))
+        return value
+
+    def to_representation(self, value):
+        # Major units of the currency are exact, quantizing to decimal_places would change the precision
+        if isinstance(value, Decimal):
+            return value if not self.coerce_to_string else '{0:f}'.format(value)
+        return super().to_representation(value)
+
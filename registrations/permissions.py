@@ -1,6 +1,8 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 
-from .models import Manager, Accountant, Person, Account
+from .enums import UserRoleEnum
+from .models import Account
+from .roles import role_resolver
 from fund_transfers.models import FundTransfer
 
 
@@ -34,23 +36,17 @@ class IsMethodPOST(BasePermission):
 
 class IsManager(BasePermission):
     def has_permission(self, request, view):
-        is_manager = Manager.objects.filter(user__pk=request.user.id).exists()
-
-        return is_manager
+        return role_resolver.get_role(request.user) == UserRoleEnum.M.name
 
 
 class IsPerson(BasePermission):
     def has_permission(self, request, view):
-        is_person = Person.objects.filter(user__pk=request.user.id).exists()
-
-        return is_person
+        return role_resolver.get_role(request.user) == UserRoleEnum.P.name
 
 
 class IsAccountant(BasePermission):
     def has_permission(self, request, view):
-        is_accountant = Accountant.objects.filter(user__pk=request.user.id).exists()
-
-        return is_accountant
+        return role_resolver.get_role(request.user) == UserRoleEnum.A.name
 
 
 class AccountDeletePermission(BasePermission):
@@ -67,6 +63,6 @@ class IsManagerAndAccountOwner(BasePermission):
     Manager with access to account could add more users to it
     """
     def has_object_permission(self, request, view, obj):
-        is_manager = Manager.objects.filter(user__pk=request.user.id).exists()
+        is_manager = role_resolver.get_role(request.user) == UserRoleEnum.M.name
         is_account_owner = Account.objects.filter(pk=obj.id).filter(users__pk=request.user.id).exists()
         return is_manager and is_account_owner
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.http import Http404
+from rest_framework.response import Response
+from rest_framework.status import HTTP_304_NOT_MODIFIED
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Currency, AccountProduct
+
+
+class ReferenceDataCache:
+    """
+    In-process cache of reference data coming from Core Banking System - Currencies and Account Products.
+    Both tables are small, so they are loaded whole on first use and dropped
+    by post_save / post_delete signals (see signals) or after ttl seconds, signals do not reach
+    other worker processes nor QuerySet.update().
+    Serialized responses built from them are cached until the next change too.
+    Amounts are converted with rates read by conversion_currencies, not with the rates cached here.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._data = None
+        self._expires = None
+        self._responses = {}
+
+    def _expire(self):
+        expires = self._expires
+        if expires is not None and time.monotonic() >= expires:
+            self.invalidate()
+
+    def _get_data(self):
+        self._expire()
+        data = self._data
+        if data is None:
+            generation = self._generation
+            currencies = list(Currency.objects.order_by('pk'))
+            products = list(AccountProduct.objects.order_by('pk'))
+            data = {
+                'currencies': currencies,
+                'currencies_by_code': {currency.code: currency for currency in currencies},
+                'currencies_by_id': {currency.pk: currency for currency in currencies},
+                'products': products,
+                'products_by_id': {product.pk: product for product in products},
+            }
+            with self._lock:
+                # Data changed while loading, next call loads it again
+                if generation == self._generation:
+                    self._data = data
+                    self._expires = time.monotonic() + self.ttl if self.ttl else None
+        return data
+
+    def currencies(self):
+        return self._get_data()['currencies']
+
+    def products(self):
+        return self._get_data()['products']
+
+    def get_currency(self, code):
+        """
+        :param code: currency code
+        :return: Currency or None
+        """
+        return self._get_data()['currencies_by_code'].get(code)
+
+    def get_currency_by_id(self, pk):
+        return self._get_data()['currencies_by_id'].get(pk)
+
+    def get_product(self, pk):
+        return self._get_data()['products_by_id'].get(pk)
+
+    def get_currency_or_404(self, code):
+        currency = self.get_currency(code)
+        if currency is None:
+            raise Http404('No Currency matches the given query.')
+        return currency
+
+    def get_response(self, key, build):
+        """
+        Cached serialized response data with its ETag
+        :param key: response key, e.g. view name and format
+        :param build: function building response data
+        :return: tuple of data and strong ETag
+        """
+        self._expire()
+        generation = self._generation
+        response = self._responses.get(key)
+        if response is None:
+            data = build()
+            content = json.dumps(data, cls=JSONEncoder, sort_keys=True).encode()
+            response = data, f'"{hashlib.sha1(content).hexdigest()}"'
+            with self._lock:
+                if generation == self._generation:
+                    self._responses[key] = response
+        return response
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._data = None
+            self._expires = None
+            self._responses = {}
+
+
+reference_data = ReferenceDataCache(ttl=getattr(settings, 'REFERENCE_DATA_CACHE_TTL', None))
+
+
+def conversion_currencies(codes):
+    """
+    Currencies read from the database for money conversion, so amounts are converted with current rates
+    :param codes: currency codes
+    :return: dict of Currency by code
+    """
+    return {currency.code: currency for currency in Currency.objects.filter(code__in=set(codes))}
+
+
+def get_conversion_currency_or_404(code):
+    currency = conversion_currencies([code]).get(code)
+    if currency is None:
+        raise Http404('No Currency matches the given query.')
+    return currency
+
+
+class ReferenceDataETagMixin:
+    """
+    Serves GET list from reference data cache with strong ETag.
+    Responds with 304 Not Modified if If-None-Match contains current ETag.
+    """
+    def get_reference_data(self):
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        key = (self.__class__.__name__, request.accepted_media_type)
+        data, etag = reference_data.get_response(key, self.get_reference_data)
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+            return Response(status=HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        return Response(data, headers={'ETag': etag})
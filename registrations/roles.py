@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from bank_api.cache import LRUCache
+from .enums import UserRoleEnum
+from .models import Person, Manager, Accountant
+
+
+class ExtendedUserResolver:
+    """
+    Resolves the extended user (Person / Manager / Accountant) behind a User.
+    Role and profile are loaded with a single query, kept on the request's user instance
+    and in a bounded cache shared between requests.
+    Cache entries are dropped when a profile is saved or deleted (see signals).
+    """
+    # Related names in resolving priority order
+    profiles = (
+        ('person', Person, UserRoleEnum.P.name),
+        ('manager', Manager, UserRoleEnum.M.name),
+        ('accountant', Accountant, UserRoleEnum.A.name),
+    )
+    user_attribute = '_extended_user'
+    role_attribute = '_role'
+
+    def __init__(self, max_size=1024, ttl=None):
+        self._cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    def get_extended_user(self, user):
+        """
+        Gets extended user for user
+        :param user: User instance, usually request.user
+        :return: Person / Manager / Accountant or None if user has no profile
+        """
+        if user is None or not user.is_authenticated:
+            return None
+
+        extended_user = user.__dict__.get(self.user_attribute, _MISSING)
+        if extended_user is _MISSING:
+            extended_user = self._cache.get(user.pk, _MISSING)
+            if extended_user is _MISSING:
+                extended_user = self._load(user.pk)
+                self._cache.set(user.pk, extended_user)
+            setattr(user, self.user_attribute, extended_user)
+
+        return extended_user
+
+    def get_role(self, user):
+        """
+        Gets user role
+        :param user:
+        :return: UserRoleEnum name ('P', 'M', 'A') or None
+        """
+        role = user.__dict__.get(self.role_attribute, _MISSING) if user is not None else _MISSING
+        if role is not _MISSING:
+            return role
+
+        extended_user = self.get_extended_user(user)
+        for related_name, model, role in self.profiles:
+            if isinstance(extended_user, model):
+                return role
+        return None
+
+    def set_role(self, user, role):
+        """
+        Keeps already known role on user instance, e.g. from token claims,
+        so get_role does not load the extended user
+        """
+        setattr(user, self.role_attribute, role)
+
+    def invalidate(self, user_id):
+        self._cache.delete(user_id)
+
+    def clear(self):
+        self._cache.clear()
+
+    def _load(self, user_id):
+        related = [f'{related_name}__customer' for related_name, model, role in self.profiles]
+        user = get_user_model().objects.select_related(*related).filter(pk=user_id).first()
+        if user is None:
+            return None
+
+        for related_name, model, role in self.profiles:
+            try:
+                return getattr(user, related_name)
+            except model.DoesNotExist:
+                continue
+        return None
+
+
+_MISSING = object()
+
+role_resolver = ExtendedUserResolver(max_size=getattr(settings, 'EXTENDED_USER_CACHE_SIZE', 1024),
+                                     ttl=getattr(settings, 'EXTENDED_USER_CACHE_TTL', None))
@@ -1,12 +1,11 @@
 from random import randint
+from django.contrib.auth import authenticate
 from django.contrib.auth.validators import UnicodeUsernameValidator
-from django.db import transaction
 from rest_framework import serializers
 
-from django_iban.generator import IBANGenerator
-from sequences import get_next_value
-
+from .iban import iban_allocator
 from .models import *
+from .money import MoneySerializerField, to_money
 from .utils import ExtendedTools, CustomerTypeValidator
 
 
@@ -72,6 +71,11 @@ class CurrencySerializer(serializers.ModelSerializer):
     class Meta:
         model = Currency
         fields = '__all__'
+        extra_kwargs = {
+            'rate_to_bgn': {
+                'coerce_to_string': False,
+            }
+        }
 
 
 class CurrencyShortSerializer(serializers.ModelSerializer):
@@ -210,11 +214,12 @@ class AccountSerializer(ExtendedTools, serializers.ModelSerializer):
     """
     users = UserDetailSerializer(many=True, read_only=True)
     customer = CustomerDetailSerializer(read_only=True)
+    balance = MoneySerializerField(source='aggregated_balance', currency_source='currency_id', read_only=True)
 
     class Meta:
         model = Account
         fields = '__all__'
-        read_only_fields = ('id', 'customer', 'users', 'iban', 'balance', 'created_at', 'status')
+        read_only_fields = ('id', 'customer', 'users', 'iban', 'balance', 'created_at', 'status', 'balance_shards')
 
     def create(self, validated_data):
         user = self.context['request'].user
@@ -222,17 +227,9 @@ class AccountSerializer(ExtendedTools, serializers.ModelSerializer):
 
         validated_data['customer'] = extended_user.customer
 
-        generator = IBANGenerator()
-
-        with transaction.atomic():
-            iban_sequence = get_next_value('iban_sequence')
-            iban = generator.generate(country_code='BG',
-                                      bank=Account.DJANGO_BANK_BIC,
-                                      account=f"{validated_data['product'].code[:2]}{validated_data['currency'].code}{iban_sequence:05d}")
-
-        validated_data['iban'] = iban['generated_iban']
+        validated_data['iban'] = iban_allocator.next(validated_data['product'], validated_data['currency'])
 
-        validated_data['balance'] = randint(1, 77) * 1000
+        validated_data['balance'] = to_money(randint(1, 77) * 1000, validated_data['currency'])
 
         instance = Account.objects.create(**validated_data)
 
@@ -246,11 +243,13 @@ class AccountStatusSerializer(serializers.ModelSerializer):
     customer = CustomerDetailSerializer(read_only=True)
     product = AccountProductSerializer(read_only=True)
     currency = CurrencyShortSerializer(read_only=True)
+    balance = MoneySerializerField(source='aggregated_balance', currency_source='currency_id', read_only=True)
 
     class Meta:
         model = Account
         fields = '__all__'
-        read_only_fields = ('id', 'customer', 'users', 'iban', 'balance', 'created_at', 'product', 'currency')
+        read_only_fields = ('id', 'customer', 'users', 'iban', 'balance', 'created_at', 'product', 'currency',
+                            'balance_shards')
 
 
 class AccountReadOnlySerializer(serializers.ModelSerializer):
@@ -258,6 +257,7 @@ class AccountReadOnlySerializer(serializers.ModelSerializer):
     customer = CustomerDetailSerializer(read_only=True)
     product = AccountProductShortSerializer(read_only=True)
     currency = CurrencyShortSerializer(read_only=True)
+    balance = MoneySerializerField(source='aggregated_balance', currency_source='currency_id', read_only=True)
 
     class Meta:
         model = Account
@@ -277,3 +277,19 @@ class AccountShortSerializer(serializers.ModelSerializer):
                 'validators': [],
             }
         }
+
+
+class TokenObtainSerializer(serializers.Serializer):
+    username = serializers.CharField()
+    password = serializers.CharField(style={'input_type': 'password'}, write_only=True)
+
+    def validate(self, attrs):
+        user = authenticate(self.context.get('request'), username=attrs['username'], password=attrs['password'])
+        if user is None or not user.is_active:
+            raise serializers.ValidationError('Unable to log in with provided credentials!')
+        attrs['user'] = user
+        return attrs
+
+
+class TokenRefreshSerializer(serializers.Serializer):
+    refresh = serializers.CharField()
@@ -0,0 +1,52 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .iban import iban_index
+from .models import Person, Manager, Accountant, Currency, AccountProduct, Account
+from .reference import reference_data
+from .roles import role_resolver
+
+
+@receiver([post_save, post_delete], sender=Person)
+@receiver([post_save, post_delete], sender=Manager)
+@receiver([post_save, post_delete], sender=Accountant)
+def invalidate_extended_user(sender, instance, **kwargs):
+    """
+    Drops cached role and profile when extended user is changed
+    """
+    role_resolver.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def invalidate_new_user(sender, instance, created, **kwargs):
+    """
+    New user must not reuse cached role of a deleted user with the same pk
+    """
+    if created:
+        role_resolver.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    role_resolver.invalidate(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Currency)
+@receiver([post_save, post_delete], sender=AccountProduct)
+def invalidate_reference_data(sender, instance, **kwargs):
+    reference_data.invalidate()
+
+
+@receiver(post_save, sender=Account)
+def route_account(sender, instance, using, **kwargs):
+    """
+    Account is added to the IBAN routing index after commit, so a rolled back account is never routed
+    """
+    transaction.on_commit(lambda: iban_index.add(instance), using=using)
+
+
+@receiver(post_delete, sender=Account)
+def unroute_account(sender, instance, **kwargs):
+    iban_index.discard(instance.iban)
@@ -1,12 +1,36 @@
-from rest_framework.test import APITestCase
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, APITestCase
 from rest_framework import status
+from bank_api.throttling import bucket_store
+from django_iban.generator import IBANGenerator
+from sequences.models import Sequence
+from .authentication import CacheRevocationList, JWTAuthentication, LocalRevocationList, revocation_list
+from .iban import IBAN_SEQUENCE, IBANBlockAllocator, iban_index
 from .models import *
+from .money import Money, from_bgn, to_bgn, to_money
+from .reference import ReferenceDataCache, get_conversion_currency_or_404, reference_data
+from .roles import role_resolver
+from .serializers import AccountReadOnlySerializer
 
 
 class BaseRegistrationsTestCase(APITestCase):
 
     def setUp(self):
         self.base_url = 'http://127.0.0.1:8000/api/v1/registrations/'
+        # Throttle buckets of the process outlive rolled back test data
+        bucket_store.clear()
+        iban_index.clear()
 
         self.admin_user = User.objects.create_user('admin', 'admin@test.com', '123')
         self.admin_user.is_staff = True
@@ -111,7 +135,7 @@ class BaseRegistrationsTestCase(APITestCase):
         self.account_1_customer_person.product = self.account_product
         self.account_1_customer_person.customer = self.customer_person
         self.account_1_customer_person.iban = 'BG88DJNG828010BGN00012'
-        self.account_1_customer_person.balance = 1000
+        self.account_1_customer_person.balance = to_money(1000)
         self.account_1_customer_person.currency = self.bgn
         self.account_1_customer_person.save()
         self.account_1_customer_person.users.add(self.person.user)
@@ -121,7 +145,7 @@ class BaseRegistrationsTestCase(APITestCase):
         self.account_2_customer_person.product = self.account_product
         self.account_2_customer_person.customer = self.customer_person
         self.account_2_customer_person.iban = 'BG84DJNG828010EUR00013'
-        self.account_2_customer_person.balance = 2000
+        self.account_2_customer_person.balance = to_money(2000, self.eur)
         self.account_2_customer_person.currency = self.eur
         self.account_2_customer_person.save()
         self.account_2_customer_person.users.add(self.person.user)
@@ -131,7 +155,7 @@ class BaseRegistrationsTestCase(APITestCase):
         self.account_1_customer_company.product = self.account_product
         self.account_1_customer_company.customer = self.customer_company
         self.account_1_customer_company.iban = 'BG79DJNG828042BGN00014'
-        self.account_1_customer_company.balance = 12000
+        self.account_1_customer_company.balance = to_money(12000)
         self.account_1_customer_company.currency = self.bgn
         self.account_1_customer_company.save()
         self.account_1_customer_company.users.add(self.manager.user)
@@ -142,12 +166,18 @@ class BaseRegistrationsTestCase(APITestCase):
         self.account_2_customer_company.product = self.account_product
         self.account_2_customer_company.customer = self.customer_company
         self.account_2_customer_company.iban = 'BG97DJNG828020USD00015'
-        self.account_2_customer_company.balance = 24000
+        self.account_2_customer_company.balance = to_money(24000, self.usd)
         self.account_2_customer_company.currency = self.usd
         self.account_2_customer_company.save()
         self.account_2_customer_company.users.add(self.manager.user)
         self.account_2_customer_company.save()
 
+    def assertWithinQueryBudget(self, response):
+        budget = settings.QUERY_BUDGETS.get(response.url_name)
+        self.assertIsNotNone(budget, f'No query budget for {response.url_name}')
+        self.assertLessEqual(response.query_count, budget,
+                             f'{response.url_name}: {response.query_count} queries, budget is {budget}')
+
 
 class RegistrationsTestCases(BaseRegistrationsTestCase):
 
@@ -252,3 +282,408 @@ class RegistrationsTestCases(BaseRegistrationsTestCase):
         self.client.delete(self.base_url + 'accounts/1/')
         after_delete = Account.objects.count()
         self.assertEqual(before_delete, after_delete)
+
+
+class RoleResolverTestCases(BaseRegistrationsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        role_resolver.clear()
+
+    def test_role_resolved_with_single_query(self):
+        user = User.objects.get(pk=self.manager.user.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(role_resolver.get_role(user), 'M')
+            self.assertEqual(role_resolver.get_extended_user(user).customer, self.customer_company)
+
+    def test_role_cached_between_requests(self):
+        role_resolver.get_role(User.objects.get(pk=self.person.user.pk))
+        user = User.objects.get(pk=self.person.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(role_resolver.get_role(user), 'P')
+
+    def test_user_without_profile_has_no_role(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(role_resolver.get_role(self.admin_user))
+            self.assertIsNone(role_resolver.get_role(self.admin_user))
+
+    def test_profile_save_invalidates_cache(self):
+        role_resolver.get_extended_user(User.objects.get(pk=self.manager.user.pk))
+        self.manager.limit_per_transfer = 100
+        self.manager.save()
+        extended_user = role_resolver.get_extended_user(User.objects.get(pk=self.manager.user.pk))
+        self.assertEqual(extended_user.limit_per_transfer, 100)
+
+    def test_profile_delete_invalidates_cache(self):
+        user = User.objects.get(pk=self.accountant.user.pk)
+        role_resolver.get_role(user)
+        self.accountant.delete()
+        self.assertIsNone(role_resolver.get_role(User.objects.get(pk=user.pk)))
+
+
+class QueryCountTestCases(BaseRegistrationsTestCase):
+    """
+    List endpoints should issue the same number of queries for any number of rows
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username=self.admin_user.username, password='123')
+
+    def assertQueryCountIndependentOfRows(self, url, add_rows):
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries_before:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        add_rows()
+        with CaptureQueriesContext(connection) as queries_after:
+            response_after = self.client.get(url)
+        self.assertGreater(len(response_after.content), len(response.content))
+        self.assertEqual(len(queries_before), len(queries_after))
+
+    def add_extended_users(self, count=3):
+        for i in range(count):
+            user = User.objects.create_user(f'extra_{i}', f'extra_{i}@mail.bg', '123')
+            Person.objects.create(user=user, personal_identity_number='1', date_of_birth='1990-12-12',
+                                  address='Sofia', mobile_phone='+359885001483', customer=self.customer_person)
+            user = User.objects.create_user(f'extra_manager_{i}', f'extra_manager_{i}@mail.bg', '123')
+            Manager.objects.create(user=user, personal_identity_number='1', mobile_phone='+359885001483',
+                                   customer=self.customer_company)
+            user = User.objects.create_user(f'extra_accountant_{i}', f'extra_accountant_{i}@mail.bg', '123')
+            Accountant.objects.create(user=user, personal_identity_number='1', mobile_phone='+359885001483',
+                                      customer=self.customer_company)
+
+    def add_accounts(self, count=3):
+        for i in range(count):
+            account = Account.objects.create(product=self.account_product, customer=self.customer_company,
+                                             iban=f'BG80DJNG828010BGN9000{i}', currency=self.eur)
+            account.users.add(self.manager.user, self.accountant.user)
+
+    def test_accounts_query_count(self):
+        self.assertQueryCountIndependentOfRows(self.base_url + 'accounts/', self.add_accounts)
+
+    def add_sharded_accounts(self, count=3):
+        self.add_accounts(count)
+        for account in Account.objects.filter(iban__startswith='BG80DJNG828010BGN9000'):
+            Account.objects.filter(pk=account.pk).update(balance_shards=2)
+            AccountBalanceShard.objects.bulk_create([AccountBalanceShard(account=account, shard=shard, balance=100)
+                                                     for shard in range(2)])
+
+    def test_sharded_accounts_query_count(self):
+        self.assertQueryCountIndependentOfRows(self.base_url + 'accounts/', self.add_sharded_accounts)
+        response = self.client.get(self.base_url + 'accounts/')
+        self.assertEqual({account['balance'] for account in response.data
+                          if account['iban'].startswith('BG80DJNG828010BGN9000')}, {2})
+
+    def test_persons_query_count(self):
+        self.assertQueryCountIndependentOfRows(self.base_url + 'persons/', self.add_extended_users)
+
+    def test_managers_query_count(self):
+        self.assertQueryCountIndependentOfRows(self.base_url + 'managers/', self.add_extended_users)
+
+    def test_accountants_query_count(self):
+        self.assertQueryCountIndependentOfRows(self.base_url + 'accountants/', self.add_extended_users)
+
+    def test_all_users_query_count(self):
+        self.assertQueryCountIndependentOfRows(self.base_url + 'all_users/', self.add_extended_users)
+
+
+class ReferenceDataTestCases(BaseRegistrationsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reference_data.invalidate()
+
+    def test_reference_data_served_from_cache(self):
+        for url in ('currencies/', 'account_products/', 'info/'):
+            self.client.get(self.base_url + url)
+            with self.assertNumQueries(0):
+                response = self.client.get(self.base_url + url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.has_header('ETag'))
+
+    def test_info_lists_products_and_currencies(self):
+        response = self.client.get(self.base_url + 'info/')
+        self.assertEqual([currency['code'] for currency in response.data['Currency']], ['BGN', 'EUR', 'USD'])
+        self.assertEqual([product['code'] for product in response.data['AccountProduct']], ['10CA'])
+
+    def test_if_none_match_returns_not_modified(self):
+        etag = self.client.get(self.base_url + 'currencies/')['ETag']
+        response = self.client.get(self.base_url + 'currencies/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_currency_change_invalidates_cache(self):
+        etag = self.client.get(self.base_url + 'currencies/')['ETag']
+        self.usd.rate_to_bgn = 1.8
+        self.usd.save()
+        response = self.client.get(self.base_url + 'currencies/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(reference_data.get_currency('USD').rate_to_bgn, Decimal('1.8'))
+
+    def test_cached_data_expires_after_ttl(self):
+        cache = ReferenceDataCache(ttl=60)
+        cache.get_currency('USD')
+        # Changes of other worker processes and QuerySet.update() send no signals here
+        Currency.objects.filter(pk=self.usd.pk).update(rate_to_bgn=Decimal('1.8'))
+        self.assertEqual(cache.get_currency('USD').rate_to_bgn, Decimal('1.75584'))
+
+        with mock.patch('registrations.reference.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(cache.get_currency('USD').rate_to_bgn, Decimal('1.8'))
+
+    def test_conversion_uses_current_rate(self):
+        reference_data.get_currency('USD')
+        Currency.objects.filter(pk=self.usd.pk).update(rate_to_bgn=Decimal('1.8'))
+        self.assertEqual(get_conversion_currency_or_404('USD').rate_to_bgn, Decimal('1.8'))
+
+    def test_currency_lookup_by_code(self):
+        reference_data.get_currency('EUR')
+        with self.assertNumQueries(0):
+            self.assertEqual(reference_data.get_currency('EUR'), self.eur)
+            self.assertIsNone(reference_data.get_currency('XXX'))
+
+
+class MoneyTestCases(BaseRegistrationsTestCase):
+
+    def test_money_rounds_half_up_to_minor_units(self):
+        self.assertEqual(Money.from_major('10.005'), 1001)
+        self.assertEqual(Money.from_major(0.1 + 0.2), 30)
+        self.assertEqual(Money.from_major('10', minor_unit=0), 10)
+        self.assertEqual(Money(1001).to_major(), Decimal('10.01'))
+
+    def test_money_arithmetic_stays_money(self):
+        balance = Money(1000) - Money(250) + 5
+        self.assertIsInstance(balance, Money)
+        self.assertIsInstance(-balance, Money)
+        self.assertIsInstance(sum([Money(1), Money(2)]), Money)
+        self.assertEqual(balance, 755)
+
+    def test_conversion_with_fixed_point_rate(self):
+        eur = Currency.objects.get(code='EUR')
+        self.assertEqual(to_bgn(to_money(100, eur), eur), to_money('195.58'))
+        self.assertEqual(from_bgn(to_money('195.58'), eur), to_money(100, eur))
+
+    def test_balance_is_rendered_in_minor_units_of_account_currency(self):
+        jpy = Currency.objects.create(code='JPY', name='Japanese yen', rate_to_bgn=Decimal('0.0118'), minor_unit=0)
+        kwd = Currency.objects.create(code='KWD', name='Kuwaiti dinar', rate_to_bgn=Decimal('5.71'), minor_unit=3)
+        for currency, balance in ((self.bgn, Decimal('12.34')), (jpy, Decimal('1234')), (kwd, Decimal('1.234'))):
+            Account.objects.filter(pk=self.account_1_customer_person.pk).update(currency=currency, balance=1234)
+            account = Account.objects.get(pk=self.account_1_customer_person.pk)
+            self.assertEqual(AccountReadOnlySerializer(account).data['balance'], balance)
+
+    def test_account_balance_is_money(self):
+        account = Account.objects.get(pk=self.account_1_customer_person.pk)
+        self.assertIsInstance(account.balance, Money)
+        self.assertEqual(account.balance, 100000)
+
+
+class IBANAllocatorTestCases(BaseRegistrationsTestCase):
+
+    def test_ibans_match_generator(self):
+        allocator = IBANBlockAllocator(block_size=5)
+        generator = IBANGenerator()
+        for currency in (self.bgn, self.eur, self.usd):
+            iban = allocator.next(self.account_product, currency)
+            expected = generator.generate(country_code='BG', bank=Account.DJANGO_BANK_BIC,
+                                          account=f'{self.account_product.code[:2]}{currency.code}{iban[-5:]}')
+            self.assertEqual(iban, expected['generated_iban'])
+        allocator.release()
+
+    def test_values_are_taken_from_reserved_blocks(self):
+        allocator = IBANBlockAllocator(block_size=10)
+        ibans = [allocator.next(self.account_product, self.bgn)]
+        with self.assertNumQueries(0):
+            ibans += [allocator.next(self.account_product, self.bgn) for _ in range(9)]
+        ibans.append(allocator.next(self.account_product, self.bgn))
+        allocator.release()
+
+        self.assertEqual([int(iban[-5:]) for iban in ibans], list(range(1, 12)))
+        self.assertEqual(list(IBANBlock.objects.order_by('start').values_list('start', 'end', 'next_value')),
+                         [(1, 10, 11), (11, 20, 12)])
+
+    def test_concurrent_allocation_gives_unique_ibans(self):
+        allocator = IBANBlockAllocator(block_size=1000)
+        allocator.next(self.account_product, self.bgn)
+        ibans = []
+
+        def allocate():
+            ibans.extend(allocator.next(self.account_product, self.bgn) for _ in range(100))
+
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(ibans)), 800)
+
+    def test_gaps_of_released_blocks_are_reported(self):
+        allocator = IBANBlockAllocator(block_size=10)
+        allocator.next(self.account_product, self.bgn)
+        allocator.release()
+        out = StringIO()
+        call_command('iban_blocks', stdout=out)
+        self.assertIn('2-10 unused', out.getvalue())
+
+    def test_abandoned_block_above_five_digits_is_reported(self):
+        Sequence.objects.create(name=IBAN_SEQUENCE, last=99999)
+        allocator = IBANBlockAllocator(block_size=10)
+        for _ in range(2):
+            Account.objects.create(product=self.account_product, customer=self.customer_company, currency=self.bgn,
+                                   iban=allocator.next(self.account_product, self.bgn))
+        # Worker crashed without releasing its block
+        allocator._current = None
+        IBANBlock.objects.update(reserved=timezone.now() - timedelta(days=2))
+
+        out = StringIO()
+        call_command('iban_blocks', stdout=out)
+        self.assertIn('100000-100009 ', out.getvalue())
+        self.assertIn('abandoned, 2 used, 100002-100009 unused', out.getvalue())
+
+
+class IBANRoutingIndexTestCases(BaseRegistrationsTestCase):
+
+    def test_batch_lookup_without_queries(self):
+        ibans = [self.account_1_customer_person.iban, self.account_2_customer_company.iban]
+        with self.assertNumQueries(1):
+            iban_index.lookup(ibans)
+        with self.assertNumQueries(0):
+            routes = iban_index.lookup(ibans + ['BG80BNBG96611020345678'])
+        self.assertEqual(routes, {
+            self.account_1_customer_person.iban: (self.account_1_customer_person.pk, self.bgn.pk, 0),
+            self.account_2_customer_company.iban: (self.account_2_customer_company.pk, self.usd.pk, 0),
+        })
+
+    def test_foreign_iban_is_rejected_without_query(self):
+        self.assertFalse(iban_index.is_local('BG80 BNBG 9661 1020 3456 78'))
+        self.assertTrue(iban_index.is_local(self.account_1_customer_person.iban))
+        with self.assertNumQueries(0):
+            self.assertIsNone(iban_index.get('BG80BNBG96611020345678'))
+
+    def test_accounts_missing_from_index_are_looked_up(self):
+        iban_index.get(self.account_1_customer_person.iban)
+        # Accounts of other worker processes or bulk_create do not send signals here
+        account = Account.objects.bulk_create([Account(product=self.account_product, customer=self.customer_person,
+                                                       iban='BG77DJNG828010BGN00016', currency=self.bgn)])[0]
+        account = Account.objects.get(iban=account.iban)
+        with self.assertNumQueries(1):
+            self.assertEqual(iban_index.get(account.iban).account_id, account.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(iban_index.get(account.iban).account_id, account.pk)
+
+    def test_deleted_account_is_discarded(self):
+        account = self.account_2_customer_person
+        iban_index.get(account.iban)
+        account.delete()
+        with self.assertNumQueries(1):
+            self.assertIsNone(iban_index.get(account.iban))
+
+
+class QueryBudgetTestCases(BaseRegistrationsTestCase):
+
+    def test_registrations_endpoints_within_query_budget(self):
+        self.client.login(username=self.manager.user.username, password='123')
+        for endpoint in ('info/', 'currencies/', 'account_products/', 'accounts/', 'managers/', 'accountants/',
+                         'persons/'):
+            response = self.client.get(self.base_url + endpoint)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertWithinQueryBudget(response)
+
+        self.client.login(username=self.admin_user.username, password='123')
+        response = self.client.get(self.base_url + 'all_users/')
+        self.assertWithinQueryBudget(response)
+
+    def test_server_timing_header(self):
+        self.client.login(username=self.person.user.username, password='123')
+        response = self.client.get(self.base_url + 'currencies/')
+        self.assertTrue(response['Server-Timing'].startswith('app;dur='))
+        self.assertIn(f'"{response.query_count} queries, 0 duplicates"', response['Server-Timing'])
+
+
+class TokenAuthenticationTestCases(BaseRegistrationsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        revocation_list.clear()
+
+    def obtain_tokens(self, user):
+        response = self.client.post(self.base_url + 'auth/token/', data={'username': user.username, 'password': '123'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response)
+        return response.data
+
+    def test_obtain_with_invalid_credentials_should_fail(self):
+        response = self.client.post(self.base_url + 'auth/token/',
+                                    data={'username': self.person.user.username, 'password': '456'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_access_token_authenticates_with_role_without_queries(self):
+        tokens = self.obtain_tokens(self.manager.user)
+        role_resolver.clear()
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        with self.assertNumQueries(0):
+            user, claims = JWTAuthentication().authenticate(request)
+            self.assertEqual(user.pk, self.manager.user.pk)
+            self.assertEqual(role_resolver.get_role(user), 'M')
+        self.assertEqual(user.email, self.manager.user.email)
+
+    def test_manager_creates_account_with_access_token(self):
+        tokens = self.obtain_tokens(self.manager.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        response = self.client.post(self.base_url + 'accounts/', data={'product': 1, 'currency': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(Account.objects.filter(pk=response.data['id'], users__pk=self.manager.user.pk).exists())
+
+    def test_refresh_token_is_rotated(self):
+        tokens = self.obtain_tokens(self.person.user)
+        response = self.client.post(self.base_url + 'auth/token/refresh/', data={'refresh': tokens['refresh']},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.data["access"]}')
+        self.assertEqual(self.client.get(self.base_url + 'accounts/').status_code, status.HTTP_200_OK)
+
+        response = self.client.post(self.base_url + 'auth/token/refresh/', data={'refresh': tokens['refresh']},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_refresh_token_is_claimed_once(self):
+        for revocations in (LocalRevocationList(), CacheRevocationList('default')):
+            revocations.clear()
+            self.assertTrue(revocations.claim('jti', ttl=60))
+            self.assertFalse(revocations.claim('jti', ttl=60))
+            self.assertTrue(revocations.is_revoked('jti'))
+
+        tokens = self.obtain_tokens(self.person.user)
+        with mock.patch('registrations.authentication.revocation_list', CacheRevocationList('default')):
+            response = self.client.post(self.base_url + 'auth/token/refresh/', data={'refresh': tokens['refresh']},
+                                        format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(self.base_url + 'auth/token/refresh/', data={'refresh': tokens['refresh']},
+                                        format='json')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_refresh_token_is_not_access_token(self):
+        tokens = self.obtain_tokens(self.person.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["refresh"]}')
+        self.assertNotEqual(self.client.get(self.base_url + 'accounts/').status_code, status.HTTP_200_OK)
+
+    def test_revoked_tokens_are_rejected(self):
+        tokens = self.obtain_tokens(self.person.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        response = self.client.post(self.base_url + 'auth/token/revoke/', data={'refresh': tokens['refresh']},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertNotEqual(self.client.get(self.base_url + 'accounts/').status_code, status.HTTP_200_OK)
+
+        self.client.credentials()
+        response = self.client.post(self.base_url + 'auth/token/refresh/', data={'refresh': tokens['refresh']},
+                                    format='json')
+        self.assertNotEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_expired_access_token_is_rejected(self):
+        with self.settings(JWT_ACCESS_TOKEN_TTL=-1):
+            tokens = self.obtain_tokens(self.person.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.assertNotEqual(self.client.get(self.base_url + 'accounts/').status_code, status.HTTP_200_OK)
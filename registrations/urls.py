@@ -3,6 +3,9 @@ from . import views
 
 urlpatterns = [
     path('auth/', include('rest_auth.urls')),
+    path('auth/token/', views.TokenObtainView.as_view(), name='token_obtain'),
+    path('auth/token/refresh/', views.TokenRefreshView.as_view(), name='token_refresh'),
+    path('auth/token/revoke/', views.TokenRevokeView.as_view(), name='token_revoke'),
     path('info/', views.GeneralInfoView.as_view(), name='info'),
     path('all_users/', views.AllExtendedUsersView.as_view(), name='all_users'),
     path('account_products/', views.AccountProductList.as_view(), name='account_products'),
@@ -1,7 +1,13 @@
+from functools import lru_cache
+
 from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import QuerySet
+from rest_framework import serializers
 from rest_framework.validators import ValidationError
 
 from .models import *
+from .roles import role_resolver
 
 
 class ExtendedTools:
@@ -58,16 +64,9 @@ class ExtendedTools:
         :param user:
         :return: extended user found
         """
-        try:
-            extended_user = Person.objects.get(user__pk=user.id)
-        except Person.DoesNotExist:
-            try:
-                extended_user = Manager.objects.get(user__pk=user.id)
-            except Manager.DoesNotExist:
-                try:
-                    extended_user = Accountant.objects.get(user__pk=user.id)
-                except Accountant.DoesNotExist:
-                    raise ValidationError('Wrong user type!')
+        extended_user = role_resolver.get_extended_user(user)
+        if extended_user is None:
+            raise ValidationError('Wrong user type!')
         return extended_user
 
     @staticmethod
@@ -77,13 +76,9 @@ class ExtendedTools:
         :param user:
         :return: extended user found
         """
-        try:
-            extended_user = Person.objects.get(user__pk=user.id)
-        except Person.DoesNotExist:
-            try:
-                extended_user = Manager.objects.get(user__pk=user.id)
-            except Manager.DoesNotExist:
-                raise ValidationError('Not proper user type!')
+        extended_user = role_resolver.get_extended_user(user)
+        if not isinstance(extended_user, (Person, Manager)):
+            raise ValidationError('Not proper user type!')
         return extended_user
 
     @staticmethod
@@ -114,3 +109,76 @@ class CustomerTypeValidator(object):
             raise ValidationError("Incorrect CBS customer number.")
         if customer.type != self._required_type:
             raise ValidationError("Incorrect customer type.")
+
+
+class QuerysetOptimizer:
+    """
+    Plans select_related / prefetch_related for a serializer by inspecting its nested fields:
+    nested serializers of forward relations are joined, to-many relations are prefetched.
+    """
+    @classmethod
+    def optimize(cls, queryset, serializer_class):
+        """
+        Applies related lookups of serializer_class to queryset
+        :param queryset:
+        :param serializer_class:
+        :return: optimized queryset (anything else is returned unchanged)
+        """
+        if not isinstance(queryset, QuerySet):
+            return queryset
+        select_related, prefetch_related = cls.get_related_lookups(serializer_class)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def get_related_lookups(cls, serializer_class):
+        """
+        :param serializer_class: ModelSerializer class
+        :return: tuples of select_related and prefetch_related lookups
+        """
+        select_related, prefetch_related = [], []
+        cls._collect(serializer_class(), serializer_class.Meta.model, '', False, select_related, prefetch_related)
+        return tuple(select_related), tuple(prefetch_related)
+
+    @classmethod
+    def _collect(cls, serializer, model, prefix, in_prefetch, select_related, prefetch_related):
+        for field in serializer.fields.values():
+            if field.write_only or field.source == '*' or '.' in field.source:
+                continue
+            try:
+                model_field = model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                continue
+            if not model_field.is_relation:
+                continue
+
+            lookup = prefix + field.source
+            to_many = model_field.many_to_many or model_field.one_to_many
+
+            if isinstance(field, serializers.ListSerializer):
+                prefetch_related.append(lookup)
+                if isinstance(field.child, serializers.ModelSerializer):
+                    cls._collect(field.child, model_field.related_model, lookup + '__', True,
+                                 select_related, prefetch_related)
+            elif isinstance(field, serializers.ManyRelatedField):
+                prefetch_related.append(lookup)
+            elif isinstance(field, serializers.ModelSerializer) and not to_many:
+                (prefetch_related if in_prefetch else select_related).append(lookup)
+                cls._collect(field, model_field.related_model, lookup + '__', in_prefetch,
+                             select_related, prefetch_related)
+            elif isinstance(field, serializers.RelatedField) \
+                    and not isinstance(field, serializers.PrimaryKeyRelatedField) and not to_many:
+                (prefetch_related if in_prefetch else select_related).append(lookup)
+
+
+class OptimizedQuerysetMixin:
+    """
+    Generic views mixin, joins and prefetches relations used by the view's serializer
+    """
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return QuerysetOptimizer.optimize(queryset, self.get_serializer_class())
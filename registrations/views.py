@@ -2,7 +2,7 @@ from rest_framework import generics
 from rest_framework import exceptions
 from rest_framework import status
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.validators import ValidationError
 
@@ -11,6 +11,11 @@ from drf_multiple_model.views import ObjectMultipleModelAPIView
 from .serializers import *
 from .permissions import *
 from .models import *
+from .reference import ReferenceDataETagMixin, reference_data
+from .authentication import JWTAuthentication, REFRESH_TOKEN, decode_token, issue_tokens, \
+    refresh_tokens, revoke_token
+from .roles import role_resolver
+from .utils import OptimizedQuerysetMixin, QuerysetOptimizer
 
 
 class MethodSerializerView(object):
@@ -37,16 +42,22 @@ class MethodSerializerView(object):
         raise exceptions.MethodNotAllowed(self.request.method)
 
 
-class GeneralInfoView(ObjectMultipleModelAPIView):
+class GeneralInfoView(ReferenceDataETagMixin, ObjectMultipleModelAPIView):
     """
     General info multiple view for unauthenticated access
     Shows both Account Products and Currencies info
     """
 
-    querylist = [
-        {'queryset': AccountProduct.objects.all(), 'serializer_class': AccountProductSerializer},
-        {'queryset': Currency.objects.all(), 'serializer_class': CurrencySerializer},
-    ]
+    def get_querylist(self):
+        return [
+            {'queryset': reference_data.products(), 'serializer_class': AccountProductSerializer,
+             'label': 'AccountProduct'},
+            {'queryset': reference_data.currencies(), 'serializer_class': CurrencySerializer,
+             'label': 'Currency'},
+        ]
+
+    def get_reference_data(self):
+        return super(ReferenceDataETagMixin, self).list(self.request).data
 
 
 class AllExtendedUsersView(ObjectMultipleModelAPIView):
@@ -57,18 +68,24 @@ class AllExtendedUsersView(ObjectMultipleModelAPIView):
     """
 
     querylist = [
-        {'queryset': Person.objects.all(), 'serializer_class': PersonDetailSerializer},
-        {'queryset': Accountant.objects.all(), 'serializer_class': AccountantDetailSerializer},
-        {'queryset': Manager.objects.all(), 'serializer_class': ManagerDetailSerializer},
+        {'queryset': QuerysetOptimizer.optimize(Person.objects.all(), PersonDetailSerializer),
+         'serializer_class': PersonDetailSerializer},
+        {'queryset': QuerysetOptimizer.optimize(Accountant.objects.all(), AccountantDetailSerializer),
+         'serializer_class': AccountantDetailSerializer},
+        {'queryset': QuerysetOptimizer.optimize(Manager.objects.all(), ManagerDetailSerializer),
+         'serializer_class': ManagerDetailSerializer},
     ]
 
     permission_classes = [IsAdminUser]
 
 
-class AccountProductList(generics.ListCreateAPIView):
+class AccountProductList(ReferenceDataETagMixin, generics.ListCreateAPIView):
     queryset = AccountProduct.objects.all()
     serializer_class = AccountProductSerializer
 
+    def get_reference_data(self):
+        return self.get_serializer(reference_data.products(), many=True).data
+
     permission_classes = [IsSuperUser | IsReadOnly]
 
 
@@ -79,10 +96,13 @@ class AccountProductDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsSuperUser]
 
 
-class CurrencyList(generics.ListCreateAPIView):
+class CurrencyList(ReferenceDataETagMixin, generics.ListCreateAPIView):
     queryset = Currency.objects.all()
     serializer_class = CurrencySerializer
 
+    def get_reference_data(self):
+        return self.get_serializer(reference_data.currencies(), many=True).data
+
     permission_classes = [IsSuperUser | IsReadOnly]
 
 
@@ -107,7 +127,7 @@ class CustomerDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsSuperUser]
 
 
-class PersonList(MethodSerializerView, generics.ListCreateAPIView):
+class PersonList(OptimizedQuerysetMixin, MethodSerializerView, generics.ListCreateAPIView):
     method_serializer_classes = {
         ('GET',): PersonDetailSerializer,
         ('POST',): PersonSerializer,
@@ -126,7 +146,7 @@ class PersonDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAdminUser]
 
 
-class AccountantList(MethodSerializerView, generics.ListCreateAPIView):
+class AccountantList(OptimizedQuerysetMixin, MethodSerializerView, generics.ListCreateAPIView):
     method_serializer_classes = {
         ('GET',): AccountantDetailSerializer,
         ('POST',): AccountantSerializer,
@@ -142,12 +162,9 @@ class AccountantList(MethodSerializerView, generics.ListCreateAPIView):
             return Accountant.objects.all()
         else:
             # Managers should be able to view list of Accountants for the same customer
-            try:
-                manager = Manager.objects.get(user__pk=self.request.user.pk)
-                if manager.customer:
-                    return Accountant.objects.filter(customer__pk=manager.customer.pk)
-            except Manager.DoesNotExist:
-                pass
+            extended_user = role_resolver.get_extended_user(self.request.user)
+            if isinstance(extended_user, Manager) and extended_user.customer_id:
+                return Accountant.objects.filter(customer__pk=extended_user.customer_id)
         return Accountant.objects.none()
 
 
@@ -158,7 +175,7 @@ class AccountantDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAdminUser]
 
 
-class ManagerList(MethodSerializerView, generics.ListCreateAPIView):
+class ManagerList(OptimizedQuerysetMixin, MethodSerializerView, generics.ListCreateAPIView):
     method_serializer_classes = {
         ('GET',): ManagerDetailSerializer,
         ('POST',): ManagerSerializer,
@@ -174,12 +191,9 @@ class ManagerList(MethodSerializerView, generics.ListCreateAPIView):
             return Manager.objects.all()
         else:
             # Managers should be able to view list of Managers for the same customer
-            try:
-                manager = Manager.objects.get(user__pk=self.request.user.pk)
-                if manager.customer:
-                    return Manager.objects.filter(customer__pk=manager.customer.pk)
-            except Manager.DoesNotExist:
-                pass
+            extended_user = role_resolver.get_extended_user(self.request.user)
+            if isinstance(extended_user, Manager) and extended_user.customer_id:
+                return Manager.objects.filter(customer__pk=extended_user.customer_id)
         return Manager.objects.none()
 
 
@@ -190,7 +204,7 @@ class ManagerDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAdminUser]
 
 
-class AccountList(MethodSerializerView, generics.ListCreateAPIView):
+class AccountList(OptimizedQuerysetMixin, MethodSerializerView, generics.ListCreateAPIView):
     method_serializer_classes = {
         ('GET',): AccountReadOnlySerializer,
         ('POST',): AccountSerializer,
@@ -203,7 +217,7 @@ class AccountList(MethodSerializerView, generics.ListCreateAPIView):
         if not user.is_staff:
             query_set = query_set.filter(users__pk=user.pk)
 
-        return query_set
+        return with_aggregated_balance(query_set)
 
     permission_classes = [IsAuthenticated, IsAdminUser | IsPerson | IsManager | IsAccountant & IsReadOnly]
 
@@ -221,7 +235,7 @@ class AccountDetail(MethodSerializerView, generics.RetrieveUpdateDestroyAPIView)
         if not user.is_staff:
             query_set = query_set.filter(users__pk=user.pk)
 
-        return query_set
+        return with_aggregated_balance(query_set)
 
     permission_classes = [IsAuthenticated, AccountDeletePermission, IsAdminUser | IsPerson | IsManager]
 
@@ -259,3 +273,46 @@ class AccountUser(ExtendedTools, APIView):
         return Response(data=serializer.data, status=status.HTTP_200_OK)
 
 
+class TokenObtainView(APIView):
+    """
+    Access and refresh token for username and password
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    serializer_class = TokenObtainSerializer
+
+    def post(self, request):
+        serializer = TokenObtainSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        return Response(data=issue_tokens(serializer.validated_data['user']), status=status.HTTP_200_OK)
+
+
+class TokenRefreshView(APIView):
+    """
+    New access and refresh token for refresh token, the given refresh token is revoked
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    serializer_class = TokenRefreshSerializer
+
+    def post(self, request):
+        serializer = TokenRefreshSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(data=refresh_tokens(serializer.validated_data['refresh']), status=status.HTTP_200_OK)
+
+
+class TokenRevokeView(APIView):
+    """
+    Revokes refresh token and the access token of the request if any (logout)
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [AllowAny]
+    serializer_class = TokenRefreshSerializer
+
+    def post(self, request):
+        serializer = TokenRefreshSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        revoke_token(decode_token(serializer.validated_data['refresh'], REFRESH_TOKEN))
+        if request.auth is not None:
+            revoke_token(request.auth)
+        return Response(status=status.HTTP_204_NO_CONTENT)